@@ -0,0 +1,532 @@
+import logging
+import numpy as np
+from itertools import izip, islice
+from classifiers import BitmapIndex
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100000
+
+# the types to use for fields copied from arcpy.ListFields
+FIELD_TYPES = {
+    'String': 'TEXT',
+    'Integer': 'LONG',
+    'SmallInteger': 'SHORT',
+    'Double': 'DOUBLE',
+    'Single': 'FLOAT',
+    'Date': 'DATE',
+}
+
+
+class GroupIndex(object):
+    """Maps group keys to consecutive ids."""
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """returns the ids of the keys as an array, adding unknown keys"""
+        ids = self.ids
+        result = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            id = ids.get(key)
+            if id is None:
+                id = ids[key] = len(self.keys)
+                self.keys.append(key)
+            result[i] = id
+        return result
+
+
+class Accumulator(object):
+    """
+    Accumulates the number of rows and the count, sum, sum of inverses,
+    minimum and maximum of the non-null values of a column per group id.
+    """
+
+    def __init__(self):
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros(0)
+        self.sum_inverse = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+
+    def _grow(self, size):
+        n = len(self.rows)
+        if size <= n:
+            return
+        def grow(a, fill):
+            b = np.empty(size, dtype=a.dtype)
+            b[:n] = a
+            b[n:] = fill
+            return b
+        self.rows = grow(self.rows, 0)
+        self.count = grow(self.count, 0)
+        self.sum = grow(self.sum, 0)
+        self.sum_inverse = grow(self.sum_inverse, 0)
+        self.min = grow(self.min, np.inf)
+        self.max = grow(self.max, -np.inf)
+
+    def add(self, ids, values=None, size=None):
+        """adds the values (NaN for null) of the rows with the group ids"""
+        if size is None:
+            size = int(ids.max()) + 1 if len(ids) else 0
+        self._grow(size)
+        self.rows += np.bincount(ids, minlength=size)[:len(self.rows)]
+        if values is None:
+            return
+        valid = ~np.isnan(values)
+        ids, values = ids[valid], values[valid]
+        if not len(ids):
+            return
+        self.count += np.bincount(ids, minlength=size)[:len(self.rows)]
+        self.sum += np.bincount(ids, weights=values, minlength=size)[:len(self.rows)]
+        nonzero = values != 0
+        self.sum_inverse += np.bincount(ids[nonzero], weights=1.0 / values[nonzero], minlength=size)[:len(self.rows)]
+        np.minimum.at(self.min, ids, values)
+        np.maximum.at(self.max, ids, values)
+
+    def groups(self, index=None):
+        """
+        returns the ids of the groups with at least one row, ordered by
+        their keys if the GroupIndex is given
+        """
+        ids = np.flatnonzero(self.rows > 0).tolist()
+        if index is not None:
+            ids.sort(key=lambda id: index.keys[id])
+        return ids
+
+    def mean(self, id):
+        return float(self.sum[id] / self.count[id]) if self.count[id] else None
+
+    def harmonic_mean(self, id):
+        return float(self.count[id] / self.sum_inverse[id]) if self.sum_inverse[id] else None
+
+
+def _to_float(values):
+    return np.array([np.nan if x is None else x for x in values], dtype=np.float64)
+
+def _chunks(rows, chunk_size):
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def _join_field(*values):
+    return '|'.join(str(x) for x in values)
+
+def get_field_type(table, name):
+    """returns the type to create a copy of the field with"""
+    for field in table.list_fields():
+        if field.name == name:
+            return FIELD_TYPES.get(field.type, 'TEXT')
+    return 'TEXT'
+
+def write_table(table, fields, rows, join_field=False):
+    """(re)creates the table with the (name, type) fields and inserts the rows"""
+    table.delete_if_exists()
+    table.create()
+    for field_name, field_type in fields:
+        table.add_field(field_name, field_type)
+    with table.insert([field_name for field_name, field_type in fields]) as insert:
+        for row in rows:
+            insert.insertRow(row)
+    if join_field:
+        table.add_index('join_field', 'join_field_idx')
+    return table
+
+def write_speed_tables(fgdb, postfix, axis_type, segment_type, axis_index, by_axis, axis_segment_index, by_axis_segment):
+    """writes the speed_by_axis_segment_ and speed_by_axis_ tables"""
+    rows = []
+    for id in by_axis_segment.groups(axis_segment_index):
+        axis, segment = axis_segment_index.keys[id]
+        rows.append((axis, segment, int(by_axis_segment.count[id]),
+                     by_axis_segment.mean(id), by_axis_segment.harmonic_mean(id)))
+    write_table(
+        fgdb.table('speed_by_axis_segment_' + postfix),
+        [('axis', axis_type), ('segment', segment_type), ('num_observations', 'LONG'),
+         ('arithmetic_mean_speed', 'DOUBLE'), ('harmonic_mean_speed', 'DOUBLE')],
+        rows)
+
+    write_table(
+        fgdb.table('speed_by_axis_' + postfix),
+        [('axis', axis_type), ('num_observations', 'LONG'),
+         ('arithmetic_mean_speed', 'DOUBLE'), ('harmonic_mean_speed', 'DOUBLE')],
+        ((axis_index.keys[id], int(by_axis.count[id]), by_axis.mean(id), by_axis.harmonic_mean(id))
+         for id in by_axis.groups(axis_index)))
+
+
+class MeanSpeedAggregator(object):
+    """
+    Accumulates the arithmetic and harmonic mean speed of measurements by
+    axis and segment and, for measurements of complete axis matches, by
+    axis. Null and 0 speeds are ignored.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.axis = GroupIndex()
+        self.axis_segment = GroupIndex()
+        self.by_axis = Accumulator()
+        self.by_axis_segment = Accumulator()
+
+    def scan(self, view):
+        """adds the (selected) rows of the view"""
+        fields = ['axis', 'segment', 'speed', 'complete_axis_match']
+        with view.search(fields) as rows:
+            for chunk in _chunks(rows, self.chunk_size):
+                axis, segment, speed, complete = izip(*chunk)
+                speed = _to_float(speed)
+                has_speed = ~np.isnan(speed) & (speed != 0)
+                complete = np.array([x == 1 for x in complete], dtype=bool)
+                axis_ids = self.axis.lookup(axis)
+                axis_segment_ids = self.axis_segment.lookup(list(izip(axis, segment)))
+                self.by_axis_segment.add(axis_segment_ids[has_speed], speed[has_speed], len(self.axis_segment))
+                has_speed &= complete
+                self.by_axis.add(axis_ids[has_speed], speed[has_speed], len(self.axis))
+
+    def write(self, fgdb, postfix, axis_type='TEXT', segment_type='LONG'):
+        write_speed_tables(fgdb, postfix, axis_type, segment_type,
+                           self.axis, self.by_axis, self.axis_segment, self.by_axis_segment)
+
+
+class StatisticsAggregator(object):
+    """
+    Calculates the statistics tables of calculate_statistics for every time
+    class in a single scan of the measurements, the stops and the segments
+    of the model. The rows of every scan update group-by accumulators for
+    every (class, axis[, segment]) key they belong to; all tables are
+    written at the end.
+    """
+
+    def __init__(self, model, fgdb, classifiers, names, chunk_size=CHUNK_SIZE):
+        self.model = model
+        self.fgdb = fgdb
+        self.classifiers = classifiers
+        self.names = list(names)
+        self.chunk_size = chunk_size
+
+        self.axis = GroupIndex()
+        self.axis_segment = GroupIndex()
+        self.axis_track = GroupIndex()
+        self.axis_segment_track = GroupIndex()
+        # accumulators by (class, name)
+        self.accumulators = {}
+        self.segment_lengths = None
+        self.axis_lengths = None
+        self.field_types = {}
+
+    def accumulator(self, postfix, name):
+        key = (postfix, name)
+        if key not in self.accumulators:
+            self.accumulators[key] = Accumulator()
+        return self.accumulators[key]
+
+    def selections(self, time_classes):
+        """yields the postfix and row selection of every class"""
+        yield 'all', None
+        index = BitmapIndex(time_classes, self.classifiers)
+        for name in self.names:
+            yield name, index.select(name)
+
+    def run(self):
+        self.scan_measurements()
+        self.scan_stops()
+        self.scan_segments()
+        self.write_tables()
+
+    def scan_measurements(self):
+        measurements = self.fgdb.feature_class('measurements')
+        self.field_types['axis'] = get_field_type(measurements, 'axis')
+        self.field_types['segment'] = get_field_type(measurements, 'segment')
+        fields = ['axis', 'segment', 'complete_axis_match', 'time_class', 'co2', 'consumption', 'speed']
+        with measurements.search(fields) as rows:
+            for chunk in _chunks(rows, self.chunk_size):
+                axis, segment, complete, time_class, co2, consumption, speed = izip(*chunk)
+                axis_ids = self.axis.lookup(axis)
+                axis_segment_ids = self.axis_segment.lookup(list(izip(axis, segment)))
+                complete = np.array([x == 1 for x in complete], dtype=bool)
+                time_class = np.array([x or 0 for x in time_class], dtype=np.int64)
+                co2, consumption, speed = _to_float(co2), _to_float(consumption), _to_float(speed)
+                # the speed statistics ignore null and 0 values
+                has_speed = ~np.isnan(speed) & (speed != 0)
+
+                for postfix, selection in self.selections(time_class):
+                    a, s = axis_ids, axis_segment_ids
+                    c, cm, sp, hs, cp = co2, consumption, speed, has_speed, complete
+                    if selection is not None:
+                        a, s, c, cm, sp, hs, cp = (x[selection] for x in (a, s, c, cm, sp, hs, cp))
+                    self.accumulator(postfix, 'co2_by_axis').add(a, c, len(self.axis))
+                    self.accumulator(postfix, 'consumption_by_axis').add(a, cm, len(self.axis))
+                    self.accumulator(postfix, 'co2_by_axis_segment').add(s, c, len(self.axis_segment))
+                    self.accumulator(postfix, 'consumption_by_axis_segment').add(s, cm, len(self.axis_segment))
+                    self.accumulator(postfix, 'speed_by_axis_segment').add(s[hs], sp[hs], len(self.axis_segment))
+                    hs = hs & cp
+                    self.accumulator(postfix, 'speed_by_axis').add(a[hs], sp[hs], len(self.axis))
+
+    def scan_stops(self):
+        stops = self.fgdb.table('stops')
+        fields = ['axis', 'segment', 'track', 'duration', 'time_class']
+        with stops.search(fields) as rows:
+            for chunk in _chunks(rows, self.chunk_size):
+                axis, segment, track, duration, time_class = izip(*chunk)
+                axis_ids = self.axis.lookup(axis)
+                axis_segment_ids = self.axis_segment.lookup(list(izip(axis, segment)))
+                axis_track_ids = self.axis_track.lookup(list(izip(axis, track)))
+                axis_segment_track_ids = self.axis_segment_track.lookup(list(izip(axis, segment, track)))
+                duration = _to_float(duration)
+                time_class = np.array([x or 0 for x in time_class], dtype=np.int64)
+
+                for postfix, selection in self.selections(time_class):
+                    a, s, at, ast, d = axis_ids, axis_segment_ids, axis_track_ids, axis_segment_track_ids, duration
+                    if selection is not None:
+                        a, s, at, ast, d = (x[selection] for x in (a, s, at, ast, d))
+                    self.accumulator(postfix, 'stops_by_axis').add(a, d, len(self.axis))
+                    self.accumulator(postfix, 'stops_by_axis_segment').add(s, d, len(self.axis_segment))
+                    self.accumulator(postfix, 'stops_by_axis_track').add(at, None, len(self.axis_track))
+                    self.accumulator(postfix, 'stops_by_axis_segment_track').add(ast, None, len(self.axis_segment_track))
+
+    def scan_segments(self):
+        segments = self.model.segments
+        self.field_types['Achsen_ID'] = get_field_type(segments, 'Achsen_ID')
+        self.field_types['segment_id'] = get_field_type(segments, 'segment_id')
+        self.axis_lengths = {}
+        self.segment_lengths = {}
+        with segments.search(['Achsen_ID', 'segment_id', 'laenge']) as rows:
+            for axis, segment, length in rows:
+                for lengths, key in ((self.axis_lengths, axis), (self.segment_lengths, (axis, segment))):
+                    # like the SUM statistic null lengths are ignored, the
+                    # sum of only null lengths is null
+                    if length is not None:
+                        lengths[key] = (lengths.get(key) or 0) + length
+                    else:
+                        lengths.setdefault(key, None)
+
+    def write_table(self, name, fields, rows, join_field=False):
+        return write_table(self.fgdb.table(name), fields, rows, join_field)
+
+    def write_tables(self):
+        for postfix in ['all'] + self.names:
+            self.write_measurement_tables(postfix)
+            self.write_stop_tables(postfix)
+            self.write_travel_time_tables(postfix)
+
+    def write_measurement_tables(self, postfix):
+        axis_type = self.field_types['axis']
+        segment_type = self.field_types['segment']
+        for value in ['consumption', 'co2']:
+            acc = self.accumulator(postfix, value + '_by_axis')
+            self.write_table(
+                '%s_by_axis_%s' % (value, postfix),
+                [('axis', axis_type), ('num_observations', 'LONG'), (value, 'DOUBLE')],
+                ((self.axis.keys[id], int(acc.count[id]), acc.mean(id)) for id in acc.groups(self.axis)))
+
+            acc = self.accumulator(postfix, value + '_by_axis_segment')
+            rows = []
+            for id in acc.groups(self.axis_segment):
+                axis, segment = self.axis_segment.keys[id]
+                rows.append((axis, segment, int(acc.count[id]), acc.mean(id), _join_field(axis, segment)))
+            self.write_table(
+                '%s_by_axis_segment_%s' % (value, postfix),
+                [('axis', axis_type), ('segment', segment_type), ('num_observations', 'LONG'), (value, 'DOUBLE'), ('join_field', 'TEXT')],
+                rows, join_field=True)
+
+        write_speed_tables(self.fgdb, postfix, axis_type, segment_type,
+                           self.axis, self.accumulator(postfix, 'speed_by_axis'),
+                           self.axis_segment, self.accumulator(postfix, 'speed_by_axis_segment'))
+
+    def write_stop_tables(self, postfix):
+        axis_type = self.field_types['axis']
+        segment_type = self.field_types['segment']
+
+        # the stops of tracks that stopped more than once
+        multistops = {}
+        acc = self.accumulator(postfix, 'stops_by_axis_track')
+        for id in acc.groups():
+            if acc.rows[id] > 1:
+                axis = self.axis_track.keys[id][0]
+                multistops[axis] = multistops.get(axis, 0) + int(acc.rows[id])
+        acc = self.accumulator(postfix, 'stops_by_axis')
+        self.write_table(
+            'stops_by_axis_' + postfix,
+            [('axis', axis_type), ('stops', 'LONG'), ('duration', 'DOUBLE'), ('multistops', 'LONG')],
+            ((self.axis.keys[id], int(acc.count[id]), acc.mean(id), multistops.get(self.axis.keys[id], 0))
+             for id in acc.groups(self.axis)))
+
+        multistops = {}
+        acc = self.accumulator(postfix, 'stops_by_axis_segment_track')
+        for id in acc.groups():
+            if acc.rows[id] > 1:
+                key = self.axis_segment_track.keys[id][:2]
+                multistops[key] = multistops.get(key, 0) + int(acc.rows[id])
+        acc = self.accumulator(postfix, 'stops_by_axis_segment')
+        rows = []
+        for id in acc.groups(self.axis_segment):
+            axis, segment = self.axis_segment.keys[id]
+            rows.append((axis, segment, int(acc.count[id]), acc.mean(id), _join_field(axis, segment),
+                         multistops.get((axis, segment), 0)))
+        self.write_table(
+            'stops_by_axis_segment_' + postfix,
+            [('axis', axis_type), ('segment', segment_type), ('stops', 'LONG'), ('duration', 'DOUBLE'),
+             ('join_field', 'TEXT'), ('multistops', 'LONG')],
+            rows, join_field=True)
+
+    def write_travel_time_tables(self, postfix):
+        def duration(length, speed):
+            if length is None or not speed:
+                return None
+            return int(round((length / speed) * 3600))
+
+        # the segment statistics are joined by segment only, so the speed of
+        # a segment is the one of the first (axis, segment) with that segment
+        acc = self.accumulator(postfix, 'speed_by_axis_segment')
+        speed_by_segment = {}
+        for id in acc.groups(self.axis_segment):
+            speed_by_segment.setdefault(self.axis_segment.keys[id][1], acc.mean(id))
+        self.write_table(
+            'travel_time_by_axis_segment_' + postfix,
+            [('axis', self.field_types['Achsen_ID']), ('segment', self.field_types['segment_id']), ('duration', 'LONG')],
+            ((axis, segment, duration(length, speed_by_segment.get(segment)))
+             for (axis, segment), length in sorted(self.segment_lengths.iteritems())))
+
+        acc = self.accumulator(postfix, 'speed_by_axis')
+        speed_by_axis = dict((self.axis.keys[id], acc.mean(id)) for id in acc.groups())
+        self.write_table(
+            'travel_time_by_axis_' + postfix,
+            [('axis', self.field_types['Achsen_ID']), ('duration', 'LONG')],
+            ((axis, duration(length, speed_by_axis.get(axis)))
+             for axis, length in sorted(self.axis_lengths.iteritems())))
+
+
+class PassageAggregator(object):
+    """
+    Counts the passages with and without stops by axis and by segment for
+    every time class in a single scan of the measurements and the stops. A
+    passage is a track on a segment (or, if it matches the complete axis,
+    on an axis). The time classes of the rows of every passage and of its
+    stops are collected as OR-masks in hash maps, so every class is a bit
+    test on them.
+    """
+
+    def __init__(self, model, fgdb, classifiers, names):
+        self.model = model
+        self.fgdb = fgdb
+        self.classifiers = classifiers
+        self.names = list(names)
+        # an extra bit for the rows of all time classes
+        self.all_bit = 1 << len(classifiers)
+        # masks by (axis, segment, track) and (axis, track)
+        self.segment_passages = {}
+        self.axis_passages = {}
+        # masks of any stops and of stops with a duration
+        self.segment_stops = {}
+        self.segment_counted_stops = {}
+        self.axis_counted_stops = {}
+
+    def run(self):
+        self.scan_measurements()
+        self.scan_stops()
+        self.write_tables()
+
+    def bits(self):
+        """yields the postfix and bit of every class"""
+        yield 'all', self.all_bit
+        for name in self.names:
+            yield name, self.classifiers.bits[name]
+
+    def scan_measurements(self):
+        segment_passages = self.segment_passages
+        axis_passages = self.axis_passages
+        fields = ['axis', 'segment', 'track', 'complete_axis_match', 'time_class']
+        with self.fgdb.feature_class('measurements').search(fields) as rows:
+            for axis, segment, track, complete, time_class in rows:
+                mask = (time_class or 0) | self.all_bit
+                key = (axis, segment, track)
+                segment_passages[key] = segment_passages.get(key, 0) | mask
+                if complete == 1:
+                    key = (axis, track)
+                    axis_passages[key] = axis_passages.get(key, 0) | mask
+
+    def scan_stops(self):
+        fields = ['axis', 'segment', 'track', 'duration', 'complete', 'time_class']
+        with self.fgdb.table('stops').search(fields) as rows:
+            for axis, segment, track, duration, complete, time_class in rows:
+                mask = (time_class or 0) | self.all_bit
+                key = (axis, segment, track)
+                self.segment_stops[key] = self.segment_stops.get(key, 0) | mask
+                if duration is not None:
+                    self.segment_counted_stops[key] = self.segment_counted_stops.get(key, 0) | mask
+                    if complete == 1:
+                        key = (axis, track)
+                        self.axis_counted_stops[key] = self.axis_counted_stops.get(key, 0) | mask
+
+    def count(self):
+        """
+        returns the number of passages with and without stops by class and
+        (axis, segment) and by class and axis
+        """
+        by_segment = dict((postfix, {}) for postfix, bit in self.bits())
+        for key, mask in self.segment_passages.iteritems():
+            stops = self.segment_stops.get(key, 0)
+            counted_stops = self.segment_counted_stops.get(key, 0)
+            for postfix, bit in self.bits():
+                if mask & bit:
+                    counts = by_segment[postfix].setdefault(key[:2], [0, 0])
+                    # a passage with only stops without duration is in both
+                    if stops & bit:
+                        counts[0] += 1
+                    if not counted_stops & bit:
+                        counts[1] += 1
+
+        by_axis = dict((postfix, {}) for postfix, bit in self.bits())
+        for key, mask in self.axis_passages.iteritems():
+            counted_stops = self.axis_counted_stops.get(key, 0)
+            for postfix, bit in self.bits():
+                if mask & bit:
+                    counts = by_axis[postfix].setdefault(key[0], [0, 0])
+                    counts[0 if counted_stops & bit else 1] += 1
+        return by_segment, by_axis
+
+    def write_tables(self):
+        segments = self.model.segments
+        axis_type = get_field_type(segments, 'Achsen_ID')
+        segment_type = get_field_type(segments, 'segment_id')
+        with segments.search(['Achsen_ID', 'segment_id']) as rows:
+            axis_segments = sorted(set((axis, segment) for axis, segment in rows))
+        axes = sorted(set(axis for axis, segment in axis_segments))
+
+        def passages_row(key, with_stops, without_stops):
+            with_stops = with_stops or 0
+            without_stops = without_stops or 0
+            return key + (with_stops, without_stops, with_stops + without_stops)
+
+        by_segment, by_axis = self.count()
+        for postfix, bit in self.bits():
+            # the passages were joined to the segments by segment only, so
+            # every segment gets the counts of the first axis with that
+            # segment that has any
+            counts = sorted(by_segment[postfix].iteritems())
+            with_stops, without_stops = {}, {}
+            for (axis, segment), (w, wo) in counts:
+                if w:
+                    with_stops.setdefault(segment, w)
+                if wo:
+                    without_stops.setdefault(segment, wo)
+            write_table(
+                self.fgdb.table('passages_by_axis_segment_' + postfix),
+                [('axis', axis_type), ('segment', segment_type), ('passages_with_stops', 'LONG'),
+                 ('passages_without_stops', 'LONG'), ('passages_overall', 'LONG')],
+                (passages_row((axis, segment), with_stops.get(segment), without_stops.get(segment))
+                 for axis, segment in axis_segments))
+
+            counts = by_axis[postfix]
+            write_table(
+                self.fgdb.table('passages_by_axis_' + postfix),
+                [('axis', axis_type), ('passages_with_stops', 'LONG'),
+                 ('passages_without_stops', 'LONG'), ('passages_overall', 'LONG')],
+                (passages_row((axis,), *counts.get(axis, (0, 0))) for axis in axes))
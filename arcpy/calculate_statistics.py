@@ -3,33 +3,79 @@ import ec
 import ooarcpy
 import os
 import logging
+import multiprocessing
 
 log = logging.getLogger(__name__)
 
-if __name__ == '__main__':
+def calculate_statistics(fgdb, track_workers, statistics_workers):
+    log.debug('calculating statistics for %s', fgdb.id)
+    measurements = fgdb.feature_class('measurements')
+    stops = fgdb.table('stops')
+    try:
+        tracks = fgdb.feature_class('tracks')
+
+        log.debug('creating tracks')
+        ec.create_tracks(measurements, tracks, workers=track_workers)
+
+        log.debug('creating stop table')
+        ec.create_stop_table(measurements, stops, workers=track_workers)
+
+        log.debug('calculating statistics')
+        ec.calculate_statistics(config.axis_model, fgdb, single_pass=config.single_pass_statistics,
+                                workers=statistics_workers, timeout=config.statistics_timeout)
+
+        log.debug('finding passages')
+        ec.find_passages(fgdb, config.axis_model, single_pass=config.single_pass_statistics)
+    finally:
+        stops.delete_if_exists()
+
+    log.debug('creating result tables')
+    ec.create_result_tables(fgdb, config.axis_model, bulk=config.bulk_result_tables)
+
+def _init_period_worker():
     config.setenv()
 
-    for fgdb in config.fgdbs:
+def _calculate_statistics_for_period(path):
+    """
+    Calculates the statistics of a period FileGDB in a worker process and
+    logs to a file of its own. Worker processes can not have pools of
+    their own, so the tracks, stops and statistics are created serially.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    handler = logging.FileHandler(os.path.join(config.basedir, 'ec_%s.log' % name), mode='a')
+    handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s.%(msecs)03d %(levelname)-8s %(name)s: %(message)s',
+        datefmt='%Y-%m-%dT%H:%M:%S'))
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for h in handlers:
+        root.removeHandler(h)
+    root.addHandler(handler)
+    try:
+        calculate_statistics(ooarcpy.FileGDB(path), track_workers=1, statistics_workers=1)
+    finally:
+        root.removeHandler(handler)
+        handler.close()
+        for h in handlers:
+            root.addHandler(h)
+    return path
 
-        log.debug('calculating statistics for %s', fgdb.id)
-        measurements = fgdb.feature_class('measurements')
-        stops = fgdb.table('stops')
+if __name__ == '__main__':
+    config.setenv()
+
+    if config.period_workers > 1:
+        workers = min(config.period_workers, len(config.fgdbs))
+        log.debug('calculating statistics for %d periods using %d workers', len(config.fgdbs), workers)
+        pool = multiprocessing.Pool(workers, _init_period_worker)
         try:
-            tracks = fgdb.feature_class('tracks')
-            
-            log.debug('creating tracks')
-            ec.create_tracks(measurements, tracks)
-            
-            log.debug('creating stop table')
-            ec.create_stop_table(measurements, stops)
-            
-            log.debug('calculating statistics')
-            ec.calculate_statistics(config.axis_model, fgdb)
-            
-            log.debug('finding passages')
-            ec.find_passages(fgdb, config.axis_model)
+            for path in pool.imap_unordered(_calculate_statistics_for_period, [fgdb.id for fgdb in config.fgdbs]):
+                log.debug('calculated statistics for %s', path)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
         finally:
-            stops.delete_if_exists()
-
-        log.debug('creating result tables')
-        ec.create_result_tables(fgdb, config.axis_model)
+            pool.join()
+    else:
+        for fgdb in config.fgdbs:
+            calculate_statistics(fgdb, config.track_workers, config.statistics_workers)
@@ -0,0 +1,146 @@
+import numpy as np
+from collections import namedtuple
+from utils import SQL
+
+HOURS_PER_WEEK = 7 * 24
+MILLIS_PER_HOUR = 60 * 60 * 1000
+# 1970-01-01 was a thursday, shift the epoch hours so 0 is monday 00:00
+EPOCH_HOUR_OF_WEEK = 3 * 24
+
+WORKDAYS = (0, 1, 2, 3, 4)
+WEEKEND = (5, 6)
+
+
+class Classifier(namedtuple('Classifier', ['name', 'days', 'min_hour', 'max_hour'])):
+    """
+    A time of week class: the days of the week (0 is monday) and the hours
+    of the day [min_hour, max_hour). If min_hour > max_hour the range wraps
+    around midnight.
+    """
+
+    def contains(self, weekday, hour):
+        if weekday not in self.days:
+            return False
+        if self.min_hour <= self.max_hour:
+            return self.min_hour <= hour < self.max_hour
+        return self.min_hour <= hour or hour < self.max_hour
+
+
+# times are in UTC, the windows are meant to be in +2
+CLASSIFIERS = (
+    Classifier('weekend_morning', WEEKEND,   4,  8),
+    Classifier('weekend_noon',    WEEKEND,  10, 12),
+    Classifier('weekend_evening', WEEKEND,  13, 17),
+    Classifier('weekend_night',   WEEKEND,  19,  4),
+    Classifier('workday_morning', WORKDAYS,  4,  8),
+    Classifier('workday_noon',    WORKDAYS, 10, 12),
+    Classifier('workday_evening', WORKDAYS, 13, 17),
+    Classifier('workday_night',   WORKDAYS, 19,  4),
+)
+
+
+def hour_of_week(millis):
+    """returns the hour of the week (0 is monday 00:00) of a millisecond timestamp"""
+    return (int(millis // MILLIS_PER_HOUR) + EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+
+def hours_of_week(millis):
+    """returns the hours of the week of an array of millisecond timestamps"""
+    millis = np.asarray(millis)
+    hours = np.floor_divide(millis, MILLIS_PER_HOUR).astype(np.int64)
+    return (hours + EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+
+
+class ClassifierTable(object):
+    """
+    The classifiers compiled into a lookup table mapping every hour of the
+    week to the bitmask of the classifiers containing it. Bit i is set for
+    classifiers[i].
+    """
+
+    def __init__(self, classifiers=CLASSIFIERS):
+        if len(classifiers) > 63:
+            raise ValueError('too many classifiers: %d' % len(classifiers))
+        self.classifiers = tuple(classifiers)
+        self.names = [c.name for c in self.classifiers]
+        self.bits = dict((c.name, 1 << i) for i, c in enumerate(self.classifiers))
+        self.table = np.zeros(HOURS_PER_WEEK, dtype=np.int64)
+        for how in xrange(HOURS_PER_WEEK):
+            weekday, hour = divmod(how, 24)
+            for i, c in enumerate(self.classifiers):
+                if c.contains(weekday, hour):
+                    self.table[how] |= 1 << i
+        # plain integers are faster for scalar lookups
+        self._masks = self.table.tolist()
+
+    def __len__(self):
+        return len(self.classifiers)
+
+    def mask(self, *millis):
+        """returns the bitmask of the classifiers containing any of the timestamps"""
+        mask = 0
+        for t in millis:
+            mask |= self._masks[hour_of_week(t)]
+        return mask
+
+    def masks(self, *millis):
+        """returns the bitmasks of arrays of timestamps (combined elementwise)"""
+        masks = None
+        for t in millis:
+            m = self.table[hours_of_week(t)]
+            masks = m if masks is None else masks | m
+        return masks
+
+    def flags(self, *millis, **kwargs):
+        """
+        returns a tuple of 0/1 flags of the classifiers containing any of the
+        timestamps in the order of names (or of the names keyword argument)
+        """
+        names = kwargs.get('names', self.names)
+        mask = self.mask(*millis)
+        return tuple(1 if mask & self.bits[name] else 0 for name in names)
+
+    def values(self):
+        """
+        returns every bitmask that can be stored for rows classified by one
+        or two timestamps (measurements, or the start and end of tracks and
+        stops), i.e. the table values and their pairwise unions
+        """
+        values = set(self._masks)
+        return sorted(set(a | b for a in values for b in values))
+
+    def values_with(self, name):
+        """returns the possible bitmasks that contain the classifier"""
+        bit = self.bits[name]
+        return [m for m in self.values() if m & bit]
+
+    def where_clause(self, name, field='time_class'):
+        """creates a where clause selecting the rows of a packed time class field in the class"""
+        return SQL.in_(field, self.values_with(name))
+
+
+class BitmapIndex(object):
+    """
+    An in-memory classifier -> row bitmap index over a packed time class
+    column. The row selection of every classifier is computed once and
+    served from memory.
+    """
+
+    def __init__(self, masks, table):
+        masks = np.asarray(masks, dtype=np.int64)
+        self.size = len(masks)
+        self.bitmaps = dict((name, (masks & bit) != 0) for name, bit in table.bits.iteritems())
+
+    def __len__(self):
+        return self.size
+
+    def select(self, name):
+        """returns the boolean row selection of the classifier"""
+        return self.bitmaps[name]
+
+    def count(self, name):
+        """returns the number of rows in the classifier"""
+        return int(np.count_nonzero(self.bitmaps[name]))
+
+    def flags(self, names):
+        """returns the 0/1 flag columns of the classifiers in the order of names"""
+        return [self.bitmaps[name].astype(np.int16) for name in names]
@@ -51,6 +51,29 @@ axes = ['2_1']
 #axes = None
 #axes = [a for a in ec.axis(range(1,10))]
 
+# 'axis' matches the tracks axis by axis, 'track' reads every track only once
+schedule = 'axis'
+# number of worker processes matching axes (or partitions of the tracks with the track schedule) in parallel (1 disables the pool)
+workers = 1
+# only match tracks that were not matched by previous runs and append them
+incremental = False
+# columnar copy of the measurements used to look up track measurements (None disables it)
+store = os.path.join(workspace, 'measurements.store')
+# calculate the statistics and passages of all time classes in a single scan of the tables
+single_pass_statistics = False
+# create the result tables with a single insert per row instead of an update per value
+bulk_result_tables = False
+# number of worker processes creating the tracks and stops of partitions of the tracks (1 disables the pool)
+track_workers = 1
+# number of period FileGDBs calculated in parallel worker processes, each logs to ec_<name>.log
+# (1 disables the pool, the workers create the tracks, stops and statistics serially)
+period_workers = 1
+# number of worker processes calculating independent statistics tables of a period (1 disables the pool)
+# (every task writes to a scratch FileGDB of its own, its tables are copied to the period FileGDB)
+statistics_workers = 1
+# seconds a statistics task may run in a worker before the worker is considered dead (None waits forever)
+statistics_timeout = 4 * 60 * 60
+
 def setenv():
 	arcpy.env.overwriteOutput = True
 	arcpy.env.workspace = workspace
@@ -1,9 +1,13 @@
 import ec
 import config
+from store import MeasurementStore
 
 if __name__ == '__main__':
     config.setenv()
 
+    if config.store is not None:
+        MeasurementStore.open_or_build(config.enviroCar.feature_class('measurements'), config.store)
+
     ec.create_axis_subsets(
         measurements_fc = config.enviroCar.feature_class('measurements'),
         trajectories_fc = config.enviroCar.feature_class('trajectories'),
@@ -12,4 +16,8 @@ if __name__ == '__main__':
         time = None,
         out_dir = config.workspace,
         out_name = 'outputs.gdb',
-        axis_model = config.axis_model)
+        axis_model = config.axis_model,
+        schedule = config.schedule,
+        workers = config.workers,
+        incremental = config.incremental,
+        store = config.store)
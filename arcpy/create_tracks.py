@@ -10,4 +10,4 @@ if __name__ == '__main__':
   for fgdb in config.fgdbs:
     measurements = fgdb.feature_class('measurements')
     tracks = fgdb.feature_class('tracks')
-    ec.create_tracks(measurements, tracks)
+    ec.create_tracks(measurements, tracks, workers=config.track_workers)
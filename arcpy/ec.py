@@ -1,26 +1,58 @@
 import os
+import errno
 import arcpy
 import csv
+import json
+import shutil
+import tempfile
+import multiprocessing
 import textwrap
 import arcpy
-from arcpy import SpatialReference, Array, FieldMappings, env
-from arcpy import Point, Polyline, Multipoint, Geometry
-from ooarcpy import FeatureClass, FileGDB
+from arcpy import SpatialReference, FieldMappings, env
+from ooarcpy import ArcPyEntity, FeatureClass, FileGDB, Table
 from itertools import izip, islice, tee, groupby
 from datetime import timedelta, datetime
-from utils import first, nwise, min_max, SQL, gzip_file
+from utils import first, nwise, min_max, SQL, gzip_file, fingerprint, path_signature, Manifest, route_to_intervals, sort_rows
+from runs import cluster_intervals, find_stop_runs, run_starts
+from classifiers import BitmapIndex, ClassifierTable
+from aggregate import StatisticsAggregator, MeanSpeedAggregator, PassageAggregator, get_field_type
+from store import MeasurementStore
+from parallel import PartitionedExecutor, TaskGraph, hash_partition
+from spatial import SegmentLocator, STRtree, extent_of, union, project_local, segment_point_distances, buffered_envelope_area, linestring_wkb
 import logging
+import numpy as np
+from collections import namedtuple
 
 MAX_TIME_SPAN_SAME_NODE = 10 * 1000
 MAX_TIME_SPAN_CONSECUTIVE_NODES = 60 * 1000
 NUM_CONSECUTIVE_MATCHES = 4
+NODE_VISIT_GAP = 20 * 1000
 NODE_BUFFER_SIZE = 20
+MEASUREMENT_BUFFER_SIZE = 20
+SEGMENT_ASSOCIATION_BATCH_SIZE = 10000
+STOP_CHUNK_SIZE = 100000
+STOP_BATCH_SIZE = 50000
+TRACK_CHUNK_SIZE = 100000
+SORT_CHUNK_SIZE = 500000
+# the table recording facts about the feature classes of a FileGDB
+METADATA_TABLE = 'metadata'
+# the order the measurements are read in by the per track algorithms
+CLUSTERED_ORDER = ['axis', 'track', 'time']
+# the NumPy types of the result table fields (strings keep their length)
+RESULT_FIELD_DTYPES = {'Double': '<f8', 'Single': '<f4', 'Integer': '<i4', 'SmallInteger': '<i2'}
+# the time of week classes of tracks, stops and measurements
+TIME_CLASSES = ClassifierTable()
+# the time classes the statistics are calculated for, in the order of the registry
+TIME_SEGMENTS = list(TIME_CLASSES.names)
 NODE_TYPE_START = 1
 NODE_TYPE_LSA = 2
 NODE_TYPE_INFLUENCE = 3
 
 log = logging.getLogger(__name__)
 
+StopColumns = namedtuple('StopColumns', ['axis', 'segment', 'track', 'start', 'stop', 'duration', 'complete'])
+Trajectories = namedtuple('Trajectories', ['ax', 'ay', 'bx', 'by', 'start_time', 'end_time'])
+
 class TrackMatchingResult(object):
 
     def __init__(self, axis, track, matches, node_count, measurements, model):
@@ -47,6 +79,14 @@ class TrackMatchingResult(object):
     def __len__(self):
         return len(self.matches)
 
+    def __getstate__(self):
+        # the measurements and the model are only needed to filter the
+        # matches, so results passed between processes leave them behind
+        state = self.__dict__.copy()
+        state['measurements'] = None
+        state['model'] = None
+        return state
+
     def check_match_length(self, matches):
         """
         Returns only those matches that have a length greater or equal to the
@@ -72,41 +112,24 @@ class TrackMatchingResult(object):
                 pass
 
     def create_node_matches(self, matches):
-        """Creates NodeMatchingResult objects for the supplied tuples."""
-        for match in matches:
-            idx, min_time, max_time = match
+        """
+        Creates NodeMatchingResult objects for the supplied node index,
+        min_time and max_time arrays.
+        """
+        for idx, min_time, max_time in izip(*(x.tolist() for x in matches)):
             yield NodeMatchingResult(min_time=min_time,
                 max_time=max_time, min_idx=idx,
                 axis_node_count=self.axis_node_count)
 
     def get_segment_bounding_box_area(self, rank):
-        where_clause = SQL.and_((SQL.eq_('Achsen_ID', SQL.quote_(self.axis)),
-                                 SQL.eq_('rank', rank)))
-        with self.model.segments.search('bbox_area', where_clause) as rows:
-            for row in rows:
-                return row[0]
+        areas = self.model.segment_bbox_areas.get(self.axis)
+        if areas is not None and 0 <= rank < len(areas) and areas[rank] is not None:
+            return areas[rank]
         raise Exception('No bbox area for axis segment no. %s of axis %s' % (rank, self.axis))
 
     def get_measurement_bbox_area(self, time):
-        where_clause = SQL.and_((
-            SQL.eq_('track', self.track),
-            SQL.is_between_('time', [time for time in time])
-            ))
-
-        points = [Point(*row[0]) for row in self.measurements.search('SHAPE@XY', where_clause)]
-        if not len(points):
-            return 0
-        multipoint = Multipoint(Array(points), SpatialReference(4326))
-        buffered = None
-        try:
-            buffered = arcpy.analysis.Buffer(multipoint, Geometry(), '20 Meters')[0]
-        except:
-            log.debug('Can not buffer geometry: %s', multipoint.JSON)
-            # FIXME
-            return 0
-
-        bbox = arcpy.management.MinimumBoundingGeometry(buffered, Geometry(), 'ENVELOPE')[0]
-        return bbox.getArea('GEODESIC', 'SQUAREKILOMETERS')
+        x, y = self.measurements.window(*time)
+        return buffered_envelope_area(x, y, MEASUREMENT_BUFFER_SIZE)
 
     def filter_matches(self, matches):
         """
@@ -150,6 +173,44 @@ class TrackMatchingResult(object):
         """Converts this result to a SQL clause."""
         return SQL.and_((SQL.eq_('track', self.track), SQL.or_(x.as_sql_clause() for x in self.matches)))
 
+class TrackMeasurements(object):
+    """
+    The measurements of a single track as time sorted coordinate arrays. With
+    a MeasurementStore the windows are read from the store, otherwise the
+    measurements are fetched from the measurements feature class on first
+    access.
+    """
+
+    def __init__(self, track, measurements, store=None):
+        self.track = track
+        self.measurements = measurements
+        self.store = store
+        self.time = None
+        self.x = None
+        self.y = None
+
+    def fetch(self):
+        where_clause = SQL.eq_('track', self.track)
+        with self.measurements.search(['time', 'SHAPE@XY'], where_clause) as rows:
+            rows = [(time, xy[0], xy[1]) for time, xy in rows if xy is not None and xy[0] is not None]
+        columns = zip(*rows) if rows else [(), (), ()]
+        time, x, y = (np.array(column, dtype=np.float64) for column in columns)
+        order = np.argsort(time, kind='mergesort')
+        self.time, self.x, self.y = time[order], x[order], y[order]
+
+    def window(self, min_time, max_time):
+        """Returns the coordinates of the measurements between min_time and max_time (inclusive)."""
+        if self.store is not None:
+            x, y = self.store.get(self.store.window(self.track, min_time, max_time), ['x', 'y'])
+            # drop missing coordinates
+            valid = ~np.isnan(x)
+            return x[valid], y[valid]
+        if self.time is None:
+            self.fetch()
+        start = np.searchsorted(self.time, min_time, 'left')
+        end = np.searchsorted(self.time, max_time, 'right')
+        return self.x[start:end], self.y[start:end]
+
 class NodeMatchingResult(object):
     def __init__(self, axis_node_count, min_time, max_time, min_idx, max_idx=None, details=None):
         if max_idx is None:
@@ -268,10 +329,13 @@ class NodeMatchingResult(object):
 
 def create_axis_subsets(measurements_fc, trajectories_fc, tracks_fc, axis_model,
                         out_dir = None, out_name = 'outputs.gdb', axes = None,
-                        time = None):
+                        time = None, schedule = 'axis', workers = 1,
+                        incremental = False, store = None):
     matcher = TrackMatcher(measurements_fc=measurements_fc,
         trajectories_fc=trajectories_fc, tracks_fc=tracks_fc, axes=axes,
-        time=time, out_dir=out_dir, out_name=out_name, axis_model=axis_model)
+        time=time, out_dir=out_dir, out_name=out_name, axis_model=axis_model,
+        schedule=schedule, workers=workers, incremental=incremental,
+        store=store)
     matcher.analyze()
 
 class AxisModel(object):
@@ -281,6 +345,28 @@ class AxisModel(object):
         self.start_nodes = FeatureClass(start_nodes)
         self.influence_nodes = FeatureClass(influence_nodes)
         self.lsa_nodes = FeatureClass(lsa_nodes)
+        self._segment_bbox_areas = None
+
+    @property
+    def segment_bbox_areas(self):
+        """
+        The bounding box areas of the segments as a dictionary of lists
+        indexed by axis and segment rank.
+        """
+        if self._segment_bbox_areas is None:
+            self.load_segment_bbox_areas()
+        return self._segment_bbox_areas
+
+    def load_segment_bbox_areas(self):
+        """(Re)loads the bounding box areas of the segments."""
+        areas = {}
+        with self.segments.search(['Achsen_ID', 'rank', 'bbox_area']) as rows:
+            for axis, rank, area in rows:
+                if rank is not None:
+                    areas.setdefault(axis, {})[rank] = area
+        self._segment_bbox_areas = dict(
+            (axis, [values.get(rank) for rank in xrange(max(values) + 1)])
+            for axis, values in areas.iteritems())
 
     @staticmethod
     def for_dir(directory):
@@ -316,13 +402,43 @@ class TrackMatcher(object):
                  out_dir = None,
                  out_name = 'outputs.gdb',
                  axes = None,
-                 time = None):
+                 time = None,
+                 schedule = 'axis',
+                 workers = 1,
+                 csv_dir = None,
+                 incremental = False,
+                 watermarks = None,
+                 csv_suffix = None,
+                 store = None):
+
+        if schedule not in ('axis', 'track'):
+            raise ValueError('unknown schedule: %s' % schedule)
 
         self.out_dir = out_dir if out_dir is not None else env.workspace
         if not os.path.exists(self.out_dir):
-            os.makedirs(self.out_dir)
+            try:
+                os.makedirs(self.out_dir)
+            except OSError as e:
+                # created concurrently, e.g. by another worker process
+                if e.errno != errno.EEXIST:
+                    raise
         self.out_name = out_name
         self.fgdb = FileGDB(os.path.join(self.out_dir, self.out_name))
+        self.csv_dir = csv_dir if csv_dir is not None else self.out_dir
+        self.manifest = Manifest(os.path.join(self.out_dir, self.out_name + '.manifest.json'))
+        self.inputs_fingerprint = None
+        # the tracks already matched against each axis by previous runs
+        if watermarks is None:
+            watermarks = Manifest(os.path.join(self.out_dir, self.out_name + '.watermarks.json'))
+        self.watermarks = watermarks
+        self.incremental = incremental
+        self.csv_suffix = csv_suffix
+        self.track_times = {}
+        self.processed = {}
+        self.track_measurements = None
+        # the path of a MeasurementStore to read track measurements from
+        self.store_path = store
+        self.store = None
         self.axis_model = axis_model
 
         self.measurements_fc = measurements_fc
@@ -337,20 +453,207 @@ class TrackMatcher(object):
         self.node_fc = None
         self.node_buffer_fc = None
         self.node_buffer_fl = None
+        self.node_index = None
+        self.nodes = None
 
         self.axis_ids = axes
         self.time = time
+        self.schedule = schedule
+        self.workers = workers
 
     def analyze(self):
         if self.axis_ids is None:
             self.axis_ids = get_all_axes(self.axis_model)
 
         self.fgdb.create_if_not_exists()
+        target = self.fgdb.feature_class('measurements')
+
+        if self.incremental and not target.exists():
+            log.info('%s does not exist, matching all tracks', target.id)
+            self.incremental = False
+        if self.incremental:
+            # keep the CSV exports of previous runs
+            if self.csv_suffix is None:
+                self.csv_suffix = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        elif not self.manifest.entries:
+            # a new complete run rematches all tracks
+            self.watermarks.delete()
+
+        # fingerprint the inputs before any layer or cursor is opened on them
+        self.inputs_fingerprint = self.get_inputs_fingerprint()
+        # skip the axes that were completed by a previous (failed) run
+        subsets = self.get_completed_subsets()
+        pending = [axis for axis in self.axis_ids if axis not in subsets]
+        if subsets:
+            log.info('Resuming run, %d of %d axes are already completed', len(subsets), len(self.axis_ids))
+
+        if pending and self.workers > 1:
+            subsets.update(self.create_ec_subsets_in_parallel(pending))
+        elif pending:
+            self.open()
+            try:
+                if self.schedule == 'track':
+                    # read every track once and route the results to the axes
+                    matches = self.get_track_matches_for_axes(pending)
+                    for axis in pending:
+                        subsets[axis] = self.checkpoint(axis, self.create_ec_subset_for_axis(axis, matches[axis]))
+                else:
+                    for axis in pending:
+                        subsets[axis] = self.checkpoint(axis, self.create_ec_subset_for_axis(axis))
+            finally:
+                self.close()
+
+        if self.incremental:
+            self.append_subsets([subsets[axis] for axis in self.axis_ids], target)
+            # the new tracks are appended after the existing ones
+            set_clustered(target, False)
+        else:
+            # every subset is clustered by track, so the merged subsets
+            # are clustered by (axis, track)
+            self.merge_subsets([subsets[axis] for axis in sorted(self.axis_ids)], target)
+            add_time_segment_fields(target)
+            set_clustered(target)
+            for axis in self.axis_ids:
+                self.update_watermark(axis)
+        self.manifest.delete()
+
+    def append_subsets(self, subsets, target):
+        """
+        Appends the subsets of newly matched tracks to the target. The
+        subsets already contain the time class of their rows.
+        """
+        if target.exists() and not target.field_exist('time_class'):
+            calculate_time_class_field(target)
+            # the other indexes exist since the target was first created
+            target.add_index(['time_class'], 'time_class_idx')
+        for axis, subset in zip(self.axis_ids, subsets):
+            entry = self.manifest.get(axis)
+            if entry.get('appending'):
+                # a failed run may have appended the subset (partially)
+                log.info('Removing the measurements of axis %s appended by a failed run', axis)
+                self.delete_appended_rows(target, axis, entry['tracks'])
+            else:
+                entry['appending'] = True
+                self.manifest.set(axis, entry)
+            log.info('Appending %d new measurements of axis %s', subset.count(), axis)
+            target.append(subset)
+            # record the progress immediately so a failed run never appends twice
+            self.update_watermark(axis)
+            self.manifest.remove(axis)
+            subset.delete()
+        self.delete_scratch_workspaces(subsets)
+
+    def delete_appended_rows(self, target, axis, tracks, chunk_size=500):
+        """Deletes the measurements of the tracks of the axis from the target."""
+        tracks = sorted(tracks)
+        for i in xrange(0, len(tracks), chunk_size):
+            where_clause = SQL.and_((SQL.eq_('axis', SQL.quote_(axis)),
+                                     SQL.in_('track', [SQL.quote_(track) for track in tracks[i:i + chunk_size]])))
+            with target.update(['track'], where_clause=where_clause) as rows:
+                for row in rows:
+                    rows.deleteRow()
+
+    def update_watermark(self, axis):
+        """Adds the tracks processed for the axis in this run to its watermark."""
+        entry = self.manifest.get(axis)
+        if entry is None:
+            return
+        watermark = self.watermarks.get(axis, {'tracks': [], 'min_time': None, 'max_time': None})
+        times = [t for t in (watermark['min_time'], watermark['max_time'], entry['min_time'], entry['max_time']) if t is not None]
+        self.watermarks.set(axis, {
+            'tracks': sorted(set(watermark['tracks']) | set(entry['tracks'])),
+            'min_time': min(times) if times else None,
+            'max_time': max(times) if times else None
+        })
+
+    def get_watermark_tracks(self, axis):
+        """Returns the set of tracks already matched against the axis."""
+        if not self.incremental:
+            return set()
+        return set(self.watermarks.get(axis, {}).get('tracks', []))
+
+    def record_processed_tracks(self, axis, tracks):
+        """Records the tracks checked against the axis in this run."""
+        times = [self.track_times[track] for track in tracks if track in self.track_times]
+        self.processed[axis] = {
+            'tracks': sorted(tracks),
+            'min_time': min(t[0] for t in times) if times else None,
+            'max_time': max(t[1] for t in times) if times else None
+        }
+
+    def get_inputs_fingerprint(self):
+        """Creates a fingerprint of the inputs and the parameters used for matching."""
+        inputs = (self.measurements_fc, self.trajectories_fc, self.tracks_fc,
+                  self.axis_model.segments, self.axis_model.start_nodes,
+                  self.axis_model.influence_nodes, self.axis_model.lsa_nodes)
+        return fingerprint(
+            [(x.id, path_signature(os.path.dirname(x.id))) for x in inputs],
+            self.time, NODE_BUFFER_SIZE, NUM_CONSECUTIVE_MATCHES,
+            MAX_TIME_SPAN_SAME_NODE, MAX_TIME_SPAN_CONSECUTIVE_NODES,
+            self.incremental)
+
+    def get_fingerprint(self, axis):
+        """Creates a fingerprint of the inputs and parameters used to match the axis."""
+        if self.inputs_fingerprint is None:
+            self.inputs_fingerprint = self.get_inputs_fingerprint()
+        return fingerprint(self.inputs_fingerprint, axis, sorted(self.get_watermark_tracks(axis)))
+
+    def checkpoint(self, axis, subset, processed=None):
+        """
+        Records the completed subset of the axis and the tracks processed for
+        it in the run manifest.
+        """
+        if processed is None:
+            processed = self.processed.get(axis, {'tracks': [], 'min_time': None, 'max_time': None})
+        entry = {
+            'subset': subset.id,
+            'csv': self.get_csv_path(axis) + '.gz',
+            'fingerprint': self.get_fingerprint(axis)
+        }
+        entry.update(processed)
+        self.manifest.set(axis, entry)
+        return subset
+
+    def get_completed_subsets(self):
+        """
+        Returns the subsets recorded in the run manifest whose inputs did not
+        change and whose outputs still exist.
+        """
+        subsets = {}
+        for axis in self.axis_ids:
+            entry = self.manifest.get(axis)
+            if entry is None:
+                continue
+            subset = FeatureClass(entry['subset'])
+            if (entry['fingerprint'] == self.get_fingerprint(axis)
+                    and os.path.exists(entry['csv']) and subset.exists()):
+                subsets[axis] = subset
+            else:
+                self.manifest.remove(axis)
+        return subsets
 
+    def merge_subsets(self, subsets, target):
+        """
+        Merges the subsets into the target. Subsets from scratch workspaces
+        are copied and their workspaces are deleted afterwards.
+        """
+        in_place = all(os.path.dirname(subset.id) == self.fgdb.id for subset in subsets)
+        merge_feature_classes(subsets, target, delete=in_place)
+        if not in_place:
+            for subset in subsets:
+                subset.delete_if_exists()
+            self.delete_scratch_workspaces(subsets)
+
+    def open(self):
+        """Creates the layers, node feature classes and indices used for matching."""
         self.measurements_fl = self.measurements_fc.view()
         self.trajectories_fl = self.trajectories_fc.view()
         self.tracks_fl = self.tracks_fc.view()
         self.axis_segment_fl = self.axis_model.segments.view()
+        # the segment bounding boxes are shared by all matching results
+        self.axis_model.load_segment_bbox_areas()
+        if self.store_path is not None:
+            self.store = MeasurementStore(self.store_path)
 
         # join the different node feature classes
         self.node_fc = self.create_node_feature_class()
@@ -361,30 +664,113 @@ class TrackMatcher(object):
 
         self.node_buffer_fl = self.node_buffer_fc.view()
         #self.axis_mbr_fl = self.axis_mbr_fc.view()
-
+        # load the node buffers into an in-memory spatial index
+        self.node_index = self.create_node_index()
+
+    def close(self):
+        """Deletes the layers and temporary feature classes created by open()."""
+        self.node_buffer_fl.delete()
+        #self.axis_mbr_fl.delete()
+        self.measurements_fl.delete()
+        self.trajectories_fl.delete()
+        self.axis_segment_fl.delete()
+        self.tracks_fl.delete()
+        self.node_buffer_fc.delete_if_exists()
+        self.node_fc.delete_if_exists()
+        #self.axis_mbr_fc.delete_if_exists()
+        self.node_index = None
+        self.nodes = None
+        self.track_measurements = None
+        if self.store is not None:
+            self.store.close()
+        self.store = None
+
+    def create_ec_subsets_in_parallel(self, axes):
+        """
+        Matches the axes in a pool of worker processes. Every worker writes
+        its subsets to its own scratch FileGDB. Returns the subsets by axis.
+        """
+        scratch_dir = os.path.join(self.out_dir, 'scratch')
+        # create it before the workers do
+        if not os.path.exists(scratch_dir):
+            os.makedirs(scratch_dir)
+        kwargs = dict(measurements_fc=self.measurements_fc,
+                      trajectories_fc=self.trajectories_fc,
+                      tracks_fc=self.tracks_fc,
+                      axis_model=self.axis_model,
+                      out_dir=scratch_dir,
+                      csv_dir=self.csv_dir,
+                      csv_suffix=self.csv_suffix,
+                      incremental=self.incremental,
+                      watermarks=self.watermarks,
+                      store=self.store_path,
+                      time=self.time)
+        settings = dict(overwriteOutput=env.overwriteOutput, workspace=env.workspace)
+        log.info('Matching %d axes using %d workers', len(axes), self.workers)
+        subsets = {}
+        pool = multiprocessing.Pool(self.workers, _init_matcher_worker, (kwargs, settings))
         try:
-            target = self.fgdb.feature_class('measurements')
-            subsets = [self.create_ec_subset_for_axis(axis) for axis in self.axis_ids]
-            merge_feature_classes(subsets, target)
-            add_time_segment_fields(target)
+            if self.schedule == 'track':
+                # every worker reads a partition of the tracks once and
+                # matches it against all axes, then the axes are written
+                tasks = [(axes, (partition, self.workers)) for partition in xrange(self.workers)]
+                matches = dict((axis, []) for axis in axes)
+                processed = dict((axis, []) for axis in axes)
+                for partition_matches, partition_processed in pool.imap_unordered(_get_track_matches_for_axes, tasks):
+                    for axis in axes:
+                        matches[axis].extend(partition_matches[axis])
+                        processed[axis].append(partition_processed[axis])
+                tasks = [(axis, matches[axis], merge_processed_tracks(processed[axis])) for axis in axes]
+            else:
+                tasks = [(axis, None, None) for axis in axes]
+            for axis, subset, processed in pool.imap_unordered(_create_ec_subset_for_axis, tasks):
+                subsets[axis] = self.checkpoint(axis, FeatureClass(subset), processed)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
         finally:
-            self.node_buffer_fl.delete()
-            #self.axis_mbr_fl.delete()
-            self.measurements_fl.delete()
-            self.trajectories_fl.delete()
-            self.axis_segment_fl.delete()
-            self.tracks_fl.delete()
-            self.node_buffer_fc.delete_if_exists()
-            self.node_fc.delete_if_exists()
-            #self.axis_mbr_fc.delete_if_exists()
+            pool.join()
+        return subsets
+
+    def delete_scratch_workspaces(self, subsets):
+        """Deletes the scratch FileGDBs of the supplied subsets."""
+        for path in sorted(set(os.path.dirname(subset.id) for subset in subsets)):
+            if path != self.fgdb.id:
+                FileGDB(path).delete_if_exists()
 
     def create_node_buffer_feature_class(self):
         log.info('Creating node buffers with %s meters tolerance', NODE_BUFFER_SIZE)
         return self.node_fc.buffer(self.fgdb.feature_class('nodes_buffer'),
                                    str(NODE_BUFFER_SIZE) + ' Meters')
 
-    def create_ec_subset_for_axis(self, axis):
-        matches = self.get_track_matches_for_axis(axis)
+    def create_node_index(self):
+        """
+        Loads the node buffers into a STR-tree keyed by (AXIS, NODE_RANK) and
+        the node coordinates of every axis into arrays ordered by NODE_RANK,
+        so trajectories can be matched without a geoprocessing round-trip.
+        """
+        log.info('Creating node buffer index')
+        entries = []
+        with self.node_buffer_fc.search(['AXIS', 'NODE_RANK', 'SHAPE@']) as rows:
+            for axis, rank, shape in rows:
+                entries.append((extent_of(shape), (axis, rank)))
+
+        nodes = {}
+        with self.node_fc.search(['AXIS', 'NODE_RANK', 'SHAPE@XY']) as rows:
+            for axis, rank, (x, y) in rows:
+                nodes.setdefault(axis, []).append((rank, x, y))
+
+        self.nodes = {}
+        for axis, values in nodes.iteritems():
+            ranks, x, y = zip(*sorted(values))
+            self.nodes[axis] = (list(ranks), np.array(x, dtype=np.float64), np.array(y, dtype=np.float64))
+
+        return STRtree(entries)
+
+    def create_ec_subset_for_axis(self, axis, matches=None):
+        if matches is None:
+            matches = self.get_track_matches_for_axis(axis)
 
         fc = self.measurements_fc
         # create the feature class
@@ -405,8 +791,11 @@ class TrackMatcher(object):
             nfc.add_field(fname, ftype)
 
         nfc.add_field('complete_axis_match', 'SHORT')
+        nfc.add_field('segment', 'LONG')
+        nfc.add_field('axis', 'TEXT')
+        nfc.add_field('time_class', 'LONG')
 
-        csv_path = os.path.join(self.out_dir, 'ec_subset_for_axis_{}.csv'.format(axis))
+        csv_path = self.get_csv_path(axis)
 
         if not matches:
             log.info('No track matches axis %s', axis)
@@ -419,62 +808,73 @@ class TrackMatcher(object):
 
             # the field names to insert/request
             fnames =  ['SHAPE@XY'] + [fname for fname, ftype in fields]
-            # the index of the track field
+            # the index of the track and time field
             track_idx = fnames.index('track')
-
-            insertNames = [name if name != 'objectid' else 'mongoid' for name in fnames] + ['complete_axis_match']
-
-            with nfc.insert(insertNames) as insert:
-                # iterate over every track
-                for match in matches:
-                    track = str(match.track)
-                    # iterate over every matching track interval
-                    for idx, time in enumerate(match.matches):
-
-                        where_clause = SQL.and_([SQL.eq_('track', track), time.as_sql_clause()])
-                        new_track_name = '_'.join([track, str(idx)])
-                        log.info('%s matches complete axis? %s', new_track_name, time.matches_complete_axis)
-                        with fc.search(fnames, where_clause = where_clause) as rows:
-                            for row in rows:
-                                insert.insertRow(
-                                    [column if idx != track_idx else new_track_name for idx, column in enumerate(row)] + [1 if time.matches_complete_axis else 0])
-
-        self.add_axis_segment_association(axis, nfc)
+            time_idx = fnames.index('time')
+
+            insertNames = [name if name != 'objectid' else 'mongoid' for name in fnames] + ['complete_axis_match', 'segment', 'axis', 'time_class']
+
+            # the matching track intervals by track, sorted by time
+            intervals = {}
+            for match in matches:
+                track = str(match.track)
+                for idx, time in enumerate(match.matches):
+                    new_track_name = '_'.join([track, str(idx)])
+                    log.info('%s matches complete axis? %s', new_track_name, time.matches_complete_axis)
+                    intervals.setdefault(track, []).append(
+                        (time.min_time, time.max_time, (new_track_name, 1 if time.matches_complete_axis else 0)))
+            for track_intervals in intervals.itervalues():
+                track_intervals.sort(key=lambda interval: interval[0])
+
+            locator = self.create_segment_locator(axis)
+
+            def insert_batch(insert, batch):
+                # associate the measurements with the nearest segment of the axis
+                lon = [row[0][0] if row[0] is not None and row[0][0] is not None else np.nan for row in batch]
+                lat = [row[0][1] if row[0] is not None and row[0][1] is not None else np.nan for row in batch]
+                time_classes = TIME_CLASSES.masks(np.array([row[time_idx] for row in batch]))
+                for row, segment, time_class in izip(batch, locator.nearest_values(lon, lat), time_classes.tolist()):
+                    insert.insertRow(row + [segment, axis, time_class])
+
+            # read the selected measurements in a single ordered scan and
+            # route every row to the intervals containing it
+            sql_clause = (None, 'ORDER BY track, time')
+            with self.measurements_fl.search(fnames, sql_clause=sql_clause) as rows, nfc.insert(insertNames) as insert:
+                routed = route_to_intervals(rows,
+                                            key=lambda row: str(row[track_idx]),
+                                            time=lambda row: row[time_idx],
+                                            intervals=intervals)
+                # write the rows of every new track consecutively, the
+                # sort is stable so they stay ordered by time
+                routed = (row for _, group in groupby(routed, key=lambda x: x[0][track_idx])
+                          for row in sorted(group, key=lambda x: x[1][0]))
+                batch = []
+                for row, (new_track_name, complete) in routed:
+                    row = list(row)
+                    row[track_idx] = new_track_name
+                    batch.append(row + [complete])
+                    if len(batch) == SEGMENT_ASSOCIATION_BATCH_SIZE:
+                        insert_batch(insert, batch)
+                        batch = []
+                if batch:
+                    insert_batch(insert, batch)
 
         gzip_file(csv_path)
 
         return nfc
 
-    def add_axis_segment_association(self, axis, fc):
-        extracted_axis = self.fgdb.feature_class('axis_%s' % axis)
-        try:
-            log.info('Exporting axis %s', axis)
-            # select the segments of this axis
-            axis_segment_fl = self.axis_model.segments.view()
-            axis_segment_fl.new_selection(SQL.eq_('Achsen_ID', SQL.quote_(axis)))
-
-
-            axis_segment_fl.copy_features(extracted_axis)
-
-
-            fc.near(extracted_axis)
-            fc.add_field('segment', 'LONG')
-            fc.add_field('axis', 'TEXT')
-
-            ec_subset_fl = fc.view()
-            extracted_axis_fl = extracted_axis.view()
-            try:
-                ec_subset_fl.add_join('NEAR_FID', extracted_axis_fl, extracted_axis_fl.oid_field_name)
-                ec_subset_fl.calculate_field('segment', '!axis_{}.segment_id!'.format(axis))
-                ec_subset_fl.calculate_field('axis', "'{}'".format(axis))
-            finally:
-                ec_subset_fl.delete()
-                extracted_axis_fl.delete()
-
-            fc.delete_field('NEAR_FID')
-            fc.delete_field('NEAR_DIST')
-        finally:
-            extracted_axis.delete_if_exists()
+    def create_segment_locator(self, axis):
+        """Creates a SegmentLocator for the segments of the axis."""
+        where_clause = SQL.eq_('Achsen_ID', SQL.quote_(axis))
+        polylines, segments = [], []
+        with self.axis_model.segments.search(['SHAPE@', 'segment_id'], where_clause=where_clause,
+                                             spatial_reference=SpatialReference(4326)) as rows:
+            for shape, segment in rows:
+                if shape is None:
+                    continue
+                polylines.append([[(p.X, p.Y) for p in part if p is not None] for part in shape])
+                segments.append(segment)
+        return SegmentLocator(polylines, segments)
 
     #def create_axis_mbr_feature_class(self):
     #    log.info('Creating MBR for axis')
@@ -483,13 +883,20 @@ class TrackMatcher(object):
     #    return fc
 
     def get_tracks_for_nodes_buffer(self, axis):
-        # select only the nodes of the current axis
-        self.node_buffer_fl.new_selection(SQL.eq_('AXIS', SQL.quote_(axis)))
+        # select only the nodes of the current axis (or axes)
+        if isinstance(axis, basestring):
+            self.node_buffer_fl.new_selection(SQL.eq_('AXIS', SQL.quote_(axis)))
+        else:
+            self.node_buffer_fl.new_selection(SQL.in_('AXIS', [SQL.quote_(x) for x in axis]))
         # select all measurements instersecting with the nodes
         self.tracks_fl.new_selection_by_location(self.node_buffer_fl)
-        # get the track ids of the intersecting measurements
-        with self.tracks_fl.search(['track'], sql_clause = ('DISTINCT', None)) as rows:
-            return sorted(set(row[0] for row in rows))
+        # get the track ids and times of the intersecting measurements
+        tracks = set()
+        with self.tracks_fl.search(['track', 'start_time', 'end_time']) as rows:
+            for track, start_time, end_time in rows:
+                tracks.add(track)
+                self.track_times[track] = (start_time, end_time)
+        return sorted(tracks)
 
     def create_node_feature_class(self):
         # create a the new feature class
@@ -519,56 +926,132 @@ class TrackMatcher(object):
                     ic.insertRow((row[0], NODE_TYPE_LSA, 2 * (row[2] - 1) + 2, row[1]))
         return fc
 
-    def get_track_matches(self, track, axis):
+    def get_track_matches(self, track, axis, trajectories=None, ranks=None):
         log.info('checking axis %s for track %s', axis, track)
         node_count = self.get_nodes_count(axis)
-        def get_node_matches(node): return self.get_node_matches(track, axis, node)
-        node_matches = [match for node in xrange(0, node_count) for match in get_node_matches(node)]
-        result = TrackMatchingResult(axis, track, node_matches, node_count, self.measurements_fc, self.axis_model)
+        if trajectories is None:
+            trajectories = self.get_trajectories(track)
+        nodes, min_time, max_time = self.get_node_matches(trajectories, axis, ranks)
+        valid = nodes < node_count
+        node_matches = (nodes[valid], min_time[valid], max_time[valid])
+        result = TrackMatchingResult(axis, track, node_matches, node_count, self.get_track_measurements(track), self.axis_model)
         log.info('result for axis %s for track %s: %s', axis, track, result)
         return result
 
-    def get_nodes_count(self, axis):
-        self.node_buffer_fl.new_selection(SQL.eq_('AXIS', SQL.quote_(axis)))
-        return self.node_buffer_fl.count()
-
-    def get_node_matches(self, track, axis, node):
-        self.node_buffer_fl.new_selection(SQL.and_((SQL.eq_('AXIS', SQL.quote_(axis)),
-                                                    SQL.eq_('NODE_RANK', node))))
-        assert self.node_buffer_fl.count() == 1
-        self.trajectories_fl.new_selection(SQL.eq_('track', track))
-        self.trajectories_fl.subset_selection_by_location(self.node_buffer_fl)
-        count = self.trajectories_fl.count()
-        #log.debug('Selected trajectories of track %s that intersect node %s of axis %s: %d', track, node, axis, count)
-        if count:
-            min_time = None
-            max_time = None
-            threshold = 20 * 1000
-
-            fields = ['start_time', 'end_time']
-            sql_clause = (None, 'ORDER BY start_time')
-
-            with self.trajectories_fl.search(fields, sql_clause=sql_clause) as rows:
-                for min, max in rows:
-                    # first match
-                    if min_time is None:
-                        min_time, max_time = min, max
-                    # if the delta is not not to big consider it a single match
-                    elif (min - max_time) < threshold:
-                        max_time = max
-                    else:
-                        yield (node, min_time, max_time)
-                        min_time = max_time = None
-
-            if min_time is not None:
-                yield (node, min_time, max_time)
+    def get_track_measurements(self, track):
+        """Returns the (lazily fetched) measurements of the track, reusing them across axes."""
+        if self.track_measurements is None or self.track_measurements.track != track:
+            self.track_measurements = TrackMeasurements(track, self.measurements_fc, self.store)
+        return self.track_measurements
 
+    def get_nodes_count(self, axis):
+        return len(self.nodes[axis][0]) if axis in self.nodes else 0
+
+    def get_trajectories(self, track):
+        """Returns the segments of the track's trajectories ordered by start_time."""
+        fields = ['SHAPE@', 'start_time', 'end_time']
+        sql_clause = (None, 'ORDER BY start_time')
+        with self.trajectories_fc.search(fields, where_clause=SQL.eq_('track', track), sql_clause=sql_clause) as rows:
+            segments = [(shape.firstPoint.X, shape.firstPoint.Y, shape.lastPoint.X, shape.lastPoint.Y, start_time, end_time)
+                        for shape, start_time, end_time in rows if shape is not None]
+        columns = zip(*segments) if segments else [()] * len(Trajectories._fields)
+        return Trajectories(*(np.array(column, dtype=np.float64) for column in columns))
+
+    def match_nodes(self, trajectories, axis, ranks=None):
+        """
+        Computes the distances of all trajectory segments of a track to all
+        nodes of the axis (or only the nodes with the supplied ranks) in a
+        local metric projection in one batched call. Returns the
+        (segments x nodes) hit mask and the start_time and end_time arrays of
+        the segments.
+        """
+        axis_ranks, x, y = self.nodes[axis]
+        if ranks is not None:
+            idx = [axis_ranks.index(rank) for rank in ranks]
+            x, y = x[idx], y[idx]
+        origin = (x.mean(), y.mean())
+        px, py = project_local(x, y, origin)
+        ax, ay = project_local(trajectories.ax, trajectories.ay, origin)
+        bx, by = project_local(trajectories.bx, trajectories.by, origin)
+        mask = segment_point_distances(ax, ay, bx, by, px, py) <= NODE_BUFFER_SIZE
+        return mask, trajectories.start_time, trajectories.end_time
+
+    def get_candidate_nodes(self, trajectories):
+        """
+        Returns the ranks of the nodes whose buffer intersects the envelope of
+        the trajectories, grouped by axis.
+        """
+        candidates = {}
+        if not len(trajectories.start_time):
+            return candidates
+        envelope = union([(trajectories.ax.min(), trajectories.ay.min(), trajectories.ax.max(), trajectories.ay.max()),
+                          (trajectories.bx.min(), trajectories.by.min(), trajectories.bx.max(), trajectories.by.max())])
+        for axis, rank in self.node_index.query(envelope):
+            candidates.setdefault(axis, []).append(rank)
+        for ranks in candidates.itervalues():
+            ranks.sort()
+        return candidates
+
+    def get_node_matches(self, trajectories, axis, ranks=None):
+        """
+        Tests the trajectories of a track against the nodes of the axis and
+        clusters the matching trajectories of every node into visits. Returns
+        the node rank, min_time and max_time arrays of the visits.
+        """
+        # only test the nodes whose buffer intersects the track's envelope
+        if ranks is None:
+            ranks = self.get_candidate_nodes(trajectories).get(axis)
+        if not ranks:
+            return np.array([], dtype=np.int64), np.array([]), np.array([])
+
+        mask, start_time, end_time = self.match_nodes(trajectories, axis, ranks)
+        # the hits ordered by node and start_time
+        node_idx, segment_idx = np.nonzero(mask.T)
+        return cluster_intervals(np.asarray(ranks)[node_idx],
+                                 start_time[segment_idx],
+                                 end_time[segment_idx],
+                                 NODE_VISIT_GAP)
 
     def get_track_matches_for_axis(self, axis):
-        tracks = self.get_tracks_for_nodes_buffer(axis)
+        watermark = self.get_watermark_tracks(axis)
+        tracks = [track for track in self.get_tracks_for_nodes_buffer(axis) if track not in watermark]
         log.info('%s tracks found for nodes of axis %s: %s', len(tracks), axis, tracks)
+        self.record_processed_tracks(axis, tracks)
         return [x for x in [self.get_track_matches(track, axis) for track in tracks] if len(x) > 0]
 
+    def get_track_matches_for_axes(self, axes, partition=None):
+        """
+        Matches the tracks against all axes at once. The trajectories of every
+        track are read only once and tested against every axis whose nodes
+        the track touches. Returns the matching results grouped by axis. A
+        (partition, partitions) tuple restricts the tracks to a hash
+        partition of them.
+        """
+        matches = dict((axis, []) for axis in axes)
+        watermarks = dict((axis, self.get_watermark_tracks(axis)) for axis in axes)
+        tracks = self.get_tracks_for_nodes_buffer(axes)
+        if partition is not None:
+            tracks = [track for track in tracks if hash_partition(track, partition[1]) == partition[0]]
+        log.info('%s tracks found for nodes of %s axes', len(tracks), len(matches))
+        for axis in axes:
+            self.record_processed_tracks(axis, [track for track in tracks if track not in watermarks[axis]])
+        for track in tracks:
+            if all(track in watermark for watermark in watermarks.itervalues()):
+                continue
+            trajectories = self.get_trajectories(track)
+            for axis, ranks in sorted(self.get_candidate_nodes(trajectories).iteritems()):
+                if axis not in matches or track in watermarks[axis]:
+                    continue
+                result = self.get_track_matches(track, axis, trajectories, ranks)
+                if len(result) > 0:
+                    matches[axis].append(result)
+        return matches
+
+    def get_csv_path(self, axis):
+        if self.csv_suffix:
+            return os.path.join(self.csv_dir, 'ec_subset_for_axis_{}_{}.csv'.format(axis, self.csv_suffix))
+        return os.path.join(self.csv_dir, 'ec_subset_for_axis_{}.csv'.format(axis))
+
     def create_csv_export_fields(self):
         def to_cest(x): return datetime.utcfromtimestamp(x/1000) + timedelta(hours = 2)
         def format_time(x): return to_cest(x).strftime('%H:%M:%S')
@@ -614,8 +1097,62 @@ class TrackMatcher(object):
                 for row in rows:
                     writer.writerow(convert_row(row))
 
+_matcher = None
+
+def _init_matcher_worker(kwargs, settings):
+    """Creates the TrackMatcher of a worker process with its own scratch FileGDB."""
+    global _matcher
+    for name, value in settings.iteritems():
+        setattr(env, name, value)
+    _matcher = TrackMatcher(out_name='worker_{}.gdb'.format(os.getpid()), **kwargs)
+    # the FileGDB may contain completed subsets of a previous run
+    _matcher.fgdb.create_if_not_exists()
+    _matcher.open()
+    # pool workers do not run atexit handlers, but the finalizers of
+    # multiprocessing when they exit after the pool is closed
+    multiprocessing.util.Finalize(_matcher, _matcher.close, exitpriority=10)
+
+def _get_track_matches_for_axes(task):
+    """
+    Matches a partition of the tracks against the axes in a worker process
+    and returns the matches and the processed tracks by axis.
+    """
+    axes, partition = task
+    _matcher.processed = {}
+    matches = _matcher.get_track_matches_for_axes(axes, partition)
+    return matches, _matcher.processed
+
+def _create_ec_subset_for_axis(task):
+    """
+    Creates the subset of a single axis in a worker process and returns the
+    path of the subset and the processed tracks. The axis is matched unless
+    its matches and processed tracks are supplied.
+    """
+    axis, matches, processed = task
+    if processed is not None:
+        _matcher.processed[axis] = processed
+    subset = _matcher.create_ec_subset_for_axis(axis, matches)
+    return axis, subset.id, _matcher.processed[axis]
+
+def merge_processed_tracks(processed):
+    """Merges the processed tracks of an axis recorded for partitions of the tracks."""
+    tracks = set()
+    min_times, max_times = [], []
+    for entry in processed:
+        tracks.update(entry['tracks'])
+        if entry['min_time'] is not None:
+            min_times.append(entry['min_time'])
+        if entry['max_time'] is not None:
+            max_times.append(entry['max_time'])
+    return {
+        'tracks': sorted(tracks),
+        'min_time': min(min_times) if min_times else None,
+        'max_time': max(max_times) if max_times else None
+    }
+
 class Stop(object):
     SAMPLING_RATE = 1 * 1000
+    FIELDS = ['axis', 'segment', 'track', 'time', 'speed', 'complete_axis_match']
 
     def __init__(self, axis, segment, track, start, stop, complete):
         self.track = track
@@ -635,10 +1172,22 @@ class Stop(object):
         return self.stop - self.start
 
     @staticmethod
-    def find(fc, stop_start_threshold=5, stop_end_threshold=10):
-
-        fields = ['axis', 'segment', 'track', 'time', 'speed', 'complete_axis_match']
-        sql_clause = (None, 'ORDER BY axis, track, time')
+    def find(fc, stop_start_threshold=5, stop_end_threshold=10, vectorized=True):
+        """
+        Finds the stops in the measurements of fc. The vectorized engine is
+        used unless disabled or the thresholds are not supported by it.
+        """
+        if vectorized and stop_start_threshold <= stop_end_threshold:
+            for columns in Stop.find_columns(fc, stop_start_threshold, stop_end_threshold):
+                for row in izip(columns.axis, columns.segment, columns.track,
+                                columns.start.tolist(), columns.stop.tolist(), columns.complete):
+                    stop = Stop(*row)
+                    # the columns are already extended by the sampling rate
+                    stop.start, stop.stop = row[3], row[4]
+                    yield stop
+            return
+
+        fields = Stop.FIELDS
 
         ctrack = None
         csegment = None
@@ -656,95 +1205,144 @@ class Stop(object):
                         stop=stop_end,
                         complete=complete)
 
-        with fc.search(fields, sql_clause = sql_clause) as rows:
-            for axis, segment, track, time, speed, complete_axis_match in rows:
+        for axis, segment, track, time, speed, complete_axis_match in search_clustered(fc, fields):
 
-                change = caxis != axis or ctrack != track or csegment != segment
-                if is_stop and change:
-                    yield create_stop()
-                    is_stop = False
+            change = caxis != axis or ctrack != track or csegment != segment
+            if is_stop and change:
+                yield create_stop()
+                is_stop = False
 
-                complete = complete_axis_match
+            complete = complete_axis_match
 
-                caxis = axis
-                ctrack = track
-                csegment = segment
-                if is_stop:
-                    if speed <= stop_end_threshold:
-                        stop_end = time
-                    else:
-                        yield create_stop()
-                        is_stop = False
-                elif speed < stop_start_threshold:
-                    is_stop = True
-                    stop_start = stop_end = time
+            caxis = axis
+            ctrack = track
+            csegment = segment
             if is_stop:
-                yield create_stop()
+                if speed <= stop_end_threshold:
+                    stop_end = time
+                else:
+                    yield create_stop()
+                    is_stop = False
+            elif speed < stop_start_threshold:
+                is_stop = True
+                stop_start = stop_end = time
+        if is_stop:
+            yield create_stop()
 
-def create_stop_table(in_fc, out_table):
-    field_names = ['axis', 'segment', 'track', 'start_time', 'end_time', 'duration', 'complete']
-    field_types = ['TEXT', 'LONG',    'TEXT',  'DOUBLE',     'DOUBLE',   'LONG'    , 'SHORT'   ]
+    @staticmethod
+    def find_columns(fc, stop_start_threshold=5, stop_end_threshold=10, chunk_size=STOP_CHUNK_SIZE):
+        """
+        Finds the stops in the measurements of fc like find(), but reads the
+        measurements in chunks of arrays and yields the stops of every chunk
+        as StopColumns.
+        """
+        rows = search_clustered(fc, Stop.FIELDS)
+        pending = None
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            columns = _to_stop_columns(izip(*chunk))
+            if pending is not None:
+                columns = [np.concatenate((a, b)) for a, b in izip(pending, columns)]
+            stops, _, pending = _find_stops_in(columns, False, stop_start_threshold, stop_end_threshold)
+            if len(stops.start):
+                yield stops
+        if pending is not None and len(pending[0]):
+            stops, _, _ = _find_stops_in(pending, True, stop_start_threshold, stop_end_threshold)
+            if len(stops.start):
+                yield stops
+
+def _to_stop_columns(columns):
+    """converts the columns of Stop.FIELDS to the arrays used to find stops"""
+    axis, segment, track, time, speed, complete = (np.array(column, dtype=object) for column in columns)
+    # a missing speed compares less than any threshold
+    speed = np.array([-np.inf if x is None else x for x in speed], dtype=np.float64)
+    return [axis, segment, track, time, speed, complete]
+
+def _find_stops_in(columns, final, stop_start_threshold, stop_end_threshold):
+    """
+    finds the stops in the columns, returns them as StopColumns together
+    with the rows they start at and the columns of the remaining rows
+    """
+    half_sampling_rate = Stop.SAMPLING_RATE/2
+    axis, segment, track, time, speed, complete = columns
+    first, last, complete_idx, done = find_stop_runs(
+        (axis, track, segment), speed, stop_start_threshold, stop_end_threshold, final)
+    start = np.array((time[first] - half_sampling_rate).tolist())
+    stop = np.array((time[last] + half_sampling_rate).tolist())
+    stops = StopColumns(axis=axis[first].tolist(),
+                        segment=segment[first].tolist(),
+                        track=track[first].tolist(),
+                        start=start,
+                        stop=stop,
+                        duration=stop - start,
+                        complete=complete[complete_idx].tolist())
+    return stops, first, [column[done:] for column in columns]
+
+def _to_stop_rows(stops):
+    """converts StopColumns to rows of the stop table"""
+    time_classes = TIME_CLASSES.masks(stops.start, stops.stop)
+    flags = BitmapIndex(time_classes, TIME_CLASSES).flags(TIME_CLASSES.names)
+    return izip(stops.axis, stops.segment, stops.track, stops.start.tolist(), stops.stop.tolist(),
+                stops.duration.tolist(), stops.complete, time_classes.tolist(),
+                *[column.tolist() for column in flags])
+
+def _find_stops_in_partition(columns, index, stop_start_threshold, stop_end_threshold):
+    """finds the stop table rows of a partition of the measurements for a PartitionedExecutor"""
+    stops, first, _ = _find_stops_in(_to_stop_columns(columns), True, stop_start_threshold, stop_end_threshold)
+    if not len(first):
+        return []
+    return izip(index[first].tolist(), _to_stop_rows(stops))
+
+def append_rows(table, fields, dtypes, rows, batch_size):
+    """
+    Appends the rows to the table in batches of structured arrays. Arrays
+    can not hold nulls, so rows with a null value are inserted one by one.
+    """
+    dtype = [(str(name), field_dtype) for name, field_dtype in zip(fields, dtypes)]
+    with_nulls = []
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        values = [tuple(row) for row in batch if None not in row]
+        with_nulls.extend(row for row in batch if None in row)
+        if values:
+            table.append_array(np.array(values, dtype=dtype))
+    if with_nulls:
+        with table.insert(fields) as insert:
+            for row in with_nulls:
+                insert.insertRow(row)
+
+def create_stop_table(in_fc, out_table, workers=1):
+    field_names  = ['axis',  'segment', 'track', 'start_time', 'end_time', 'duration', 'complete']
+    field_types  = ['TEXT',  'LONG',    'TEXT',  'DOUBLE',     'DOUBLE',   'LONG'    , 'SHORT'   ]
+    field_dtypes = ['<U255', '<i4',     '<U255', '<f8',        '<f8',      '<i4'     , '<i2'     ]
 
     out_table.delete_if_exists()
     out_table.create()
 
-
     for field_name, field_type in zip(field_names, field_types):
         out_table.add_field(field_name, field_type)
-
-    with out_table.insert(field_names) as insert:
-        for stop in Stop.find(in_fc, stop_start_threshold=5, stop_end_threshold=10):
-            insert.insertRow((stop.axis, stop.segment, stop.track, stop.start, stop.stop, stop.duration, stop.complete))
-
-
-    code_block = textwrap.dedent("""\
-    from datetime import datetime
-
-    def parse(s):
-        return datetime.utcfromtimestamp(s/1000)
-
-    def workday_is_in_range(start, end, min_hour, max_hour):
-        start = parse(start)
-        end = parse(end)
-        if min_hour <= max_hour:
-            start = (start.weekday() < 5 and min_hour <= start.hour < max_hour)
-            end = (end.weekday() < 5 and min_hour <= end.hour < max_hour)
-        else:
-            start = (start.weekday() < 5 and (min_hour <= start.hour or start.hour < max_hour))
-            end = (end.weekday() < 5 and (min_hour <= end.hour or end.hour < max_hour))
-        return start or end
-
-    def weekend_is_in_range(start, end, min_hour, max_hour):
-        start = parse(start)
-        end = parse(end)
-        if min_hour <= max_hour:
-            start = (start.weekday() >= 5 and min_hour <= start.hour < max_hour)
-            end = (end.weekday() >= 5 and min_hour <= end.hour < max_hour)
-        else:
-            start = (start.weekday() >= 5 and (min_hour <= start.hour or start.hour < max_hour))
-            end = (end.weekday() >= 5 and (min_hour <= end.hour or end.hour < max_hour))
-        return start or end
-    """)
-    out_table.add_field('weekend_morning', 'SHORT')
-    out_table.add_field('weekend_noon', 'SHORT')
-    out_table.add_field('weekend_evening', 'SHORT')
-    out_table.add_field('weekend_night', 'SHORT')
-
-    out_table.add_field('workday_morning', 'SHORT')
-    out_table.add_field('workday_noon', 'SHORT')
-    out_table.add_field('workday_evening', 'SHORT')
-    out_table.add_field('workday_night', 'SHORT')
-
-    # times are in UTC, we want them to be in +2
-    out_table.calculate_field('workday_morning', 'workday_is_in_range(!start_time!, !end_time!,  4, 8)', code_block=code_block)
-    out_table.calculate_field('workday_noon',    'workday_is_in_range(!start_time!, !end_time!, 10, 12)', code_block=code_block)
-    out_table.calculate_field('workday_evening', 'workday_is_in_range(!start_time!, !end_time!, 13, 17)', code_block=code_block)
-    out_table.calculate_field('workday_night',   'workday_is_in_range(!start_time!, !end_time!, 19, 4)', code_block=code_block)
-
-    out_table.calculate_field('weekend_morning', 'weekend_is_in_range(!start_time!, !end_time!,  4, 8)', code_block=code_block)
-    out_table.calculate_field('weekend_noon',    'weekend_is_in_range(!start_time!, !end_time!, 10, 12)', code_block=code_block)
-    out_table.calculate_field('weekend_evening', 'weekend_is_in_range(!start_time!, !end_time!, 13, 17)', code_block=code_block)
-    out_table.calculate_field('weekend_night',   'weekend_is_in_range(!start_time!, !end_time!, 19, 4)', code_block=code_block)
+    # the flags of the time classes are kept for the users of the table
+    out_table.add_field('time_class', 'LONG')
+    for name in TIME_CLASSES.names:
+        out_table.add_field(name, 'SHORT')
+
+    stop_start_threshold, stop_end_threshold = 5, 10
+    if workers > 1:
+        # find the stops of partitions of the tracks in parallel
+        executor = PartitionedExecutor(workers)
+        rows = executor.map(_find_stops_in_partition, search_clustered(in_fc, Stop.FIELDS), Stop.FIELDS,
+                            (stop_start_threshold, stop_end_threshold))
+    else:
+        # the stops and their time classes are computed per chunk of measurements
+        rows = (row for stops in Stop.find_columns(in_fc, stop_start_threshold, stop_end_threshold)
+                for row in _to_stop_rows(stops))
+    append_rows(out_table, field_names + ['time_class'] + TIME_CLASSES.names,
+                field_dtypes + ['<i4'] + ['<i2'] * len(TIME_CLASSES.names),
+                rows, STOP_BATCH_SIZE)
 
 def axis(range):
     for axis in range:
@@ -769,88 +1367,114 @@ def merge_feature_classes(feature_classes, target, delete=True):
         if delete:
             subset.delete()
 
-def create_tracks(in_fc, out_fc):
-    def workday_is_in_range(start, end, min_hour, max_hour):
-        if min_hour <= max_hour:
-            return ((start.weekday() < 5 and min_hour <= start.hour < max_hour) or
-                               (end.weekday() < 5 and min_hour <= end.hour < max_hour))
-        else:
-            return ((start.weekday() < 5 and (min_hour <= start.hour or start.hour < max_hour)) or
-                               (end.weekday() < 5 and (min_hour <= end.hour or end.hour < max_hour)))
-
-    def weekend_is_in_range(start, end, min_hour, max_hour):
-        if min_hour <= max_hour:
-            return ((start.weekday() >= 5 and min_hour <= start.hour < max_hour) or
-                              (end.weekday() >= 5 and min_hour <= end.hour < max_hour))
-        else:
-            return ((start.weekday() >= 5 and (min_hour <= start.hour or start.hour < max_hour)) or
-                               (end.weekday() >= 5 and (min_hour <= end.hour or end.hour < max_hour)))
-
-    def _as_polyline(coordinates):
-        points = (Point(*c) for c in coordinates)
-        polyline = Polyline(Array(points))
-        log.debug('Created polyline from %d points', len(coordinates))
-        return polyline
-
-    def to_millis(dt):
-        return (dt-datetime(1970, 1, 1)).total_seconds() * 1000
-
-    def _create_polylines(rows):
-        caxis = None
-        ctrack = None
-        coordinates = None
-        start_time = None
-        stop_time = None
-        complete = None
-
-        def create_row():
-            duration = long((stop_time - start_time).total_seconds() * 1000)
-
-            weekend_morning = weekend_is_in_range(start_time, stop_time,  4, 8)
-            weekend_noon = weekend_is_in_range(start_time, stop_time, 10, 12)
-            weekend_evening = weekend_is_in_range(start_time, stop_time, 13, 17)
-            weekend_night = weekend_is_in_range(start_time, stop_time, 19, 4)
-
-            workday_morning = workday_is_in_range(start_time, stop_time,  4, 8)
-            workday_noon = workday_is_in_range(start_time, stop_time, 10, 12)
-            workday_evening = workday_is_in_range(start_time, stop_time, 13, 17)
-            workday_night = workday_is_in_range(start_time, stop_time, 19, 4)
-
-            return (_as_polyline(coordinates), caxis, ctrack, to_millis(start_time), to_millis(stop_time),
-                duration, complete,
-                weekend_morning, weekend_noon, weekend_evening, weekend_night,
-                workday_morning, workday_noon, workday_evening, workday_night)
-
-        for coords, axis, track, time, complete_axis_match in rows:
-
-
-            if caxis is None:
-                caxis = axis
-            elif caxis != axis:
-                if coordinates is not None:
-                    yield create_row()
-                    coordinates = None
-                caxis = axis
-
-            if ctrack is None:
-                ctrack = track
-            elif ctrack != track:
-                if coordinates is not None:
-                    yield create_row()
-                    coordinates = None
-                ctrack = track
-
-            if coordinates is None:
-                coordinates = [coords]
-                complete = complete_axis_match
-                start_time = stop_time = datetime.utcfromtimestamp(time/1000)
-            else:
-                coordinates.append(coords)
-                stop_time = datetime.utcfromtimestamp(time/1000)
-
-        if coordinates is not None:
-            yield create_row()
-
+def get_metadata(fc, key):
+    """Returns the metadata value of the key recorded for the feature class or None."""
+    if not isinstance(fc, ArcPyEntity):
+        return None
+    table = Table(os.path.join(os.path.dirname(fc.id), METADATA_TABLE))
+    if not table.exists():
+        return None
+    name = os.path.basename(fc.id)
+    where_clause = SQL.and_((SQL.eq_('name', SQL.quote_(name)), SQL.eq_('key', SQL.quote_(key))))
+    with table.search(['value'], where_clause=where_clause) as rows:
+        for value, in rows:
+            return json.loads(value)
+    return None
+
+def set_metadata(fc, key, value):
+    """Records the metadata value of the key for the feature class, None removes it."""
+    table = Table(os.path.join(os.path.dirname(fc.id), METADATA_TABLE))
+    if not table.exists():
+        table.create()
+        table.add_field('name', 'TEXT')
+        table.add_field('key', 'TEXT')
+        table.add_field('value', 'TEXT')
+    name = os.path.basename(fc.id)
+    where_clause = SQL.and_((SQL.eq_('name', SQL.quote_(name)), SQL.eq_('key', SQL.quote_(key))))
+    with table.update(['value'], where_clause=where_clause) as rows:
+        for row in rows:
+            rows.deleteRow()
+    if value is not None:
+        with table.insert(['name', 'key', 'value']) as insert:
+            insert.insertRow((name, key, json.dumps(value)))
+
+def set_clustered(fc, clustered=True):
+    """
+    Records if the rows of every (axis, track) of the measurements are
+    stored consecutively and ordered by time. The row count is recorded
+    as well, so rows added or removed later invalidate the order.
+    """
+    order = {'fields': CLUSTERED_ORDER, 'count': fc.count()} if clustered else None
+    set_metadata(fc, 'order', order)
+
+def is_clustered(fc):
+    """Checks if the measurements are stored in CLUSTERED_ORDER."""
+    order = get_metadata(fc, 'order')
+    return order is not None and order['fields'] == CLUSTERED_ORDER and order['count'] == fc.count()
+
+def search_clustered(fc, fields, where_clause=None, chunk_size=SORT_CHUNK_SIZE):
+    """
+    Yields the rows of the measurements with the rows of every (axis, track)
+    consecutively and ordered by time. Clustered measurements are read
+    sequentially, all others are sorted by a bounded memory external merge
+    sort. fields has to contain the fields of CLUSTERED_ORDER.
+    """
+    if is_clustered(fc):
+        with fc.search(fields, where_clause=where_clause) as rows:
+            for row in rows:
+                yield row
+        return
+    log.debug('%s is not clustered, sorting it', fc.id)
+    indices = [fields.index(name) for name in CLUSTERED_ORDER]
+    with fc.search(fields, where_clause=where_clause) as rows:
+        for row in sort_rows(rows, lambda row: tuple(row[i] for i in indices), chunk_size):
+            yield row
+
+def _to_track_columns(columns):
+    """converts the columns read by create_tracks to arrays"""
+    xy, axis, track, time, complete = columns
+    xy = np.array(xy, dtype=np.float64).reshape(-1, 2)
+    return [xy[:, 0], xy[:, 1], np.array(axis, dtype=object), np.array(track, dtype=object),
+            np.array(time, dtype=np.float64), np.array(complete, dtype=object)]
+
+def _create_track_rows(columns, final):
+    """
+    creates the track rows of the (axis, track) runs in the columns, returns
+    them together with the rows they start at and the columns of the
+    remaining rows
+    """
+    x, y, axis, track, time, complete = columns
+    first = np.flatnonzero(run_starts(axis, track))
+    end = np.append(first[1:], len(axis)).astype(np.int64)
+    # the last run may continue in the next chunk
+    if not final:
+        first, end = first[:-1], end[:-1]
+    done = end[-1] if len(end) else 0
+    start_time = time[first]
+    stop_time = time[end - 1]
+    time_classes = TIME_CLASSES.masks(start_time, stop_time)
+    flags = BitmapIndex(time_classes, TIME_CLASSES).flags(TIME_CLASSES.names)
+    rows = izip((linestring_wkb(x[a:b], y[a:b]) for a, b in izip(first, end)),
+                axis[first].tolist(), track[first].tolist(),
+                start_time.tolist(), stop_time.tolist(),
+                (stop_time - start_time).astype(np.int64).tolist(),
+                complete[first].tolist(),
+                time_classes.tolist(),
+                *[column.tolist() for column in flags])
+    return rows, first, [column[done:] for column in columns]
+
+def _create_tracks_in_partition(columns, index):
+    """creates the track rows of a partition of the measurements for a PartitionedExecutor"""
+    rows, first, _ = _create_track_rows(_to_track_columns(columns), True)
+    return izip(index[first].tolist(), rows)
+
+def create_tracks(in_fc, out_fc, chunk_size=TRACK_CHUNK_SIZE, workers=1):
+    """
+    Creates a polyline per (axis, track) from the measurements. The sorted
+    measurements are read in chunks of arrays, split at the run boundaries
+    of (axis, track) and every run is encoded directly as WKB. With more
+    than one worker partitions of the tracks are created in parallel.
+    """
     out_fc.delete_if_exists()
     out_fc.create(geometry_type='POLYLINE', spatial_reference = SpatialReference(4326))
 
@@ -861,79 +1485,78 @@ def create_tracks(in_fc, out_fc):
     out_fc.add_field('duration', 'LONG')
     out_fc.add_field('complete', 'SHORT')
 
-    out_fc.add_field('weekend_morning', 'SHORT')
-    out_fc.add_field('weekend_noon', 'SHORT')
-    out_fc.add_field('weekend_evening', 'SHORT')
-    out_fc.add_field('weekend_night', 'SHORT')
-
-    out_fc.add_field('workday_morning', 'SHORT')
-    out_fc.add_field('workday_noon', 'SHORT')
-    out_fc.add_field('workday_evening', 'SHORT')
-    out_fc.add_field('workday_night', 'SHORT')
+    # the flags of the time classes are kept for the users of the tracks
+    out_fc.add_field('time_class', 'LONG')
+    for name in TIME_CLASSES.names:
+        out_fc.add_field(name, 'SHORT')
 
     output_fields = [
-        'SHAPE@', 'axis', 'track', 'start_time', 'stop_time', 'duration', 'complete',
-        'weekend_morning', 'weekend_noon', 'weekend_evening', 'weekend_night',
-        'workday_morning', 'workday_noon', 'workday_evening', 'workday_night'
-    ]
+        'SHAPE@WKB', 'axis', 'track', 'start_time', 'stop_time', 'duration', 'complete', 'time_class'
+    ] + TIME_CLASSES.names
     input_fields = ['SHAPE@XY', 'axis', 'track', 'time', 'complete_axis_match']
     where_clause = 'mongoid IS NOT NULL'
-    sql_clause = (None, 'ORDER BY axis, track, time')
 
     with out_fc.insert(output_fields) as insert:
-        with in_fc.search(input_fields, sql_clause=sql_clause, where_clause=where_clause) as rows:
-            for polyline in _create_polylines(rows):
-                insert.insertRow(polyline)
-
-def calculate_statistics(model, fgdb):
-    tracks_view = fgdb.feature_class('tracks').view()
-    stops_view = fgdb.table('stops').view()
-    measurement_view = fgdb.feature_class('measurements').view()
-
-    def create_mean_speed(postfix):
-        tmpfc = fgdb.feature_class('harmonic_mean_speed_' + postfix + '_tmp')
-        measurement_view.to_feature_class(tmpfc)
-        tmpfc.add_field('inverse_speed', 'DOUBLE')
-        tmpfc.calculate_field('inverse_speed', '1/!speed!')
-        try:
-            # calculate the inverse speed
-            out_table = fgdb.table('speed_by_axis_segment_' + postfix)
-            tmpfc.statistics(
-                out_table=out_table,
-                statistics_fields=[('inverse_speed', 'COUNT'), ('inverse_speed', 'SUM'), ('speed', 'MEAN')],
-                case_field=['axis', 'segment'])
-
-            out_table.rename_field('COUNT_inverse_speed', 'num_observations')
-            out_table.delete_field('FREQUENCY')
-            out_table.rename_field('MEAN_speed', 'arithmetic_mean_speed')
-            out_table.add_field('harmonic_mean_speed', 'DOUBLE')
-            out_table.calculate_field('harmonic_mean_speed', '!num_observations!/!SUM_inverse_speed!')
-            out_table.delete_field('SUM_inverse_speed')
-
-            tmpfc_view = tmpfc.view()
-            try:
-                tmpfc_view.new_selection(SQL.eq_('complete_axis_match', 1))
-                out_table = fgdb.table('speed_by_axis_' + postfix)
-                tmpfc_view.statistics(
-                    out_table=out_table,
-                    statistics_fields=[('inverse_speed', 'COUNT'), ('inverse_speed', 'SUM'), ('speed', 'MEAN')],
-                    case_field=['axis'])
-            finally:
-                tmpfc_view.delete_if_exists()
-
-            out_table.rename_field('COUNT_inverse_speed', 'num_observations')
-            out_table.delete_field('FREQUENCY')
-            out_table.rename_field('MEAN_speed', 'arithmetic_mean_speed')
-            out_table.add_field('harmonic_mean_speed', 'DOUBLE')
-            out_table.calculate_field('harmonic_mean_speed', '!num_observations!/!SUM_inverse_speed!')
-            out_table.delete_field('SUM_inverse_speed')
-        finally:
-            tmpfc.delete_if_exists()
-
+        rows = search_clustered(in_fc, input_fields, where_clause=where_clause)
+        if workers > 1:
+            executor = PartitionedExecutor(workers, chunk_size=chunk_size)
+            for track in executor.map(_create_tracks_in_partition, rows, input_fields):
+                insert.insertRow(track)
+            return
+
+        pending = None
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            columns = _to_track_columns(izip(*chunk))
+            if pending is not None:
+                columns = [np.concatenate((a, b)) for a, b in izip(pending, columns)]
+            tracks, _, pending = _create_track_rows(columns, False)
+            for track in tracks:
+                insert.insertRow(track)
+        if pending is not None and len(pending[0]):
+            tracks, _, _ = _create_track_rows(pending, True)
+            for track in tracks:
+                insert.insertRow(track)
+
+def _select(entity, where_clause=None):
+    """Creates a view of the entity with the rows matching where_clause selected."""
+    view = entity.view()
+    if where_clause is not None:
+        view.new_selection(where_clause)
+    return view
+
+def create_mean_speed_tables(fgdb, where_clause=None, postfix='all', out=None):
+    """
+    Creates the speed tables of the selected measurements with a speed in
+    out (by default fgdb).
+    """
+    if out is None:
+        out = fgdb
+    # eliminate null and 0 values
+    speed_clause = SQL.and_((SQL.neq_('speed', 0), SQL.is_not_null_('speed')))
+    if where_clause is not None:
+        speed_clause = SQL.and_((where_clause, speed_clause))
+    measurement_view = _select(fgdb.feature_class('measurements'), speed_clause)
+    try:
+        # stream over the selected measurements instead of copying them
+        speeds = MeanSpeedAggregator()
+        speeds.scan(measurement_view)
+        speeds.write(out, postfix,
+                     axis_type=get_field_type(measurement_view, 'axis'),
+                     segment_type=get_field_type(measurement_view, 'segment'))
+    finally:
+        measurement_view.delete()
 
-    def create_co2_consumption(postfix):
+def create_co2_consumption_tables(fgdb, where_clause=None, postfix='all', out=None):
+    """Creates the consumption and co2 tables of the selected measurements in out (by default fgdb)."""
+    if out is None:
+        out = fgdb
+    measurement_view = _select(fgdb.feature_class('measurements'), where_clause)
+    try:
         # consumption_by_axis_
-        out_table = fgdb.table('consumption_by_axis_' + postfix)
+        out_table = out.table('consumption_by_axis_' + postfix)
         measurement_view.statistics(
             out_table=out_table,
             statistics_fields=[('consumption', 'COUNT'), ('consumption', 'MEAN')],
@@ -942,7 +1565,7 @@ def calculate_statistics(model, fgdb):
         out_table.delete_field('FREQUENCY')
         out_table.rename_field('MEAN_consumption', 'consumption')
         # co2_by_axis_
-        out_table = fgdb.table('co2_by_axis_' + postfix)
+        out_table = out.table('co2_by_axis_' + postfix)
         measurement_view.statistics(
             out_table=out_table,
             statistics_fields=[('co2', 'COUNT'),('co2','MEAN')],
@@ -951,7 +1574,7 @@ def calculate_statistics(model, fgdb):
         out_table.delete_field('FREQUENCY')
         out_table.rename_field('MEAN_co2', 'co2')
         # consumption_by_axis_segment_
-        out_table = fgdb.table('consumption_by_axis_segment_' + postfix)
+        out_table = out.table('consumption_by_axis_segment_' + postfix)
         measurement_view.statistics(
             out_table=out_table,
             statistics_fields=[ ('consumption', 'COUNT'),('consumption','MEAN')],
@@ -961,7 +1584,7 @@ def calculate_statistics(model, fgdb):
         out_table.rename_field('MEAN_consumption', 'consumption')
         out_table.add_join_field(['axis', 'segment'])
         # co2_by_axis_segment_
-        out_table = fgdb.table('co2_by_axis_segment_' + postfix)
+        out_table = out.table('co2_by_axis_segment_' + postfix)
         measurement_view.statistics(
             out_table=out_table,
             statistics_fields=[('co2', 'COUNT'),('co2','MEAN')],
@@ -970,12 +1593,19 @@ def calculate_statistics(model, fgdb):
         out_table.delete_field('FREQUENCY')
         out_table.rename_field('MEAN_co2', 'co2')
         out_table.add_join_field(['axis', 'segment'])
+    finally:
+        measurement_view.delete()
 
-    def create_stops(postfix):
+def create_stops_tables(fgdb, where_clause=None, postfix='all', out=None):
+    """Creates the stops tables of the selected stops in out (by default fgdb)."""
+    if out is None:
+        out = fgdb
+    stops_view = _select(fgdb.table('stops'), where_clause)
+    try:
         # stops_by_axis_
-        out_table = fgdb.table('stops_by_axis_' + postfix)
-        tmp_table1 = fgdb.table('stops_by_axis_' + postfix + '_tmp1')
-        tmp_table2 = fgdb.table('stops_by_axis_' + postfix + '_tmp2')
+        out_table = out.table('stops_by_axis_' + postfix)
+        tmp_table1 = out.table('stops_by_axis_' + postfix + '_tmp1')
+        tmp_table2 = out.table('stops_by_axis_' + postfix + '_tmp2')
         tmp_table1_view = None
         tmp_table2_view = None
         out_table_view = None
@@ -1028,9 +1658,9 @@ def calculate_statistics(model, fgdb):
             if out_table_view is not None: out_table_view.delete_if_exists()
 
         # stops_by_axis_segment_
-        out_table = fgdb.table('stops_by_axis_segment_' + postfix)
-        tmp_table1 = fgdb.table('stops_by_axis_segment_' + postfix + '_tmp1')
-        tmp_table2 = fgdb.table('stops_by_axis_segment_' + postfix + '_tmp2')
+        out_table = out.table('stops_by_axis_segment_' + postfix)
+        tmp_table1 = out.table('stops_by_axis_segment_' + postfix + '_tmp1')
+        tmp_table2 = out.table('stops_by_axis_segment_' + postfix + '_tmp2')
         try:
 
             # the number of stops per track per axis per segment
@@ -1081,169 +1711,143 @@ def calculate_statistics(model, fgdb):
             if tmp_table1_view is not None: tmp_table1_view.delete_if_exists()
             if tmp_table2_view is not None: tmp_table2_view.delete_if_exists()
             if out_table_view is not None: out_table_view.delete_if_exists()
+    finally:
+        stops_view.delete()
 
-    def create_travel_time_axis_old(postfix):
-        # travel_time_by_axis_
-        out_table = fgdb.table('travel_time_by_axis_' + postfix)
-        # accomodate for single measurement tracks
-        tracks_view.subset_selection('duration > 0')
-        tracks_view.statistics(
-            out_table=out_table,
-            statistics_fields=[('duration', 'COUNT'),('duration', 'MEAN')],
-            case_field=['axis'])
-        out_table.rename_field('COUNT_duration', 'num_tracks')
-        out_table.rename_field('MEAN_duration', 'travel_time')
-        out_table.delete_field('FREQUENCY')
-
-    def create_travel_time_axis(postfix):
-        out_table = fgdb.table('travel_time_by_axis_' + postfix)
-        model.segments.statistics(
-            out_table=out_table,
-            statistics_fields=[('laenge', 'SUM')],
-            case_field='Achsen_ID')
-        out_table.rename_field('Achsen_ID', 'axis')
-        out_table.rename_field('SUM_laenge', 'length')
-        out_table.delete_field('FREQUENCY')
-        out_table.add_field('duration', 'LONG')
-        out_table_view = out_table.view()
-        speed_table_view = fgdb.table('speed_by_axis_' + postfix).view()
-        try:
-            out_table_view.add_join('axis', speed_table_view, 'axis')
-            out_table_view.calculate_field('duration', '(!{0}.length!/!{1}.arithmetic_mean_speed!)*3600'.format(out_table_view.name, speed_table_view.name))
-            out_table.delete_field('length')
-        finally:
-            out_table_view.delete_if_exists()
-            speed_table_view.delete_if_exists()
-
-    def create_travel_time_segment(postfix):
-        out_table = fgdb.table('travel_time_by_axis_segment_' + postfix)
-        model.segments.statistics(
-            out_table=out_table,
-            statistics_fields=[('laenge', 'SUM')],
-            case_field=['Achsen_ID', 'segment_id'])
-        out_table.rename_field('Achsen_ID', 'axis')
-        out_table.rename_field('segment_id', 'segment')
-        out_table.rename_field('SUM_laenge', 'length')
-        out_table.delete_field('FREQUENCY')
-        out_table.add_field('duration', 'LONG')
-        out_table_view = out_table.view()
-        speed_table_view = fgdb.table('speed_by_axis_segment_' + postfix).view()
-        try:
-            out_table_view.add_join('segment', speed_table_view, 'segment')
-            out_table_view.calculate_field('duration', '(!{0}.length!/!{1}.arithmetic_mean_speed!)*3600'.format(out_table_view.name, speed_table_view.name))
-            out_table.delete_field('length')
-        finally:
-            out_table_view.delete_if_exists()
-            speed_table_view.delete_if_exists()
-
-    def create_travel_time_segment_old(postfix):
-        # travel_time_by_axis_segment_
-        tmp_table = fgdb.table('travel_time_by_axis_segment_' + postfix + '_tmp')
-
-        measurement_view.statistics(
-            out_table=tmp_table,
-            statistics_fields=[('time', 'MIN'), ('time', 'MAX')],
-            case_field=['axis', 'segment', 'track'])
-
-        tmp_table.add_field('duration', 'LONG')
-        tmp_table.calculate_field('duration', '!MAX_time!-!MIN_time!')
-
-        def get_length_of_track_on_segment(track, axis, min_time, max_time):
-            min_point = get_point(track, axis, min_time)
-            max_point = get_point(track, axis, max_time)
-            array = Array([min_point.firstPoint, max_point.firstPoint])
-            polyline = Polyline(array, min_point.spatialReference)
-            return polyline.getLength('GEODESIC', 'METERS')
-
-        def get_segment_length(axis, segment):
-            where_clause = SQL.and_((SQL.eq_('Achsen_ID', SQL.quote_(axis)), SQL.eq_('segment_id', segment)))
-            with model.segments.search(['length'], where_clause=where_clause) as rows:
-                for row in rows:
-                    return row[0]
-            return None
-
-        def get_point(track, axis, time):
-
-            where_clause = SQL.and_((
-                SQL.eq_('axis', SQL.quote_(axis)),
-                SQL.eq_('track', SQL.quote_(track)),
-                SQL.eq_('time', time)))
-
-            with measurement_view.search(['SHAPE@', 'time'], where_clause=where_clause) as rows:
-                for row in rows:
-                    return row[0]
-            return None
-
-
-        with tmp_table.update(['axis', 'segment', 'track', 'MIN_time', 'MAX_time', 'duration']) as rows:
-            for row in rows:
-                axis, segment, track, min_time, max_time, duration = row
-                tlength = get_length_of_track_on_segment(track, axis, min_time, max_time)
-                slength = get_segment_length(axis, segment)
-                if tlength > 0:
-                    factor = slength/tlength
-                    #log.debug('travel_time stretching factor: %f', factor)
-                    row[5] = row[5] * factor
-                    rows.updateRow(row)
-                else:
-                    log.debug('can not scale travel time, length is zero')
-
-        tmp_table_view = tmp_table.view()
-        # accomodate for single measurement tracks
-        tmp_table_view.new_selection('duration > 0')
-
-        out_table = fgdb.table('travel_time_by_axis_segment_' + postfix)
-        tmp_table_view.statistics(
-            out_table=out_table,
-            statistics_fields=[('duration', 'COUNT'),('duration', 'MEAN')],
-            case_field=['axis','segment'])
-        out_table.rename_field('COUNT_duration', 'num_tracks')
-        out_table.delete_field('FREQUENCY')
-        out_table.rename_field('MEAN_duration', 'travel_time')
-        out_table.add_join_field(['axis', 'segment'])
-
-        tmp_table_view.delete()
-        tmp_table.delete()
-
+def create_travel_time_axis_table(model, fgdb, postfix='all', out=None):
+    """
+    Creates the travel time table of the axes from the speed_by_axis_ table
+    of fgdb in out (by default fgdb).
+    """
+    if out is None:
+        out = fgdb
+    out_table = out.table('travel_time_by_axis_' + postfix)
+    model.segments.statistics(
+        out_table=out_table,
+        statistics_fields=[('laenge', 'SUM')],
+        case_field='Achsen_ID')
+    out_table.rename_field('Achsen_ID', 'axis')
+    out_table.rename_field('SUM_laenge', 'length')
+    out_table.delete_field('FREQUENCY')
+    out_table.add_field('duration', 'LONG')
+    out_table_view = out_table.view()
+    speed_table_view = fgdb.table('speed_by_axis_' + postfix).view()
     try:
-        measurement_view.clear_selection()
-        create_co2_consumption('all')
-        # eliminate null and 0 values
-        measurement_view.new_selection(SQL.and_((SQL.neq_('speed', 0), SQL.is_not_null_('speed'))))
-        create_mean_speed('all')
-        create_travel_time_segment('all')
-
-        for time_of_week in ['workday', 'weekend']:
-          for time_of_day in ['morning', 'evening', 'noon', 'night']:
-            selector = '{}_{}'.format(time_of_week, time_of_day)
-            measurement_view.new_selection(SQL.eq_(selector, 1))
-            create_co2_consumption(selector)
-            measurement_view.subset_selection(SQL.and_((SQL.neq_('speed', 0), SQL.is_not_null_('speed'))))
-            create_mean_speed(selector)
-            create_travel_time_segment(selector)
-
-        stops_view.clear_selection()
-        create_stops('all')
-
-        for time_of_week in ['workday', 'weekend']:
-          for time_of_day in ['morning', 'evening', 'noon', 'night']:
-            selector = '{}_{}'.format(time_of_week, time_of_day)
-            stops_view.new_selection(SQL.eq_(selector, 1))
-            create_stops(selector)
-
-        tracks_view.new_selection(SQL.eq_('complete', 1))
-        create_travel_time_axis('all')
-
-        for time_of_week in ['workday', 'weekend']:
-          for time_of_day in ['morning', 'evening', 'noon', 'night']:
-            selector = '{}_{}'.format(time_of_week, time_of_day)
-            tracks_view.new_selection(SQL.and_((SQL.eq_('complete', 1), SQL.eq_(selector, 1))))
-            create_travel_time_axis(selector)
+        out_table_view.add_join('axis', speed_table_view, 'axis')
+        out_table_view.calculate_field('duration', '(!{0}.length!/!{1}.arithmetic_mean_speed!)*3600'.format(out_table_view.name, speed_table_view.name))
+        out_table.delete_field('length')
+    finally:
+        out_table_view.delete_if_exists()
+        speed_table_view.delete_if_exists()
+
+def create_travel_time_segment_table(model, fgdb, postfix='all', out=None):
+    """
+    Creates the travel time table of the segments from the
+    speed_by_axis_segment_ table of fgdb in out (by default fgdb).
+    """
+    if out is None:
+        out = fgdb
+    out_table = out.table('travel_time_by_axis_segment_' + postfix)
+    model.segments.statistics(
+        out_table=out_table,
+        statistics_fields=[('laenge', 'SUM')],
+        case_field=['Achsen_ID', 'segment_id'])
+    out_table.rename_field('Achsen_ID', 'axis')
+    out_table.rename_field('segment_id', 'segment')
+    out_table.rename_field('SUM_laenge', 'length')
+    out_table.delete_field('FREQUENCY')
+    out_table.add_field('duration', 'LONG')
+    out_table_view = out_table.view()
+    speed_table_view = fgdb.table('speed_by_axis_segment_' + postfix).view()
+    try:
+        out_table_view.add_join('segment', speed_table_view, 'segment')
+        out_table_view.calculate_field('duration', '(!{0}.length!/!{1}.arithmetic_mean_speed!)*3600'.format(out_table_view.name, speed_table_view.name))
+        out_table.delete_field('length')
+    finally:
+        out_table_view.delete_if_exists()
+        speed_table_view.delete_if_exists()
+
+def create_statistics_graph(model, fgdb, scratch_dir=None):
+    """
+    Creates the tasks calculating the statistics tables of all time classes.
+    The travel times depend on the speeds, all other tasks only read the
+    measurements, the stops and the segments of the model. If scratch_dir is
+    given, every task writes its tables to a FileGDB of its own in it.
+    """
+    graph = TaskGraph()
+
+    def add(name, function, args, inputs, outputs):
+        if scratch_dir is not None:
+            args = (function, get_task_workspace(scratch_dir, name)) + args
+            function = _run_in_workspace
+        graph.add(name, function, args, inputs, outputs)
+
+    selections = [('all', None)] + [(selector, TIME_CLASSES.where_clause(selector)) for selector in TIME_SEGMENTS]
+    for postfix, where_clause in selections:
+        add('co2_consumption_' + postfix, create_co2_consumption_tables, (fgdb, where_clause, postfix),
+            inputs=['measurements'],
+            outputs=[name + postfix for name in ('consumption_by_axis_', 'co2_by_axis_',
+                                                 'consumption_by_axis_segment_', 'co2_by_axis_segment_')])
+        add('mean_speed_' + postfix, create_mean_speed_tables, (fgdb, where_clause, postfix),
+            inputs=['measurements'],
+            outputs=['speed_by_axis_' + postfix, 'speed_by_axis_segment_' + postfix])
+        add('travel_time_segment_' + postfix, create_travel_time_segment_table, (model, fgdb, postfix),
+            inputs=['segments', 'speed_by_axis_segment_' + postfix],
+            outputs=['travel_time_by_axis_segment_' + postfix])
+    for postfix, where_clause in selections:
+        add('stops_' + postfix, create_stops_tables, (fgdb, where_clause, postfix),
+            inputs=['stops'],
+            outputs=['stops_by_axis_' + postfix, 'stops_by_axis_segment_' + postfix])
+    for postfix, where_clause in selections:
+        add('travel_time_axis_' + postfix, create_travel_time_axis_table, (model, fgdb, postfix),
+            inputs=['segments', 'speed_by_axis_' + postfix],
+            outputs=['travel_time_by_axis_' + postfix])
+    return graph
+
+def get_task_workspace(scratch_dir, name):
+    """Returns the scratch FileGDB a statistics task writes its tables to."""
+    return FileGDB(os.path.join(scratch_dir, name + '.gdb'))
+
+def _run_in_workspace(function, out, *args):
+    """Runs a statistics task in a worker process writing its tables to the out FileGDB."""
+    out.create_if_not_exists()
+    function(*args, out=out)
+
+def _init_statistics_worker(settings):
+    """Applies the arcpy environment of the parent process to a worker process."""
+    for name, value in settings.iteritems():
+        setattr(env, name, value)
+
+def calculate_statistics(model, fgdb, single_pass=False, workers=1, timeout=None):
+    if single_pass:
+        # scan measurements and stops once for all time classes
+        StatisticsAggregator(model, fgdb, TIME_CLASSES, TIME_SEGMENTS).run()
+        return
+
+    if workers <= 1:
+        graph = create_statistics_graph(model, fgdb)
+        graph.run()
+        graph.report()
+        return
+
+    # independent tables are calculated concurrently, every task writes to
+    # a scratch FileGDB of its own (concurrent writers of a FileGDB fail on
+    # its schema locks) and its tables are copied to fgdb by this process
+    scratch_dir = tempfile.mkdtemp(prefix='statistics_', dir=os.path.dirname(fgdb.id))
+
+    def copy_outputs(task):
+        workspace = get_task_workspace(scratch_dir, task.name)
+        for name in sorted(task.outputs):
+            workspace.table(name).copy(fgdb.table(name))
+        workspace.delete_if_exists()
 
+    try:
+        graph = create_statistics_graph(model, fgdb, scratch_dir)
+        settings = dict(overwriteOutput=env.overwriteOutput, workspace=env.workspace)
+        graph.run(workers, _init_statistics_worker, (settings,), completed=copy_outputs, timeout=timeout)
+        graph.report()
     finally:
-        tracks_view.delete()
-        measurement_view.delete()
-        stops_view.delete()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
 
 def find_passages_by_axis_segment(fgdb, stops_by_axis_segment_track, axis_segment, axis_track_segment, out_table):
     passages_without_stops = fgdb.table('passages_without_stops')
@@ -1433,15 +2037,9 @@ def create_segments_per_track_table(fgdb, axis_track_segment, num_segments_per_a
     num_segments_per_track.add_join_field(['axis','track'])
 
     num_segments_per_track.add_field('complete', 'SHORT')
-    num_segments_per_track.add_field('weekend_morning', 'SHORT')
-    num_segments_per_track.add_field('weekend_evening', 'SHORT')
-    num_segments_per_track.add_field('weekend_night', 'SHORT')
-    num_segments_per_track.add_field('weekend_noon', 'SHORT')
-
-    num_segments_per_track.add_field('workday_morning', 'SHORT')
-    num_segments_per_track.add_field('workday_evening', 'SHORT')
-    num_segments_per_track.add_field('workday_night', 'SHORT')
-    num_segments_per_track.add_field('workday_noon', 'SHORT')
+    time_classes = TIME_SEGMENTS
+    for name in time_classes:
+        num_segments_per_track.add_field(name, 'SHORT')
 
     view = num_segments_per_track.view()
 
@@ -1449,75 +2047,23 @@ def create_segments_per_track_table(fgdb, axis_track_segment, num_segments_per_a
         view.add_join('axis', num_segments_per_axis, 'axis')
 
         code_block = textwrap.dedent("""\
-        from datetime import datetime
-
-        def parse(s):
-            return datetime.utcfromtimestamp(s/1000)
-
         def is_complete(axis_segments, track_segments):
             return True if axis_segments == track_segments else False
-
-        def workday_is_in_range(start, end, min_hour, max_hour):
-            start = parse(start)
-            end = parse(end)
-            if min_hour <= max_hour:
-                start = (start.weekday() < 5 and min_hour <= start.hour < max_hour)
-                end = (end.weekday() < 5 and min_hour <= end.hour < max_hour)
-            else:
-                start = (start.weekday() < 5 and (min_hour <= start.hour or start.hour < max_hour))
-                end = (end.weekday() < 5 and (min_hour <= end.hour or end.hour < max_hour))
-            return start or end
-
-        def weekend_is_in_range(start, end, min_hour, max_hour):
-            start = parse(start)
-            end = parse(end)
-            if min_hour <= max_hour:
-                start = (start.weekday() >= 5 and min_hour <= start.hour < max_hour)
-                end = (end.weekday() >= 5 and min_hour <= end.hour < max_hour)
-            else:
-                start = (start.weekday() >= 5 and (min_hour <= start.hour or start.hour < max_hour))
-                end = (end.weekday() >= 5 and (min_hour <= end.hour or end.hour < max_hour))
-            return start or end
         """)
 
-        view.calculate_field('workday_morning',  'workday_is_in_range(!num_segments_per_track.start_time!, !num_segments_per_track.end_time!,  4, 8)', code_block=code_block)
-        view.calculate_field('workday_evening',  'workday_is_in_range(!num_segments_per_track.start_time!, !num_segments_per_track.end_time!, 13, 17)', code_block=code_block)
-        view.calculate_field('workday_noon',     'workday_is_in_range(!num_segments_per_track.start_time!, !num_segments_per_track.end_time!, 10, 12)', code_block=code_block)
-        view.calculate_field('workday_night',    'workday_is_in_range(!num_segments_per_track.start_time!, !num_segments_per_track.end_time!, 19, 4)', code_block=code_block)
-
-        view.calculate_field('weekend_morning',  'weekend_is_in_range(!num_segments_per_track.start_time!, !num_segments_per_track.end_time!,  4, 8)', code_block=code_block)
-        view.calculate_field('weekend_evening',  'weekend_is_in_range(!num_segments_per_track.start_time!, !num_segments_per_track.end_time!, 13, 17)', code_block=code_block)
-        view.calculate_field('weekend_noon',     'weekend_is_in_range(!num_segments_per_track.start_time!, !num_segments_per_track.end_time!, 10, 12)', code_block=code_block)
-        view.calculate_field('weekend_night',    'weekend_is_in_range(!num_segments_per_track.start_time!, !num_segments_per_track.end_time!, 19, 4)', code_block=code_block)
-
         view.calculate_field('complete', 'is_complete(!num_segments_per_axis.segments!, !num_segments_per_track.segments!)', code_block=code_block)
     finally:
         view.delete()
 
+    update_time_classes(num_segments_per_track, 'start_time', 'end_time', time_classes)
 
     t = num_segments_per_track.statistics(
         out_table=fgdb.table('num_tracks_per_axis'),
-        statistics_fields=[
-            ('complete', 'SUM'),
-            ('weekend_morning', 'SUM'),
-            ('weekend_evening', 'SUM'),
-            ('weekend_noon', 'SUM')
-            ('weekend_night', 'SUM'),
-            ('workday_morning', 'SUM'),
-            ('workday_evening', 'SUM'),
-            ('workday_noon', 'SUM')
-            ('workday_night', 'SUM')],
+        statistics_fields=[('complete', 'SUM')] + [(name, 'SUM') for name in time_classes],
         case_field='axis')
     t.rename_field('SUM_complete', 'complete')
-    t.rename_field('SUM_workday_morning', 'workday_morning')
-    t.rename_field('SUM_workday_evening', 'workday_evening')
-    t.rename_field('SUM_workday_noon', 'workday_noon')
-    t.rename_field('SUM_workday_night', 'workday_night')
-
-    t.rename_field('SUM_weekend_morning', 'weekend_morning')
-    t.rename_field('SUM_weekend_evening', 'weekend_evening')
-    t.rename_field('SUM_weekend_noon', 'weekend_noon')
-    t.rename_field('SUM_weekend_night', 'weekend_night')
+    for name in time_classes:
+        t.rename_field('SUM_' + name, name)
     t.rename_field('FREQUENCY', 'sum')
 
     return num_segments_per_track
@@ -1534,7 +2080,12 @@ def create_segments_per_axis_table(fgdb, axis_segment_fc):
     num_segments_per_axis.rename_field('COUNT_segment_id', 'segments')
     return num_segments_per_axis
 
-def find_passages(fgdb, axis_model):
+def find_passages(fgdb, axis_model, single_pass=False):
+    if single_pass:
+        # classify the passages of all time classes in memory
+        PassageAggregator(axis_model, fgdb, TIME_CLASSES, TIME_SEGMENTS).run()
+        return
+
     measurements = fgdb.feature_class('measurements').view()
     stops = fgdb.table('stops').view()
     axis_segment = create_axis_segment_table(fgdb, axis_model.segments)
@@ -1632,23 +2183,11 @@ def find_passages(fgdb, axis_model):
 
 
         create_passages_by_axis_segment_table('all', None)
-        create_passages_by_axis_segment_table('workday_morning', SQL.eq_('workday_morning', 1))
-        create_passages_by_axis_segment_table('workday_evening', SQL.eq_('workday_evening', 1))
-        create_passages_by_axis_segment_table('workday_noon', SQL.eq_('workday_noon', 1))
-        create_passages_by_axis_segment_table('workday_night', SQL.eq_('workday_night', 1))
-        create_passages_by_axis_segment_table('weekend_morning', SQL.eq_('weekend_morning', 1))
-        create_passages_by_axis_segment_table('weekend_evening', SQL.eq_('weekend_evening', 1))
-        create_passages_by_axis_segment_table('weekend_noon', SQL.eq_('weekend_noon', 1))
-        create_passages_by_axis_segment_table('weekend_night', SQL.eq_('weekend_night', 1))
+        for selector in TIME_SEGMENTS:
+            create_passages_by_axis_segment_table(selector, TIME_CLASSES.where_clause(selector))
         create_passages_by_axis_table('all', None)
-        create_passages_by_axis_table('workday_morning', SQL.eq_('workday_morning', 1))
-        create_passages_by_axis_table('workday_evening', SQL.eq_('workday_evening', 1))
-        create_passages_by_axis_table('workday_noon', SQL.eq_('workday_noon', 1))
-        create_passages_by_axis_table('workday_night', SQL.eq_('workday_night', 1))
-        create_passages_by_axis_table('weekend_morning', SQL.eq_('weekend_morning', 1))
-        create_passages_by_axis_table('weekend_evening', SQL.eq_('weekend_evening', 1))
-        create_passages_by_axis_table('weekend_noon', SQL.eq_('weekend_noon', 1))
-        create_passages_by_axis_table('weekend_night', SQL.eq_('weekend_night', 1))
+        for selector in TIME_SEGMENTS:
+            create_passages_by_axis_table(selector, TIME_CLASSES.where_clause(selector))
 
     finally:
         stops.delete()
@@ -1656,55 +2195,42 @@ def find_passages(fgdb, axis_model):
         axis.delete_if_exists()
 
 def add_time_segment_fields(feature_class):
-    code_block = textwrap.dedent("""\
-    from datetime import datetime
-
-    def parse(s):
-        return datetime.utcfromtimestamp(s/1000)
-
-    def workday_is_in_range(time, min_hour, max_hour):
-        time = parse(time)
-        if min_hour <= max_hour:
-            return (time.weekday() < 5 and min_hour <= time.hour < max_hour)
-        else:
-            return (time.weekday() < 5 and (min_hour <= time.hour or time.hour < max_hour))
-
-    def weekend_is_in_range(time, min_hour, max_hour):
-        time = parse(time)
-        if min_hour <= max_hour:
-            return (time.weekday() >= 5 and min_hour <= time.hour < max_hour)
-        else:
-            return (time.weekday() >= 5 and (min_hour <= time.hour or time.hour < max_hour))
-    """)
-
-
-    for time_of_week in ['workday', 'weekend']:
-        for time_of_day in ['morning', 'evening', 'noon', 'night']:
-            selector = '{}_{}'.format(time_of_week, time_of_day)
-            feature_class.add_field(selector, 'SHORT')
-
-    feature_class.calculate_field('workday_morning', 'workday_is_in_range(!time!,  4, 8)', code_block=code_block)
-    feature_class.calculate_field('workday_noon',    'workday_is_in_range(!time!, 10, 12)', code_block=code_block)
-    feature_class.calculate_field('workday_evening', 'workday_is_in_range(!time!, 13, 17)', code_block=code_block)
-    feature_class.calculate_field('workday_night',   'workday_is_in_range(!time!, 19, 4)', code_block=code_block)
-
-    feature_class.calculate_field('weekend_morning', 'weekend_is_in_range(!time!,  4, 8)', code_block=code_block)
-    feature_class.calculate_field('weekend_noon',    'weekend_is_in_range(!time!, 10, 12)', code_block=code_block)
-    feature_class.calculate_field('weekend_evening', 'weekend_is_in_range(!time!, 13, 17)', code_block=code_block)
-    feature_class.calculate_field('weekend_night',   'weekend_is_in_range(!time!, 19, 4)', code_block=code_block)
-
+    if not feature_class.field_exist('time_class'):
+        calculate_time_class_field(feature_class)
+    add_measurement_indexes(feature_class)
+
+def calculate_time_class_field(feature_class):
+    """Adds and calculates the packed time class field of the measurements."""
+    if not feature_class.field_exist('time_class'):
+        feature_class.add_field('time_class', 'LONG')
+
+    with feature_class.update(['time', 'time_class']) as rows:
+        for time, time_class in rows:
+            rows.updateRow([time, TIME_CLASSES.mask(time) if time is not None else 0])
+
+def update_time_classes(table, start_field, end_field=None, names=None):
+    """
+    Calculates the time class fields of every row in a single pass. A row is
+    in a time class if its start or end time is.
+    """
+    if names is None:
+        names = TIME_CLASSES.names
+    time_fields = [start_field] if end_field is None else [start_field, end_field]
+    with table.update(time_fields + list(names)) as rows:
+        for row in rows:
+            times = [t for t in row[:len(time_fields)] if t is not None]
+            rows.updateRow(row[:len(time_fields)] + list(TIME_CLASSES.flags(*times, names=names)))
+
+def add_measurement_indexes(feature_class):
+    """Adds the attribute indexes of the measurements."""
     feature_class.add_index(['segment'], 'segment_idx')
     feature_class.add_index(['axis'], 'axis_idx')
     feature_class.add_index(['track'], 'track_idx')
     feature_class.add_index(['time'], 'time_idx')
     feature_class.add_index(['complete_axis_match'], 'complete_axis_match_idx')
+    feature_class.add_index(['time_class'], 'time_class_idx')
 
-    for time_of_week in ['workday', 'weekend']:
-        for time_of_day in ['morning', 'evening', 'noon', 'night']:
-            selector = '{}_{}'.format(time_of_week, time_of_day)
-            feature_class.add_index([selector], '{}_idx'.format(selector))
-
-def create_result_tables(fgdb, model):
+def create_result_tables(fgdb, model, bulk=False):
     def get_axis_segments():
         axis_segment = create_axis_segment_table(fgdb, model.segments)
         axes = {}
@@ -1757,14 +2283,17 @@ def create_result_tables(fgdb, model):
             fields_to_insert.append((new_name, field_type))
         return fields_to_insert
 
-    axes = get_axis_segments()
-    axis_table = create_axis_result_table(axes)
-    axis_segment_table = create_axis_segment_resut_table(axes)
+    classifiers = ['all'] + TIME_SEGMENTS
+    table_types = [ 'passages', 'co2', 'consumption', 'travel_time', 'stops', 'speed']
 
+    axes = get_axis_segments()
 
+    if bulk:
+        create_result_tables_in_bulk(fgdb, axes, table_types, classifiers, get_fields_to_copy, get_fields_to_insert)
+        return
 
-    classifiers = ['all'] + ['{}_{}'.format(time_of_week, time_of_day) for time_of_week in ['workday', 'weekend'] for time_of_day in ['morning', 'evening', 'noon', 'night']]
-    table_types = [ 'passages', 'co2', 'consumption', 'travel_time', 'stops', 'speed']
+    axis_table = create_axis_result_table(axes)
+    axis_segment_table = create_axis_segment_resut_table(axes)
 
     for table_type in table_types:
         for classifier in classifiers:
@@ -1824,3 +2353,65 @@ def create_result_tables(fgdb, model):
       formula = '!co2_{0}!/!arithmetic_mean_speed_{0}!*100'.format(classifier)
       axis_table.calculate_field(column, formula)
       axis_segment_table.calculate_field(column, formula)
+
+def create_result_tables_in_bulk(fgdb, axes, table_types, classifiers, get_fields_to_copy, get_fields_to_insert):
+    """
+    Creates the results_by_axis and results_by_axis_segment tables by reading
+    every per classifier table into a dictionary by axis (and segment),
+    creating the wide schema in a single call and inserting every result
+    row once.
+    """
+    def get_dtype(field):
+        return RESULT_FIELD_DTYPES.get(field.type) or '<U%d' % max(field.length, 1)
+
+    def read(table, keys, table_type, classifier, columns, values):
+        log.debug('Sourcing %s', table.id)
+        dtypes = dict((field.name, get_dtype(field)) for field in table.list_fields())
+        fields_to_copy = get_fields_to_copy(table)
+        fields_to_insert = get_fields_to_insert(table_type, classifier, fields_to_copy)
+        names = [new_name for new_name, _ in fields_to_insert]
+        columns.extend((new_name, dtypes[field_name]) for (field_name, _), new_name in izip(fields_to_copy, names))
+        with table.search(keys + [field_name for field_name, _ in fields_to_copy]) as rows:
+            for row in rows:
+                values.setdefault(tuple(row[:len(keys)]), {}).update(izip(names, row[len(keys):]))
+        table.delete()
+
+    def write(name, keys, key_dtypes, columns, values, index_name):
+        table = fgdb.table(name)
+        table.delete_if_exists()
+        # create the complete schema at once from an empty array
+        dtype = [(str(column), column_dtype) for column, column_dtype in zip(keys, key_dtypes) + columns]
+        table.create_from_array(np.empty(0, dtype=dtype))
+        table.add_index(keys, index_name, unique=True)
+        columns = [column for column, _ in columns]
+        with table.insert(keys + columns) as insert:
+            for key, row in values:
+                insert.insertRow(list(key) + [row.get(column) for column in columns])
+        return table
+
+    axis_columns, axis_values = [], {}
+    axis_segment_columns, axis_segment_values = [], {}
+    for table_type in table_types:
+        for classifier in classifiers:
+            read(fgdb.table('{}_by_axis_{}'.format(table_type, classifier)),
+                 ['axis'], table_type, classifier, axis_columns, axis_values)
+            read(fgdb.table('{}_by_axis_segment_{}'.format(table_type, classifier)),
+                 ['axis', 'segment'], table_type, classifier, axis_segment_columns, axis_segment_values)
+
+    # recalculate the CO2 and consumption fields based on the mean speed
+    # to get the value per 100km
+    for values in (axis_values, axis_segment_values):
+        for row in values.itervalues():
+            for classifier in classifiers:
+                speed = row.get('arithmetic_mean_speed_{0}'.format(classifier))
+                for column in ('consumption_{0}'.format(classifier), 'co2_{0}'.format(classifier)):
+                    value = row.get(column)
+                    row[column] = value / speed * 100 if value is not None and speed else None
+
+    write('results_by_axis', ['axis'], ['<U255'], axis_columns,
+          (((axis,), axis_values.get((axis,), {})) for axis in axes),
+          'axis_idx')
+    write('results_by_axis_segment', ['axis', 'segment'], ['<U255', '<i4'], axis_segment_columns,
+          (((axis, segment), axis_segment_values.get((axis, segment), {}))
+           for axis, segments in axes.iteritems() for segment in segments),
+          'axis_segment_idx')
@@ -431,6 +431,21 @@ class Table(ArcPyEntity, TableLikeArcPyEntityBase):
         debug('arcpy.management.CreateTable', (out_path, out_name))
         arcpy.management.CreateTable(out_path, out_name)
 
+    def create_from_array(self, array):
+        """creates the table with the fields (and rows) of a structured NumPy array"""
+        debug('arcpy.da.NumPyArrayToTable', (array.dtype, self.id))
+        arcpy.da.NumPyArrayToTable(array, self.id)
+
+    def append_array(self, array, workspace='in_memory'):
+        """appends the rows of a structured NumPy array with the fields of the table"""
+        rows = Table(os.path.join(workspace, os.path.basename(self.id) + '_rows'))
+        rows.delete_if_exists()
+        rows.create_from_array(array)
+        try:
+            self.append(rows)
+        finally:
+            rows.delete()
+
 class TableView(ArcPyEntityView, TableLikeArcPyEntityBase):
     def create(self, source, name):
         debug('arcpy.management.MakeTableView', (source.id, name))
@@ -0,0 +1,347 @@
+import os
+import time
+import zlib
+import heapq
+import shutil
+import logging
+import tempfile
+import traceback
+import cPickle as pickle
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+import numpy as np
+from itertools import islice, izip
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100000
+
+
+def hash_partition(key, partitions):
+    """returns the partition of a key by the crc32 of its text"""
+    key = u'{}'.format(key).encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % partitions
+
+def partition_of(axis, track, partitions):
+    """returns the partition of the rows of (axis, track)"""
+    return hash_partition(u'{}|{}'.format(axis, track), partitions)
+
+def _partition_path(directory, partition):
+    return os.path.join(directory, 'partition_%d.pickle' % partition)
+
+def _load_partition(path, num_fields):
+    """loads and concatenates the chunks of columns of a partition file"""
+    columns = [[] for _ in xrange(num_fields)]
+    index = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk_index, chunk_columns = pickle.load(f)
+            except EOFError:
+                break
+            for column, chunk_column in izip(columns, chunk_columns):
+                column.append(chunk_column)
+            index.append(chunk_index)
+    return [np.concatenate(column) for column in columns], np.concatenate(index)
+
+def _result_path(directory, partition):
+    return os.path.join(directory, 'result_%d.pickle' % partition)
+
+def _run_partition(task):
+    """
+    runs the function on a partition in a worker process and writes the
+    results in chunks to a result file, returns the path of that file
+    """
+    function, partition, path, num_fields, args, chunk_size = task
+    if path is None:
+        return partition, None
+    columns, index = _load_partition(path, num_fields)
+    results = iter(function(columns, index, *args))
+    result_path = _result_path(os.path.dirname(path), partition)
+    with open(result_path, 'wb') as f:
+        while True:
+            chunk = list(islice(results, chunk_size))
+            if not chunk:
+                break
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+    return partition, result_path
+
+def _load_results(path):
+    """yields the results of a result file chunk by chunk"""
+    if path is None:
+        return
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                break
+            for result in chunk:
+                yield result
+
+
+class PartitionedExecutor(object):
+    """
+    Runs per track algorithms over an ordered stream of measurements in a
+    pool of worker processes. The rows are split into partitions by a hash
+    of (axis, track), so all rows of a track end up in the same partition
+    in their original order. Partitions are written as pickled column
+    arrays to a temporary directory and every worker processes whole
+    partitions.
+
+    The function run on a partition gets the columns of the fields, the
+    global indices of the rows and the additional arguments. It returns
+    (index, result) tuples ordered by index, where index is the global
+    index of the first row the result was computed from. Every worker
+    writes the results of its partition to a result file, the result
+    files are merged lazily by that index, so the output is the same for
+    any number of workers and partitions.
+    """
+
+    def __init__(self, workers=1, partitions=None, directory=None, chunk_size=CHUNK_SIZE):
+        self.workers = workers
+        # more partitions than workers keep the pool busy if tracks are skewed
+        self.partitions = partitions if partitions is not None else 4 * workers
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+    def partition(self, rows, fields, directory, key_fields=('axis', 'track')):
+        """
+        writes the rows to the partition files in directory and returns the
+        file path of every partition or None for empty partitions
+        """
+        key_idx = [fields.index(name) for name in key_fields]
+        paths = [None] * self.partitions
+        offset = 0
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            partition = np.array([partition_of(row[key_idx[0]], row[key_idx[1]], self.partitions)
+                                  for row in chunk], dtype=np.int64)
+            columns = [np.array(column) for column in izip(*chunk)]
+            index = np.arange(offset, offset + len(chunk), dtype=np.int64)
+            for p in np.unique(partition).tolist():
+                selected = np.flatnonzero(partition == p)
+                paths[p] = _partition_path(directory, p)
+                with open(paths[p], 'ab') as f:
+                    pickle.dump((index[selected], [column[selected] for column in columns]),
+                                f, pickle.HIGHEST_PROTOCOL)
+            offset += len(chunk)
+        log.debug('Partitioned %d rows into %d partitions', offset, self.partitions)
+        return paths
+
+    def map(self, function, rows, fields, args=(), key_fields=('axis', 'track')):
+        """
+        runs the function on every partition of the rows and yields the
+        results ordered by the index of their first row
+        """
+        directory = tempfile.mkdtemp(prefix='partitions_', dir=self.directory)
+        try:
+            paths = self.partition(rows, fields, directory, key_fields)
+            tasks = [(function, p, paths[p], len(fields), args, self.chunk_size)
+                     for p in xrange(self.partitions)]
+            results = [None] * self.partitions
+            if self.workers > 1:
+                pool = multiprocessing.Pool(self.workers)
+                try:
+                    for p, path in pool.imap_unordered(_run_partition, tasks):
+                        results[p] = path
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                for task in tasks:
+                    p, path = _run_partition(task)
+                    results[p] = path
+
+            # the partition and position break ties of results of the same row
+            merged = heapq.merge(*[(((index, p, i), value) for i, (index, value) in enumerate(_load_results(path)))
+                                   for p, path in enumerate(results)])
+            for key, value in merged:
+                yield value
+        finally:
+            # the result files are read lazily, so they are removed only
+            # after the merge is done
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+# the queue a worker process reports the tasks it starts to
+_started = None
+
+def _init_task_worker(started, initializer, initargs):
+    """keeps the queue of started tasks and calls the initializer of a worker process"""
+    global _started
+    _started = started
+    if initializer is not None:
+        initializer(*initargs)
+
+def _run_task(name, function, args):
+    """runs a task in a worker process and returns its duration or the error"""
+    if _started is not None:
+        _started.put(name)
+    start = time.time()
+    try:
+        function(*args)
+    except Exception:
+        return name, None, traceback.format_exc()
+    return name, time.time() - start, None
+
+
+class Task(object):
+    """A function of a TaskGraph with the names of the data it reads and writes."""
+
+    def __init__(self, name, function, args=(), inputs=(), outputs=()):
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.inputs = frozenset(inputs)
+        self.outputs = frozenset(outputs)
+        self.duration = None
+
+
+class TaskGraph(object):
+    """
+    A set of tasks that depend on each other by their inputs and outputs: a
+    task depends on the tasks writing any of its inputs. Inputs no task
+    writes are expected to exist. The tasks are run in a process pool, a
+    task is started as soon as all of its dependencies are completed.
+    Every task has to create the views it works on itself, concurrent tasks
+    should write to workspaces of their own.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.writers = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, name, function, args=(), inputs=(), outputs=()):
+        task = Task(name, function, args, inputs, outputs)
+        if any(t.name == name for t in self.tasks):
+            raise ValueError('duplicate task: %s' % name)
+        for output in task.outputs:
+            if output in self.writers:
+                raise ValueError('%s is written by %s and %s' % (output, self.writers[output].name, name))
+            self.writers[output] = task
+        self.tasks.append(task)
+        return task
+
+    def dependencies(self, task):
+        """returns the tasks the task depends on in the order they were added"""
+        writers = set(self.writers[x].name for x in task.inputs if x in self.writers)
+        return [t for t in self.tasks if t.name in writers]
+
+    def order(self):
+        """returns the tasks in a topological order that keeps the order they were added in"""
+        done, ordered = set(), []
+        while len(ordered) < len(self.tasks):
+            ready = [t for t in self.tasks if t.name not in done
+                     and all(d.name in done for d in self.dependencies(t))]
+            if not ready:
+                raise ValueError('the tasks contain a cycle')
+            ordered.append(ready[0])
+            done.add(ready[0].name)
+        return ordered
+
+    def run(self, workers=1, initializer=None, initargs=(), completed=None, timeout=None):
+        """
+        runs all tasks, independent tasks concurrently if workers > 1. The
+        initializer is called with initargs in every worker process and
+        completed with every completed task in this process, before the
+        tasks depending on it are started. A task running longer than
+        timeout seconds in a worker is considered lost with its worker
+        """
+        order = self.order()
+        start = time.time()
+        if workers > 1:
+            self._run_in_pool(workers, initializer, initargs, completed, timeout)
+        else:
+            for task in order:
+                task_start = time.time()
+                task.function(*task.args)
+                task.duration = time.time() - task_start
+                log.debug('Task %s took %.1fs', task.name, task.duration)
+                if completed is not None:
+                    completed(task)
+        log.info('Ran %d tasks in %.1fs', len(self.tasks), time.time() - start)
+
+    def _run_in_pool(self, workers, initializer, initargs, completed, timeout):
+        pending = list(self.tasks)
+        done = set()
+        running = {}
+        # the workers report the tasks they start (synchronously, so even a
+        # worker that dies right away does), a task of a worker that died
+        # is never completed and is detected by its running time
+        started = SimpleQueue()
+        start_times = {}
+        pool = multiprocessing.Pool(workers, _init_task_worker, (started, initializer, initargs))
+        try:
+            while pending or running:
+                ready = [t for t in pending if all(d.name in done for d in self.dependencies(t))]
+                for task in ready:
+                    pending.remove(task)
+                    running[task.name] = (task, pool.apply_async(_run_task, (task.name, task.function, task.args)))
+                while not started.empty():
+                    start_times[started.get()] = time.time()
+                finished = [(task, result) for task, result in running.values() if result.ready()]
+                if not finished:
+                    if timeout is not None:
+                        now = time.time()
+                        lost = sorted(name for name in running
+                                      if name in start_times and now - start_times[name] > timeout)
+                        if lost:
+                            raise RuntimeError('%s did not complete within %ds, the worker process may have died'
+                                               % (', '.join(lost), timeout))
+                    time.sleep(0.1)
+                    continue
+                for task, result in finished:
+                    del running[task.name]
+                    # get() raises the errors of the pool, e.g. of pickling the task
+                    name, duration, error = result.get()
+                    if error is not None:
+                        raise RuntimeError('task %s failed:\n%s' % (name, error))
+                    task.duration = duration
+                    log.debug('Task %s took %.1fs', name, duration)
+                    if completed is not None:
+                        completed(task)
+                    done.add(name)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def critical_path(self):
+        """
+        returns the chain of dependent tasks with the longest total duration
+        of the last run and that duration
+        """
+        finish, previous = {}, {}
+        for task in self.order():
+            dependencies = self.dependencies(task)
+            before = max(dependencies, key=lambda t: finish[t.name]) if dependencies else None
+            previous[task.name] = before
+            finish[task.name] = (task.duration or 0) + (finish[before.name] if before else 0)
+        if not finish:
+            return [], 0
+        last = max(self.tasks, key=lambda t: finish[t.name])
+        path = []
+        task = last
+        while task is not None:
+            path.append(task)
+            task = previous[task.name]
+        return list(reversed(path)), finish[last.name]
+
+    def report(self):
+        """logs the critical path of the last run"""
+        path, duration = self.critical_path()
+        total = sum(t.duration or 0 for t in self.tasks)
+        log.info('Critical path (%.1fs of %.1fs task time): %s', duration, total,
+                 ' -> '.join('%s (%.1fs)' % (t.name, t.duration or 0) for t in path))
+        return path, duration
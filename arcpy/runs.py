@@ -0,0 +1,90 @@
+import numpy as np
+
+
+def run_starts(*keys):
+    """
+    returns a boolean array that is True for every element that starts a new
+    run of equal keys
+    """
+    n = len(keys[0])
+    starts = np.zeros(n, dtype=bool)
+    if n:
+        starts[0] = True
+        for key in keys:
+            key = np.asarray(key)
+            starts[1:] |= key[1:] != key[:-1]
+    return starts
+
+def cluster_intervals(keys, start, end, gap):
+    """
+    Clusters the (start, end) intervals of every key into visits. The
+    intervals have to be ordered by key and start. An interval belongs to
+    the visit of the preceding interval of the same key if it starts less
+    than gap after the end of that interval. Returns the key, start and end
+    of every visit as arrays.
+    """
+    keys = np.asarray(keys)
+    start = np.asarray(start)
+    end = np.asarray(end)
+    if not len(keys):
+        return keys, start, end
+
+    starts = run_starts(keys)
+    starts[1:] |= (start[1:] - end[:-1]) >= gap
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:] - 1, len(keys) - 1)
+    return keys[first], start[first], end[last]
+
+def find_stop_runs(keys, speed, start_threshold, end_threshold, final=True):
+    """
+    Finds stops in rows ordered by keys and time. A stop starts at a row
+    with a speed below start_threshold and lasts while the speed is at most
+    end_threshold and the keys do not change. start_threshold must not be
+    greater than end_threshold; missing speeds are expected as -inf.
+
+    Returns the indices of the first and last row of every stop, the index
+    of the row whose complete flag the stop gets (the row ending the stop or
+    its last row) and the number of leading rows that are done. If final is
+    False, stops that may continue after the last row are not returned and
+    the remaining rows have to be passed again with the next rows.
+    """
+    if start_threshold > end_threshold:
+        raise ValueError('start_threshold (%s) > end_threshold (%s)' % (start_threshold, end_threshold))
+    speed = np.asarray(speed, dtype=np.float64)
+    n = len(speed)
+    empty = np.zeros(0, dtype=np.int64)
+    if not n:
+        return empty, empty, empty, 0
+
+    group_starts = run_starts(*keys)
+    low = speed <= end_threshold
+    begin = speed < start_threshold
+
+    # runs of consecutive low speed rows of the same group
+    previous_low = np.append(False, low[:-1])
+    low_starts = low & (group_starts | ~previous_low)
+    next_low = np.append(low[1:] & ~group_starts[1:], False)
+    low_ends = np.flatnonzero(low & ~next_low)
+    run_ids = np.cumsum(low_starts) - 1
+
+    # a stop starts at the first row of a run below the start threshold
+    # and lasts until the end of the run
+    candidates = np.flatnonzero(begin)
+    ids = run_ids[candidates]
+    is_first = np.ones(len(ids), dtype=bool)
+    is_first[1:] = ids[1:] != ids[:-1]
+    first = candidates[is_first]
+    last = low_ends[ids[is_first]]
+
+    # the stop gets the complete flag of the row ending it if there is one
+    following = np.minimum(last + 1, n - 1)
+    ended_by_row = (last + 1 < n) & ~group_starts[following]
+    complete = np.where(ended_by_row, following, last)
+
+    done = n
+    if not final and low[-1]:
+        # the last run may continue in the next rows
+        done = int(np.flatnonzero(low_starts)[-1])
+        keep = first < done
+        first, last, complete = first[keep], last[keep], complete[keep]
+    return first, last, complete, done
@@ -0,0 +1,239 @@
+import math
+import struct
+import numpy as np
+from itertools import izip, islice
+
+EARTH_RADIUS = 6371008.8
+WKB_LITTLE_ENDIAN = 1
+WKB_LINESTRING = 2
+
+def intersects(a, b):
+    """checks if the envelopes a and b intersect"""
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def union(envelopes):
+    """computes the envelope containing all envelopes"""
+    envelopes = iter(envelopes)
+    xmin, ymin, xmax, ymax = next(envelopes)
+    for e in envelopes:
+        if e[0] < xmin: xmin = e[0]
+        if e[1] < ymin: ymin = e[1]
+        if e[2] > xmax: xmax = e[2]
+        if e[3] > ymax: ymax = e[3]
+    return (xmin, ymin, xmax, ymax)
+
+def extent_of(geometry):
+    """returns the envelope of an arcpy geometry as a tuple"""
+    extent = geometry.extent
+    return (extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+
+def project_local(lon, lat, origin):
+    """
+    projects WGS84 coordinates to a local equirectangular projection
+    centered at origin (lon, lat) with coordinates in metres
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    scale = math.radians(1) * EARTH_RADIUS
+    x = (lon - origin[0]) * scale * math.cos(math.radians(origin[1]))
+    y = (lat - origin[1]) * scale
+    return x, y
+
+def segment_point_distances(ax, ay, bx, by, px, py):
+    """
+    computes the distances between every segment (ax, ay)--(bx, by) and
+    every point (px, py) as a (segments x points) matrix
+    """
+    ax = np.asarray(ax, dtype=np.float64)[:, np.newaxis]
+    ay = np.asarray(ay, dtype=np.float64)[:, np.newaxis]
+    bx = np.asarray(bx, dtype=np.float64)[:, np.newaxis]
+    by = np.asarray(by, dtype=np.float64)[:, np.newaxis]
+    px = np.asarray(px, dtype=np.float64)[np.newaxis, :]
+    py = np.asarray(py, dtype=np.float64)[np.newaxis, :]
+
+    dx = bx - ax
+    dy = by - ay
+    length2 = dx * dx + dy * dy
+    # degenerated segments are treated as points
+    safe_length2 = np.where(length2 > 0, length2, 1)
+    t = ((px - ax) * dx + (py - ay) * dy) / safe_length2
+    t = np.where(length2 > 0, np.clip(t, 0, 1), 0)
+    return np.hypot(ax + t * dx - px, ay + t * dy - py)
+
+def linestring_wkb(x, y):
+    """
+    encodes the coordinates as a little endian WKB LineString or returns
+    None if there are less than two points
+    """
+    if len(x) < 2:
+        return None
+    coordinates = np.empty((len(x), 2), dtype='<f8')
+    coordinates[:, 0] = x
+    coordinates[:, 1] = y
+    header = struct.pack('<BII', WKB_LITTLE_ENDIAN, WKB_LINESTRING, len(x))
+    return bytearray(header + coordinates.tostring())
+
+def buffered_envelope_area(lon, lat, distance):
+    """
+    computes the area in square kilometres of the envelope of the WGS84
+    points buffered by distance metres
+    """
+    if not len(lon):
+        return 0
+    x, y = project_local(lon, lat, (np.mean(lon), np.mean(lat)))
+    width = np.ptp(x) + 2 * distance
+    height = np.ptp(y) + 2 * distance
+    return float(width * height) / 1e6
+
+
+class STRtree(object):
+    """
+    A static R-tree that is bulk loaded using the Sort-Tile-Recursive
+    algorithm. Entries are (envelope, value) tuples, envelopes are
+    (xmin, ymin, xmax, ymax) tuples.
+    """
+
+    def __init__(self, entries, node_capacity=10):
+        if node_capacity < 2:
+            raise ValueError('node_capacity has to be at least 2')
+        self.node_capacity = node_capacity
+        self.size = 0
+        self.root = None
+
+        # leaf nodes are (envelope, value, None)
+        nodes = [(tuple(envelope), value, None) for envelope, value in entries]
+        self.size = len(nodes)
+        if not nodes:
+            return
+        leaf = True
+        while leaf or len(nodes) > 1:
+            nodes = self._pack(nodes, leaf)
+            leaf = False
+        self.root = nodes[0]
+
+    def __len__(self):
+        return self.size
+
+    def _pack(self, nodes, leaf):
+        """packs the nodes of one level into the nodes of the next level"""
+        def center_x(node): return node[0][0] + node[0][2]
+        def center_y(node): return node[0][1] + node[0][3]
+
+        capacity = self.node_capacity
+        num_parents = int(math.ceil(len(nodes) / float(capacity)))
+        num_slices = int(math.ceil(math.sqrt(num_parents)))
+        slice_size = num_slices * capacity
+
+        parents = []
+        nodes = sorted(nodes, key=center_x)
+        for i in xrange(0, len(nodes), slice_size):
+            tile = sorted(nodes[i:i + slice_size], key=center_y)
+            for j in xrange(0, len(tile), capacity):
+                children = tile[j:j + capacity]
+                envelope = union(child[0] for child in children)
+                # inner nodes are (envelope, is_leaf, children)
+                parents.append((envelope, leaf, children))
+        return parents
+
+    def query(self, envelope):
+        """yields the values of all entries intersecting the envelope"""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node_envelope, leaf, children = stack.pop()
+            if not intersects(node_envelope, envelope):
+                continue
+            if leaf:
+                for child_envelope, value, _ in children:
+                    if intersects(child_envelope, envelope):
+                        yield value
+            else:
+                stack.extend(children)
+
+
+class SegmentLocator(object):
+    """
+    Finds the nearest of a set of WGS84 polylines for WGS84 points. The
+    polylines are split into their line segments, which are indexed by an
+    STRtree in a local projection. Polylines are given as lists of parts,
+    parts as lists of (lon, lat) tuples.
+    """
+
+    def __init__(self, polylines, values, search_radius=100, chunk_size=256):
+        self.values = list(values)
+        self.search_radius = search_radius
+        self.chunk_size = chunk_size
+
+        pieces = []
+        for idx, polyline in enumerate(polylines):
+            for part in polyline:
+                for a, b in izip(part, islice(part, 1, None)):
+                    pieces.append((a[0], a[1], b[0], b[1], idx))
+        if pieces:
+            lon = [p[0] for p in pieces] + [p[2] for p in pieces]
+            lat = [p[1] for p in pieces] + [p[3] for p in pieces]
+            self.origin = (0.5 * (min(lon) + max(lon)), 0.5 * (min(lat) + max(lat)))
+        else:
+            self.origin = (0, 0)
+
+        columns = zip(*pieces) if pieces else [()] * 5
+        self.ax, self.ay = project_local(columns[0], columns[1], self.origin)
+        self.bx, self.by = project_local(columns[2], columns[3], self.origin)
+        self.polyline = np.array(columns[4], dtype=np.int64)
+
+        self.tree = STRtree(
+            ((min(ax, bx), min(ay, by), max(ax, bx), max(ay, by)), i)
+            for i, (ax, ay, bx, by) in enumerate(izip(self.ax, self.ay, self.bx, self.by)))
+
+    def _nearest_pieces(self, x, y, pieces):
+        """returns the nearest of the pieces and its distance for every point"""
+        distances = segment_point_distances(self.ax[pieces], self.ay[pieces],
+                                            self.bx[pieces], self.by[pieces], x, y)
+        nearest = np.argmin(distances, axis=0)
+        return pieces[nearest], distances[nearest, np.arange(len(x))]
+
+    def nearest(self, lon, lat):
+        """
+        returns the indices of the nearest polylines of the points or -1 for
+        points without coordinates
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        result = np.empty(len(lon), dtype=np.int64)
+        result.fill(-1)
+        valid = np.flatnonzero(~(np.isnan(lon) | np.isnan(lat)))
+        if not len(valid) or not len(self.polyline):
+            return result
+
+        x, y = project_local(lon[valid], lat[valid], self.origin)
+        pieces = np.empty(len(valid), dtype=np.int64)
+        # consecutive points are usually close to each other, so querying
+        # the tree per chunk keeps the distance matrices small
+        for start in xrange(0, len(valid), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            pieces[chunk] = self._nearest_chunk(x[chunk], y[chunk])
+        result[valid] = self.polyline[pieces]
+        return result
+
+    def _nearest_chunk(self, x, y):
+        """returns the nearest pieces of the points"""
+        r = self.search_radius
+        envelope = (x.min() - r, y.min() - r, x.max() + r, y.max() + r)
+        candidates = np.array(sorted(self.tree.query(envelope)), dtype=np.int64)
+        if len(candidates):
+            pieces, distances = self._nearest_pieces(x, y, candidates)
+        else:
+            pieces, distances = np.zeros(len(x), dtype=np.int64), np.empty(len(x))
+            distances.fill(np.inf)
+        # pieces outside of the envelope may be nearer to points that are
+        # farther than the search radius from every candidate
+        far = np.flatnonzero(distances > r)
+        if len(far):
+            everything = np.arange(len(self.polyline))
+            pieces[far], _ = self._nearest_pieces(x[far], y[far], everything)
+        return pieces
+
+    def nearest_values(self, lon, lat):
+        """returns the values of the nearest polylines of the points or None"""
+        return [self.values[idx] if idx >= 0 else None for idx in self.nearest(lon, lat).tolist()]
@@ -1,6 +1,7 @@
 import os
 import ooarcpy
 import config
+import ec
 
 from datetime import datetime, timedelta
 
@@ -13,6 +14,8 @@ def to_millis(dt):
 if __name__ == '__main__':
   config.setenv()
   measurements = config.fgdb.feature_class('measurements').view()
+  # the copies keep the order of the rows
+  clustered = ec.is_clustered(config.fgdb.feature_class('measurements'))
   begin_period_1 = datetime(2016, 6, 6)
   begin_period_2 = datetime(2016, 9, 5)
   period_length = 4
@@ -52,3 +55,6 @@ if __name__ == '__main__':
       fields = [field.name for field in index.fields]
       if measurements.oid_field_name not in fields and measurements.shape_field_name not in fields:
         out.add_index(fields, index.name, index.isUnique, index.isAscending)
+
+    if clustered:
+      ec.set_clustered(out)
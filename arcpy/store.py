@@ -0,0 +1,216 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+
+from ooarcpy import SpatialArcPyEntityBase
+from runs import run_starts
+from utils import path_signature
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100000
+
+
+def _get_dtype(field):
+    """returns the NumPy type used to store the field or None if it is not supported"""
+    if field.type == 'String':
+        return np.dtype('S%d' % max(field.length, 1))
+    elif field.type in ('Integer', 'SmallInteger'):
+        return np.dtype(np.int64)
+    elif field.type in ('Double', 'Single'):
+        return np.dtype(np.float64)
+    return None
+
+def _convert(value, dtype):
+    """converts a cursor value to be stored as dtype"""
+    if dtype.kind == 'S':
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+    elif dtype.kind == 'f':
+        return np.nan if value is None else value
+    return 0 if value is None else value
+
+
+class MeasurementStore(object):
+    """
+    A columnar copy of a measurements table. Every column is stored as a
+    memory-mapped NumPy array; the rows are sorted by (track, time) and a
+    track -> row range index allows to look up the measurements of a track
+    (or of a time window of a track) by binary search.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'store.json')) as f:
+            self.metadata = json.load(f)
+        self.columns = dict((name, np.load(self._column_path(path, name), mmap_mode='r'))
+                            for name in self.metadata['fields'])
+        self.tracks = np.load(os.path.join(path, 'tracks.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+    def __len__(self):
+        return self.metadata['size']
+
+    @property
+    def fields(self):
+        return self.metadata['fields']
+
+    @staticmethod
+    def _column_path(path, name):
+        return os.path.join(path, 'column_%s.npy' % name)
+
+    def _track_key(self, track):
+        if self.tracks.dtype.kind == 'S':
+            return track.encode('utf-8') if isinstance(track, unicode) else str(track)
+        return track
+
+    def _track_index(self, track):
+        key = self._track_key(track)
+        idx = np.searchsorted(self.tracks, key)
+        if idx < len(self.tracks) and self.tracks[idx] == key:
+            return idx
+        return None
+
+    def rows(self, track):
+        """returns the row range of the track as a slice"""
+        idx = self._track_index(track)
+        if idx is None:
+            return slice(0, 0)
+        return slice(self.offsets[idx], self.offsets[idx + 1])
+
+    def window(self, track, min_time, max_time):
+        """
+        returns the row range of the measurements of the track between
+        min_time and max_time (inclusive) as a slice
+        """
+        rows = self.rows(track)
+        time = self.columns['time'][rows]
+        start = rows.start + np.searchsorted(time, min_time, 'left')
+        end = rows.start + np.searchsorted(time, max_time, 'right')
+        return slice(start, end)
+
+    def get(self, rows, fields):
+        """returns the values of the fields for the row range"""
+        return [self.columns[name][rows] for name in fields]
+
+    def close(self):
+        """drops the memory maps of the columns, so the files can be deleted"""
+        self.columns = {}
+
+    def is_current(self, entity):
+        """checks if the store was built from the current state of entity"""
+        return (self.metadata['source'] == entity.id and
+                self.metadata['signature'] == list(path_signature(os.path.dirname(entity.id)) or []))
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'store.json'))
+
+    @staticmethod
+    def open_or_build(entity, path, fields=None):
+        """opens the store at path or (re)builds it if it is missing or outdated"""
+        if MeasurementStore.exists(path):
+            store = MeasurementStore(path)
+            if store.is_current(entity):
+                return store
+            log.info('Measurement store %s is outdated', path)
+            # open memory maps keep Windows from deleting the files
+            store.close()
+            del store
+        return MeasurementStore.build(entity, path, fields)
+
+    @staticmethod
+    def build(entity, path, fields=None, chunk_size=CHUNK_SIZE):
+        """
+        Builds a store from any ooarcpy table or feature class. Besides the
+        supported attribute fields the store contains the coordinates of
+        feature classes as x and y columns. Columns are sorted one at a time,
+        so the memory used is bounded by the size of a few columns.
+        """
+        log.info('Building measurement store %s from %s', path, entity.id)
+        signature = path_signature(os.path.dirname(entity.id))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        dtypes = {}
+        for field in entity.list_fields():
+            if fields is not None and field.name not in fields:
+                continue
+            dtype = _get_dtype(field)
+            if dtype is not None:
+                dtypes[field.name] = dtype
+        for required in ('track', 'time'):
+            if required not in dtypes:
+                raise ValueError('%s has no supported field %s' % (entity.id, required))
+
+        names = sorted(dtypes)
+        cursor_fields = list(names)
+        if isinstance(entity, SpatialArcPyEntityBase):
+            names += ['x', 'y']
+            cursor_fields += ['SHAPE@X', 'SHAPE@Y']
+            dtypes['x'] = dtypes['y'] = np.dtype(np.float64)
+
+        # write the unsorted columns chunk by chunk
+        raw_paths = dict((name, os.path.join(path, 'raw_%s.bin' % name)) for name in names)
+        raw_files = dict((name, open(raw_paths[name], 'wb')) for name in names)
+        size = 0
+        try:
+            def flush(chunk):
+                for name, column in zip(names, zip(*chunk)):
+                    dtype = dtypes[name]
+                    np.array([_convert(x, dtype) for x in column], dtype=dtype).tofile(raw_files[name])
+
+            chunk = []
+            with entity.search(cursor_fields) as rows:
+                for row in rows:
+                    chunk.append(row)
+                    if len(chunk) == chunk_size:
+                        flush(chunk)
+                        size += len(chunk)
+                        chunk = []
+            if chunk:
+                flush(chunk)
+                size += len(chunk)
+        finally:
+            for f in raw_files.itervalues():
+                f.close()
+
+        def load_raw(name):
+            if not size:
+                return np.array([], dtype=dtypes[name])
+            return np.memmap(raw_paths[name], dtype=dtypes[name], mode='r', shape=(size,))
+
+        # sort by (track, time) and write the columns
+        track = load_raw('track')
+        order = np.lexsort((load_raw('time'), track))
+        # the raw files can not be removed on Windows while they are mapped
+        del track
+        for name in names:
+            raw = load_raw(name)
+            np.save(MeasurementStore._column_path(path, name), raw[order])
+            del raw
+            os.remove(raw_paths[name])
+
+        # create the track -> row range index
+        track = np.load(MeasurementStore._column_path(path, 'track'), mmap_mode='r')
+        starts = np.flatnonzero(run_starts(track))
+        np.save(os.path.join(path, 'tracks.npy'), np.array(track[starts]))
+        np.save(os.path.join(path, 'offsets.npy'), np.append(starts, size).astype(np.int64))
+        del track
+
+        with open(os.path.join(path, 'store.json'), 'w') as f:
+            json.dump({
+                'source': entity.id,
+                'signature': list(signature or []),
+                'fields': names,
+                'size': size,
+                'order': ['track', 'time']
+            }, f, indent=2)
+
+        return MeasurementStore(path)
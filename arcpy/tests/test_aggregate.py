@@ -0,0 +1,302 @@
+import random
+import unittest
+from contextlib import contextmanager
+from aggregate import MeanSpeedAggregator, PassageAggregator, StatisticsAggregator
+from classifiers import ClassifierTable
+
+
+class Field(object):
+
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+
+
+class FakeTable(object):
+    """a table with the methods of ooarcpy tables used by the aggregators"""
+
+    def __init__(self, fields=(), rows=()):
+        self.fields = [Field(name, type) for name, type in fields]
+        self.rows = list(rows)
+        self.created = False
+
+    def list_fields(self):
+        return self.fields
+
+    @contextmanager
+    def search(self, fields):
+        yield iter([tuple(row[name] for name in fields) for row in self.rows])
+
+    def delete_if_exists(self):
+        self.fields, self.rows, self.created = [], [], False
+
+    def create(self):
+        self.created = True
+
+    def add_field(self, name, type):
+        self.fields.append(Field(name, type))
+
+    def add_index(self, fields, name):
+        pass
+
+    @contextmanager
+    def insert(self, fields):
+        class Cursor(object):
+            def insertRow(cursor, row):
+                self.rows.append(dict(zip(fields, row)))
+        yield Cursor()
+
+    def tuples(self, *fields):
+        return [tuple(row[name] for name in fields) for row in self.rows]
+
+
+class FakeFileGDB(object):
+
+    def __init__(self, **tables):
+        self.tables = tables
+
+    def table(self, name):
+        return self.tables.setdefault(name, FakeTable())
+
+    feature_class = table
+
+
+class FakeModel(object):
+
+    def __init__(self, segments):
+        self.segments = segments
+
+
+MEASUREMENT_FIELDS = [('axis', 'String'), ('segment', 'Integer'), ('track', 'String'), ('time_class', 'Integer'),
+                      ('complete_axis_match', 'SmallInteger'), ('co2', 'Double'), ('consumption', 'Double'),
+                      ('speed', 'Double')]
+STOP_FIELDS = [('axis', 'String'), ('segment', 'Integer'), ('track', 'String'), ('time_class', 'Integer'),
+               ('complete', 'SmallInteger'), ('duration', 'Double')]
+SEGMENT_FIELDS = [('Achsen_ID', 'String'), ('segment_id', 'Integer'), ('laenge', 'Double')]
+# segment 2 is part of two axes, some segments have no length
+AXIS_SEGMENTS = [('1_1', 1, None), ('1_1', 2, 1.2), ('2_1', 2, 0.8), ('2_1', 3, None), ('3_1', 4, None)]
+
+
+def random_fgdb(seed, measurements=2000, stops=300):
+    rng = random.Random(seed)
+    classifiers = ClassifierTable()
+    time_classes = classifiers.values() + [None]
+
+    def value(low, high):
+        return rng.choice([None, 0, rng.uniform(low, high), rng.uniform(low, high)])
+
+    def row(fields):
+        axis, segment, length = rng.choice(AXIS_SEGMENTS[:-1])
+        return dict(axis=axis, segment=segment, track='t%d' % rng.randint(0, 9), time_class=rng.choice(time_classes),
+                    complete_axis_match=rng.randint(0, 1), complete=rng.randint(0, 1),
+                    co2=value(0, 10), consumption=value(0, 5), speed=value(0, 50), duration=value(1, 100))
+
+    segments = [dict(Achsen_ID=axis, segment_id=segment, laenge=length) for axis, segment, length in AXIS_SEGMENTS]
+    fgdb = FakeFileGDB(measurements=FakeTable(MEASUREMENT_FIELDS, [row(MEASUREMENT_FIELDS) for _ in xrange(measurements)]),
+                       stops=FakeTable(STOP_FIELDS, [row(STOP_FIELDS) for _ in xrange(stops)]))
+    return fgdb, FakeModel(FakeTable(SEGMENT_FIELDS, segments)), classifiers
+
+
+def in_class(row, classifiers, postfix):
+    return postfix == 'all' or bool((row['time_class'] or 0) & classifiers.bits[postfix])
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+def group(rows, keys):
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row[key] for key in keys), []).append(row)
+    return sorted(groups.iteritems())
+
+def value_rows(rows, keys, field):
+    """the rows of a Statistics_analysis with COUNT and MEAN of the field by the keys"""
+    result = []
+    for key, group_rows in group(rows, keys):
+        values = [row[field] for row in group_rows if row[field] is not None]
+        result.append(key + (len(values), mean(values)))
+    return result
+
+def speed_rows(rows, keys):
+    """the rows of the speed tables of the rows with a speed"""
+    result = []
+    for key, group_rows in group([row for row in rows if row['speed']], keys):
+        speeds = [row['speed'] for row in group_rows]
+        result.append(key + (len(speeds), mean(speeds), len(speeds) / sum(1 / speed for speed in speeds)))
+    return result
+
+def stop_rows(stops, keys):
+    """the rows of the stop tables with the number of stops of tracks that stopped more than once"""
+    multistops = {}
+    for key, group_rows in group(stops, keys + ['track']):
+        if len(group_rows) > 1:
+            multistops[key[:-1]] = multistops.get(key[:-1], 0) + len(group_rows)
+    return [row + (multistops.get(row[:-2], 0),) for row in value_rows(stops, keys, 'duration')]
+
+def length_sums(segments, keys):
+    """the sums of the non-null lengths by the keys, null if there are none"""
+    sums = {}
+    for key, rows in group(segments, keys):
+        lengths = [row['laenge'] for row in rows if row['laenge'] is not None]
+        sums[key] = sum(lengths) if lengths else None
+    return sums
+
+def passage_counts(passages, stops, keys, with_stops):
+    """
+    counts the passages with and without stops like the joins of the
+    passages to the stop statistics of find_passages did
+    """
+    num_stops = dict((key, len([row for row in rows if row['duration'] is not None]))
+                     for key, rows in group(stops, keys + ['track']))
+    counts = {}
+    for key in set(tuple(row[name] for name in keys + ['track']) for row in passages):
+        stopped = with_stops(num_stops.get(key))
+        without = num_stops.get(key) is None or num_stops[key] == 0
+        for name, selected in (('with', stopped), ('without', without)):
+            if selected:
+                counts.setdefault(name, {})
+                counts[name][key[:-1]] = counts[name].get(key[:-1], 0) + 1
+    return counts.get('with', {}), counts.get('without', {})
+
+def rounded(rows):
+    return [tuple(round(x, 9) if isinstance(x, float) else x for x in row) for row in rows]
+
+
+class StatisticsAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fgdb, self.model, self.classifiers = random_fgdb(0)
+        self.postfixes = ['all'] + self.classifiers.names
+        StatisticsAggregator(self.model, self.fgdb, self.classifiers, self.classifiers.names, chunk_size=333).run()
+
+    def selected(self, table, postfix):
+        return [row for row in self.fgdb.tables[table].rows if in_class(row, self.classifiers, postfix)]
+
+    def assertTable(self, name, fields, expected):
+        self.assertEqual(rounded(self.fgdb.tables[name].tuples(*fields)), rounded(expected), name)
+
+    def test_co2_and_consumption(self):
+        for postfix in self.postfixes:
+            measurements = self.selected('measurements', postfix)
+            for value in ('co2', 'consumption'):
+                self.assertTable('%s_by_axis_%s' % (value, postfix), ['axis', 'num_observations', value],
+                                 value_rows(measurements, ['axis'], value))
+                self.assertTable('%s_by_axis_segment_%s' % (value, postfix), ['axis', 'segment', 'num_observations', value],
+                                 value_rows(measurements, ['axis', 'segment'], value))
+
+    def test_speed(self):
+        fields = ['num_observations', 'arithmetic_mean_speed', 'harmonic_mean_speed']
+        for postfix in self.postfixes:
+            measurements = self.selected('measurements', postfix)
+            self.assertTable('speed_by_axis_segment_' + postfix, ['axis', 'segment'] + fields,
+                             speed_rows(measurements, ['axis', 'segment']))
+            self.assertTable('speed_by_axis_' + postfix, ['axis'] + fields,
+                             speed_rows([row for row in measurements if row['complete_axis_match'] == 1], ['axis']))
+
+    def test_stops(self):
+        for postfix in self.postfixes:
+            stops = self.selected('stops', postfix)
+            self.assertTable('stops_by_axis_' + postfix, ['axis', 'stops', 'duration', 'multistops'],
+                             stop_rows(stops, ['axis']))
+            self.assertTable('stops_by_axis_segment_' + postfix, ['axis', 'segment', 'stops', 'duration', 'multistops'],
+                             stop_rows(stops, ['axis', 'segment']))
+
+    def test_join_field(self):
+        self.assertEqual(self.fgdb.tables['co2_by_axis_segment_all'].tuples('join_field')[0], ('1_1|1',))
+
+    def test_travel_time(self):
+        def duration(length, speed):
+            return None if length is None or not speed else int(round(length / speed * 3600))
+
+        for postfix in self.postfixes:
+            lengths = length_sums(self.model.segments.rows, ['Achsen_ID', 'segment_id'])
+            # the speeds are joined by segment only, the first axis with the segment wins
+            speeds = {}
+            for row in self.fgdb.tables['speed_by_axis_segment_' + postfix].rows:
+                speeds.setdefault(row['segment'], row['arithmetic_mean_speed'])
+            self.assertTable('travel_time_by_axis_segment_' + postfix, ['axis', 'segment', 'duration'],
+                             [key + (duration(lengths[key], speeds.get(key[1])),) for key in sorted(lengths)])
+
+            speeds = dict(self.fgdb.tables['speed_by_axis_' + postfix].tuples('axis', 'arithmetic_mean_speed'))
+            axis_lengths = length_sums(self.model.segments.rows, ['Achsen_ID'])
+            self.assertTable('travel_time_by_axis_' + postfix, ['axis', 'duration'],
+                             [key + (duration(axis_lengths[key], speeds.get(key[0])),) for key in sorted(axis_lengths)])
+
+
+class MeanSpeedAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fgdb, self.model, self.classifiers = random_fgdb(1)
+        self.measurements = self.fgdb.tables['measurements']
+
+    def test_matches_baseline(self):
+        fields = ['num_observations', 'arithmetic_mean_speed', 'harmonic_mean_speed']
+        for chunk_size in (1, 100, 10000):
+            out = FakeFileGDB()
+            speeds = MeanSpeedAggregator(chunk_size)
+            speeds.scan(self.measurements)
+            speeds.write(out, 'all')
+            self.assertEqual(rounded(out.tables['speed_by_axis_segment_all'].tuples('axis', 'segment', *fields)),
+                             rounded(speed_rows(self.measurements.rows, ['axis', 'segment'])))
+            complete = [row for row in self.measurements.rows if row['complete_axis_match'] == 1]
+            self.assertEqual(rounded(out.tables['speed_by_axis_all'].tuples('axis', *fields)),
+                             rounded(speed_rows(complete, ['axis'])))
+
+    def test_field_types(self):
+        out = FakeFileGDB()
+        speeds = MeanSpeedAggregator()
+        speeds.scan(self.measurements)
+        speeds.write(out, 'all', axis_type='TEXT', segment_type='SHORT')
+        self.assertEqual([(f.name, f.type) for f in out.tables['speed_by_axis_segment_all'].fields[:2]],
+                         [('axis', 'TEXT'), ('segment', 'SHORT')])
+
+
+class PassageAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fgdb, self.model, self.classifiers = random_fgdb(2, measurements=500, stops=100)
+        PassageAggregator(self.model, self.fgdb, self.classifiers, self.classifiers.names).run()
+
+    def selected(self, table, postfix, **values):
+        return [row for row in self.fgdb.tables[table].rows if in_class(row, self.classifiers, postfix)
+                and all(row[name] == value for name, value in values.iteritems())]
+
+    def test_by_axis_segment(self):
+        axis_segments = sorted(set((axis, segment) for axis, segment, length in AXIS_SEGMENTS))
+        for postfix in ['all'] + self.classifiers.names:
+            with_stops, without_stops = passage_counts(
+                self.selected('measurements', postfix), self.selected('stops', postfix), ['axis', 'segment'],
+                # a stop without a duration makes a passage one with and without stops
+                lambda num_stops: num_stops is not None)
+
+            def joined(counts, segment):
+                # the counts are joined by segment only, the first axis with the segment wins
+                for (a, s), count in sorted(counts.iteritems()):
+                    if s == segment:
+                        return count
+                return 0
+
+            expected = []
+            for axis, segment in axis_segments:
+                w, wo = joined(with_stops, segment), joined(without_stops, segment)
+                expected.append((axis, segment, w, wo, w + wo))
+            self.assertEqual(self.fgdb.tables['passages_by_axis_segment_' + postfix].tuples(
+                'axis', 'segment', 'passages_with_stops', 'passages_without_stops', 'passages_overall'), expected, postfix)
+
+    def test_by_axis(self):
+        axes = sorted(set(axis for axis, segment, length in AXIS_SEGMENTS))
+        for postfix in ['all'] + self.classifiers.names:
+            with_stops, without_stops = passage_counts(
+                self.selected('measurements', postfix, complete_axis_match=1),
+                self.selected('stops', postfix, complete=1), ['axis'],
+                lambda num_stops: num_stops > 0)
+            expected = []
+            for axis in axes:
+                w, wo = with_stops.get((axis,), 0), without_stops.get((axis,), 0)
+                expected.append((axis, w, wo, w + wo))
+            self.assertEqual(self.fgdb.tables['passages_by_axis_' + postfix].tuples(
+                'axis', 'passages_with_stops', 'passages_without_stops', 'passages_overall'), expected, postfix)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import calendar
+import unittest
+from datetime import datetime
+import numpy as np
+from classifiers import CLASSIFIERS, HOURS_PER_WEEK, MILLIS_PER_HOUR, BitmapIndex, ClassifierTable, hour_of_week, hours_of_week
+
+
+def millis(*args):
+    return calendar.timegm(datetime(*args).timetuple()) * 1000
+
+
+class HourOfWeekTest(unittest.TestCase):
+
+    def test_monday_is_zero(self):
+        self.assertEqual(hour_of_week(millis(2017, 5, 1)), 0)
+        self.assertEqual(hour_of_week(millis(2017, 5, 7, 23, 59)), HOURS_PER_WEEK - 1)
+
+    def test_arrays(self):
+        times = np.arange(0, 2 * HOURS_PER_WEEK * MILLIS_PER_HOUR, MILLIS_PER_HOUR // 3, dtype=np.int64)
+        self.assertEqual(hours_of_week(times).tolist(), [hour_of_week(t) for t in times.tolist()])
+
+
+class ClassifierTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = ClassifierTable()
+
+    def test_table_matches_classifiers(self):
+        for how in xrange(HOURS_PER_WEEK):
+            weekday, hour = divmod(how, 24)
+            for i, c in enumerate(CLASSIFIERS):
+                self.assertEqual(bool(self.table.table[how] & (1 << i)), c.contains(weekday, hour))
+
+    def test_masks_match_mask(self):
+        rng = np.random.RandomState(0)
+        start = rng.randint(0, 10 ** 12, 1000).astype(np.int64)
+        end = start + rng.randint(0, 10 ** 7, 1000)
+        self.assertEqual(self.table.masks(start, end).tolist(),
+                         [self.table.mask(a, b) for a, b in zip(start.tolist(), end.tolist())])
+
+    def test_values_are_all_stored_masks(self):
+        masks = self.table.table.tolist()
+        expected = sorted(set(a | b for a in masks for b in masks))
+        self.assertEqual(self.table.values(), expected)
+        self.assertEqual(len(self.table.values()), 37)
+
+    def test_where_clause(self):
+        for name in self.table.names:
+            values = self.table.values_with(name)
+            self.assertEqual(len(values), 8)
+            self.assertTrue(all(v & self.table.bits[name] for v in values))
+            self.assertEqual(self.table.where_clause(name),
+                             'time_class IN (%s)' % ', '.join(str(v) for v in values))
+
+    def test_flags(self):
+        t = millis(2017, 5, 6, 5)
+        self.assertEqual(self.table.flags(t, names=['weekend_morning', 'workday_morning']), (1, 0))
+
+
+class BitmapIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = ClassifierTable()
+        rng = np.random.RandomState(0)
+        self.masks = rng.choice(self.table.values(), 500)
+        self.index = BitmapIndex(self.masks, self.table)
+
+    def test_select(self):
+        self.assertEqual(len(self.index), 500)
+        for name in self.table.names:
+            values = self.table.values_with(name)
+            self.assertEqual(self.index.select(name).tolist(), [m in values for m in self.masks.tolist()])
+            self.assertEqual(self.index.count(name), sum(m in values for m in self.masks.tolist()))
+
+    def test_flags(self):
+        names = ['workday_evening', 'weekend_morning']
+        flags = self.index.flags(names)
+        self.assertEqual(zip(*(f.tolist() for f in flags)),
+                         [tuple(1 if m & self.table.bits[name] else 0 for name in names) for m in self.masks.tolist()])
+
+
+if __name__ == '__main__':
+    unittest.main()
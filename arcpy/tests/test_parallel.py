@@ -0,0 +1,155 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from parallel import PartitionedExecutor, TaskGraph, partition_of
+
+FIELDS = ['axis', 'track', 'time']
+
+
+def summarize_tracks(columns, index, offset):
+    """yields the first index, length and time sum of every run of a track and a second result per run"""
+    axis, track, time = columns
+    starts = np.flatnonzero(np.concatenate(([True], (axis[1:] != axis[:-1]) | (track[1:] != track[:-1]))))
+    ends = np.append(starts[1:], len(axis))
+    for start, end in zip(starts, ends):
+        key = (axis[start], track[start])
+        yield index[start], key + (end - start, time[start:end].sum() + offset)
+        # results of the same row keep their order
+        yield index[start], key + ('second',)
+
+def write_marker(directory, name, inputs):
+    """fails unless the markers of the inputs exist and writes the marker of name"""
+    for input in inputs:
+        if not os.path.exists(os.path.join(directory, input)):
+            raise IOError('%s is missing' % input)
+    open(os.path.join(directory, name), 'w').close()
+
+def fail():
+    raise ValueError('task failed')
+
+def die():
+    os._exit(1)
+
+def reference(rows, offset):
+    results = []
+    for i, row in enumerate(rows):
+        if i == 0 or rows[i - 1][:2] != row[:2]:
+            results.append(row[:2] + (0, offset))
+            results.append(row[:2] + ('second',))
+        axis, track, count, total = results[-2]
+        results[-2] = (axis, track, count + 1, total + row[2])
+    return results
+
+def random_rows(rng, n):
+    """rows clustered by (axis, track) like the measurements the executor is run on"""
+    keys = [(axis, 't%d' % track) for axis in ('1_1', '2_1', '3_1') for track in xrange(100)]
+    rng.shuffle(keys)
+    rows = []
+    for axis, track in keys:
+        rows.extend((axis, track, rng.randint(0, 100)) for _ in xrange(rng.randint(1, 30)))
+    return rows[:n]
+
+
+class PartitionedExecutorTest(unittest.TestCase):
+
+    def run_map(self, rows, **kwargs):
+        executor = PartitionedExecutor(**kwargs)
+        return list(executor.map(summarize_tracks, iter(rows), FIELDS, (1000,)))
+
+    def test_order_is_independent_of_partitions(self):
+        rows = random_rows(random.Random(0), 1000)
+        expected = reference(rows, 1000)
+        for partitions in (1, 2, 7):
+            for chunk_size in (1, 13, 5000):
+                self.assertEqual(self.run_map(rows, partitions=partitions, chunk_size=chunk_size), expected,
+                                 'partitions=%d chunk_size=%d' % (partitions, chunk_size))
+
+    def test_order_is_independent_of_workers(self):
+        rows = random_rows(random.Random(1), 2000)
+        expected = reference(rows, 1000)
+        for workers in (1, 2, 3):
+            self.assertEqual(self.run_map(rows, workers=workers, chunk_size=100), expected, 'workers=%d' % workers)
+
+    def test_empty(self):
+        self.assertEqual(self.run_map([], partitions=3), [])
+
+    def test_partition_of(self):
+        partitions = [partition_of(axis, 't%d' % track, 5) for axis in ('1_1', '2_1') for track in xrange(100)]
+        self.assertTrue(all(0 <= p < 5 for p in partitions))
+        self.assertEqual(len(set(partitions)), 5)
+        self.assertEqual(partition_of(u'1_1', u't1', 5), partition_of('1_1', 't1', 5))
+
+
+class TaskGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def diamond(self):
+        """a -> b, c -> d and the independent e"""
+        graph = TaskGraph()
+        for name, inputs in (('d', 'bc'), ('b', 'a'), ('c', 'a'), ('a', ''), ('e', '')):
+            graph.add(name, write_marker, (self.directory, name, inputs), inputs=inputs, outputs=name)
+        return graph
+
+    def test_order(self):
+        self.assertEqual([t.name for t in self.diamond().order()], ['a', 'b', 'c', 'd', 'e'])
+
+    def test_cycle(self):
+        graph = TaskGraph()
+        graph.add('a', fail, inputs=['y'], outputs=['x'])
+        graph.add('b', fail, inputs=['x'], outputs=['y'])
+        self.assertRaises(ValueError, graph.order)
+
+    def test_duplicates(self):
+        graph = TaskGraph()
+        graph.add('a', fail, outputs=['x'])
+        self.assertRaises(ValueError, graph.add, 'a', fail)
+        self.assertRaises(ValueError, graph.add, 'b', fail, outputs=['x'])
+
+    def test_critical_path(self):
+        graph = self.diamond()
+        self.assertEqual(TaskGraph().critical_path(), ([], 0))
+        for task, duration in zip(graph.tasks, (1, 2, 5, 3, 8.5)):
+            task.duration = duration
+        path, duration = graph.critical_path()
+        self.assertEqual(([t.name for t in path], duration), (['a', 'c', 'd'], 9))
+        graph.tasks[-1].duration = 10
+        path, duration = graph.critical_path()
+        self.assertEqual(([t.name for t in path], duration), (['e'], 10))
+
+    def test_run(self):
+        for workers in (1, 3):
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+            graph = self.diamond()
+            completed = []
+            graph.run(workers, completed=lambda task: completed.append(task.name))
+            self.assertEqual(sorted(os.listdir(self.directory)), ['a', 'b', 'c', 'd', 'e'])
+            self.assertEqual(sorted(completed), ['a', 'b', 'c', 'd', 'e'])
+            for task in graph.tasks:
+                self.assertIsNotNone(task.duration)
+                # the callback is called before any dependent task is started
+                for dependency in graph.dependencies(task):
+                    self.assertLess(completed.index(dependency.name), completed.index(task.name))
+
+    def test_failing_task(self):
+        graph = TaskGraph()
+        graph.add('fail', fail)
+        self.assertRaises(ValueError, graph.run)
+        self.assertRaises(RuntimeError, graph.run, 2)
+
+    def test_lost_worker(self):
+        graph = TaskGraph()
+        graph.add('die', die)
+        self.assertRaises(RuntimeError, graph.run, 2, timeout=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
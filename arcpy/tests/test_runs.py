@@ -0,0 +1,141 @@
+import unittest
+import numpy as np
+from runs import run_starts, cluster_intervals, find_stop_runs
+
+
+def reference_visits(keys, start, end, gap):
+    """clusters the intervals interval by interval"""
+    visits = []
+    for key, s, e in zip(keys, start, end):
+        if visits and visits[-1][0] == key and s - visits[-1][2] < gap:
+            visits[-1][2] = e
+        else:
+            visits.append([key, s, e])
+    return [tuple(visit) for visit in visits]
+
+def reference_stop_runs(keys, speed, start_threshold, end_threshold):
+    """finds the (first, last, complete) rows of the stops row by row"""
+    stops = []
+    current = None
+    first = last = None
+    for i, s in enumerate(speed):
+        key = tuple(k[i] for k in keys)
+        if first is not None and key != current:
+            stops.append((first, last, i - 1))
+            first = None
+        current = key
+        if first is not None:
+            if s <= end_threshold:
+                last = i
+            else:
+                stops.append((first, last, i))
+                first = None
+        elif s < start_threshold:
+            first = last = i
+    if first is not None:
+        stops.append((first, last, len(speed) - 1))
+    return stops
+
+def chunked_stop_runs(keys, speed, start_threshold, end_threshold, chunk_size):
+    """finds the stops chunk by chunk, passing the remaining rows on like Stop.find_columns"""
+    stops = []
+    offset = 0
+    n = len(speed)
+    end = 0
+    while offset < n:
+        end = min(max(end, offset) + chunk_size, n)
+        final = end == n
+        first, last, complete, done = find_stop_runs(
+            [k[offset:end] for k in keys], speed[offset:end], start_threshold, end_threshold, final)
+        stops.extend(zip((first + offset).tolist(), (last + offset).tolist(), (complete + offset).tolist()))
+        offset += done
+    return stops
+
+def random_rows(rng, n):
+    axis = np.sort(rng.randint(0, 3, n))
+    track = rng.randint(0, 2, n)
+    order = np.lexsort((track, axis))
+    speed = rng.choice([-np.inf, 0, 2, 5, 7, 10, 15], n)
+    return [axis[order], track[order]], speed
+
+
+class RunStartsTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(len(run_starts([])), 0)
+
+    def test_single_key(self):
+        self.assertEqual(run_starts([3, 3, 1, 1, 3]).tolist(), [True, False, True, False, True])
+
+    def test_any_key_starts_a_run(self):
+        starts = run_starts([1, 1, 1, 2, 2], ['a', 'b', 'b', 'b', 'b'])
+        self.assertEqual(starts.tolist(), [True, True, False, True, False])
+
+
+class ClusterIntervalsTest(unittest.TestCase):
+
+    def test_empty(self):
+        keys, start, end = cluster_intervals([], [], [], 5)
+        self.assertEqual((len(keys), len(start), len(end)), (0, 0, 0))
+
+    def test_keys_are_not_merged(self):
+        # touching intervals of different keys are separate visits
+        keys, start, end = cluster_intervals(['a', 'a', 'b', 'b', 'c'], [0, 2, 4, 6, 7], [1, 3, 5, 7, 9], 5)
+        self.assertEqual(zip(keys.tolist(), start.tolist(), end.tolist()),
+                         [('a', 0, 3), ('b', 4, 7), ('c', 7, 9)])
+
+    def test_gap(self):
+        # a gap of exactly gap starts a new visit
+        keys, start, end = cluster_intervals([1, 1, 1, 1], [0, 9, 20, 30], [5, 15, 25, 35], 5)
+        self.assertEqual(zip(keys.tolist(), start.tolist(), end.tolist()),
+                         [(1, 0, 15), (1, 20, 25), (1, 30, 35)])
+
+    def test_matches_reference(self):
+        rng = np.random.RandomState(0)
+        for n in (1, 2, 10, 500):
+            keys = np.sort(rng.randint(0, 5, n))
+            start = np.concatenate([np.sort(rng.randint(0, 1000, np.count_nonzero(keys == k))) for k in xrange(5)])
+            end = start + rng.randint(0, 30, n)
+            for gap in (1, 10, 100):
+                visits = cluster_intervals(keys, start, end, gap)
+                self.assertEqual(zip(*(a.tolist() for a in visits)),
+                                 reference_visits(keys.tolist(), start.tolist(), end.tolist(), gap))
+
+
+class FindStopRunsTest(unittest.TestCase):
+
+    def test_rejects_inverted_thresholds(self):
+        self.assertRaises(ValueError, find_stop_runs, [[1]], [1], 10, 5)
+
+    def test_empty(self):
+        first, last, complete, done = find_stop_runs([[]], [], 5, 10)
+        self.assertEqual((len(first), len(last), len(complete), done), (0, 0, 0, 0))
+
+    def test_matches_reference(self):
+        rng = np.random.RandomState(0)
+        for n in (1, 2, 5, 50, 500):
+            keys, speed = random_rows(rng, n)
+            first, last, complete, done = find_stop_runs(keys, speed, 5, 10)
+            self.assertEqual(done, n)
+            self.assertEqual(zip(first.tolist(), last.tolist(), complete.tolist()),
+                             reference_stop_runs(keys, speed, 5, 10))
+
+    def test_equal_thresholds(self):
+        rng = np.random.RandomState(1)
+        keys, speed = random_rows(rng, 200)
+        first, last, complete, _ = find_stop_runs(keys, speed, 7, 7)
+        self.assertEqual(zip(first.tolist(), last.tolist(), complete.tolist()),
+                         reference_stop_runs(keys, speed, 7, 7))
+
+    def test_chunks_are_equivalent(self):
+        rng = np.random.RandomState(2)
+        for n in (1, 10, 300):
+            keys, speed = random_rows(rng, n)
+            expected = reference_stop_runs(keys, speed, 5, 10)
+            for chunk_size in (1, 2, 3, 7, 1000):
+                self.assertEqual(chunked_stop_runs(keys, speed, 5, 10, chunk_size), expected,
+                                 'n=%d chunk_size=%d' % (n, chunk_size))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import random
+import struct
+import unittest
+import numpy as np
+from spatial import STRtree, SegmentLocator, intersects, linestring_wkb, project_local, segment_point_distances
+
+
+def random_envelope(rng, size):
+    x, y = rng.uniform(0, 100), rng.uniform(0, 100)
+    return (x, y, x + rng.uniform(0, size), y + rng.uniform(0, size))
+
+
+class STRtreeTest(unittest.TestCase):
+
+    def test_empty(self):
+        tree = STRtree([])
+        self.assertEqual(len(tree), 0)
+        self.assertEqual(list(tree.query((0, 0, 1, 1))), [])
+
+    def test_rejects_small_capacity(self):
+        self.assertRaises(ValueError, STRtree, [], 1)
+
+    def test_single_entry(self):
+        tree = STRtree([((0, 0, 1, 1), 'a')])
+        self.assertEqual(list(tree.query((1, 1, 2, 2))), ['a'])
+        self.assertEqual(list(tree.query((1.5, 1.5, 2, 2))), [])
+
+    def test_matches_brute_force(self):
+        rng = random.Random(0)
+        for n, node_capacity in ((5, 2), (100, 4), (1000, 10)):
+            entries = [(random_envelope(rng, 5), i) for i in xrange(n)]
+            tree = STRtree(entries, node_capacity)
+            self.assertEqual(len(tree), n)
+            for _ in xrange(50):
+                envelope = random_envelope(rng, 20)
+                self.assertEqual(sorted(tree.query(envelope)),
+                                 [value for e, value in entries if intersects(e, envelope)])
+
+
+class SegmentPointDistancesTest(unittest.TestCase):
+
+    def distance(self, ax, ay, bx, by, px, py):
+        # samples the segment densely, the error is at most half a step
+        t = np.linspace(0, 1, 10001)
+        return np.hypot(ax + t * (bx - ax) - px, ay + t * (by - ay) - py).min()
+
+    def test_matches_sampling(self):
+        rng = np.random.RandomState(0)
+        ax, ay, bx, by = rng.rand(4, 20)
+        px, py = rng.rand(2, 30) * 2 - 0.5
+        distances = segment_point_distances(ax, ay, bx, by, px, py)
+        self.assertEqual(distances.shape, (20, 30))
+        for i in xrange(20):
+            for j in xrange(30):
+                self.assertAlmostEqual(distances[i, j], self.distance(ax[i], ay[i], bx[i], by[i], px[j], py[j]), 4)
+
+    def test_degenerated_segment(self):
+        self.assertEqual(segment_point_distances([1], [1], [1], [1], [4], [5]).tolist(), [[5.0]])
+
+    def test_project_local(self):
+        x, y = project_local([7.0, 7.01], [52.0, 52.0], (7.0, 52.0))
+        self.assertEqual((x[0], y[0]), (0, 0))
+        # one hundredth of a degree of longitude is about 685 m at 52 degrees
+        self.assertAlmostEqual(x[1], 685, -1)
+        self.assertEqual(y[1], 0)
+
+
+class SegmentLocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.polylines = []
+        for i in xrange(30):
+            n = rng.randint(2, 6)
+            points = np.cumsum(rng.randn(n, 2) * 0.002, axis=0) + [7.6 + rng.rand() * 0.05, 51.9 + rng.rand() * 0.05]
+            self.polylines.append([[tuple(p) for p in points]])
+        self.values = ['s%d' % i for i in xrange(30)]
+        self.lon = 7.6 + rng.rand(1000) * 0.07
+        self.lat = 51.9 + rng.rand(1000) * 0.07
+
+    def brute_force(self, locator, lon, lat):
+        x, y = project_local(lon, lat, locator.origin)
+        distances = segment_point_distances(locator.ax, locator.ay, locator.bx, locator.by, x, y)
+        return locator.polyline[np.argmin(distances, axis=0)]
+
+    def test_matches_brute_force(self):
+        for search_radius, chunk_size in ((50, 17), (100, 256), (5000, 1)):
+            locator = SegmentLocator(self.polylines, self.values, search_radius, chunk_size)
+            self.assertEqual(locator.nearest(self.lon, self.lat).tolist(),
+                             self.brute_force(locator, self.lon, self.lat).tolist())
+
+    def test_missing_coordinates(self):
+        locator = SegmentLocator(self.polylines, self.values)
+        lon, lat = self.lon[:3].copy(), self.lat[:3].copy()
+        lat[1] = np.nan
+        values = locator.nearest_values(lon, lat)
+        self.assertIsNone(values[1])
+        self.assertEqual([values[0], values[2]], locator.nearest_values(lon[[0, 2]], lat[[0, 2]]))
+
+    def test_no_polylines(self):
+        locator = SegmentLocator([], [])
+        self.assertEqual(locator.nearest([7.6], [51.9]).tolist(), [-1])
+
+
+class LinestringWkbTest(unittest.TestCase):
+
+    def test_too_few_points(self):
+        self.assertIsNone(linestring_wkb([], []))
+        self.assertIsNone(linestring_wkb([1.0], [2.0]))
+
+    def test_encoding(self):
+        wkb = linestring_wkb([1.0, 3.0, 5.0], [2.0, 4.0, 6.0])
+        self.assertIsInstance(wkb, bytearray)
+        self.assertEqual(struct.unpack('<BII', bytes(wkb[:9])), (1, 2, 3))
+        self.assertEqual(struct.unpack('<6d', bytes(wkb[9:])), (1.0, 2.0, 3.0, 4.0, 5.0, 6.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import shutil
+import random
+import tempfile
+import unittest
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    from ooarcpy import SpatialArcPyEntityBase
+    from store import MeasurementStore
+except ImportError:
+    # the store reads ooarcpy entities and needs ArcPy
+    MeasurementStore = None
+
+
+class Field(object):
+
+    def __init__(self, name, type, length=0):
+        self.name = name
+        self.type = type
+        self.length = length
+
+
+class FakeTable(object):
+    """a table with the list_fields and search methods of ooarcpy tables"""
+
+    def __init__(self, id, fields, rows):
+        self.id = id
+        self.fields = fields
+        self.rows = rows
+
+    def list_fields(self):
+        return self.fields
+
+    @contextmanager
+    def search(self, fields):
+        names = [field.name for field in self.fields] + ['SHAPE@X', 'SHAPE@Y']
+        indices = [names.index(name) for name in fields]
+        yield iter([tuple(row[i] for i in indices) for row in self.rows])
+
+
+class FakeFeatureClass(FakeTable):
+    pass
+
+
+FIELDS = [Field('track', 'String', 4), Field('time', 'Double'), Field('speed', 'Double'),
+          Field('count', 'Integer'), Field('shape', 'Geometry')]
+
+
+@unittest.skipIf(MeasurementStore is None, 'ArcPy is not available')
+class MeasurementStoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        SpatialArcPyEntityBase.register(FakeFeatureClass)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = random.Random(0)
+        self.rows = []
+        for track in ('t1', 't2', 't3'):
+            for time in rng.sample(xrange(1000), 100):
+                speed = None if rng.random() < 0.1 else rng.uniform(0, 100)
+                x = None if rng.random() < 0.1 else rng.uniform(7, 8)
+                self.rows.append((track, float(time), speed, rng.randint(0, 10), None, x, None if x is None else 52.0))
+        rng.shuffle(self.rows)
+        self.path = os.path.join(self.directory, 'store')
+        self.gdb = os.path.join(self.directory, 'measurements.gdb')
+        os.makedirs(self.gdb)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, cls=FakeFeatureClass, chunk_size=7):
+        entity = cls(os.path.join(self.gdb, 'measurements'), FIELDS, self.rows)
+        return MeasurementStore.build(entity, self.path, chunk_size=chunk_size)
+
+    def expected(self, track, min_time=-np.inf, max_time=np.inf):
+        return sorted(row for row in self.rows if row[0] == track and min_time <= row[1] <= max_time)
+
+    def test_build(self):
+        store = self.build()
+        self.assertEqual(len(store), len(self.rows))
+        self.assertEqual(store.fields, ['count', 'speed', 'time', 'track', 'x', 'y'])
+        self.assertTrue(MeasurementStore.exists(self.path))
+        store.close()
+
+    def test_tables_have_no_coordinates(self):
+        store = self.build(FakeTable)
+        self.assertEqual(store.fields, ['count', 'speed', 'time', 'track'])
+        store.close()
+
+    def test_rows(self):
+        store = self.build()
+        for track in ('t1', 't2', 't3', u't2'):
+            time, speed, count, x = store.get(store.rows(track), ['time', 'speed', 'count', 'x'])
+            expected = self.expected(track)
+            self.assertEqual(time.tolist(), [row[1] for row in expected])
+            self.assertEqual(count.tolist(), [row[3] for row in expected])
+            # missing values are stored as NaN
+            self.assertEqual(np.isnan(speed).tolist(), [row[2] is None for row in expected])
+            self.assertEqual(np.isnan(x).tolist(), [row[5] is None for row in expected])
+        store.close()
+
+    def test_missing_track(self):
+        store = self.build()
+        self.assertEqual(store.rows('t0'), slice(0, 0))
+        self.assertEqual(store.rows('t4'), slice(0, 0))
+        store.close()
+
+    def test_window(self):
+        store = self.build(chunk_size=1000)
+        for min_time, max_time in ((-1, 2000), (100, 200), (500, 500), (300, 299)):
+            time, = store.get(store.window('t2', min_time, max_time), ['time'])
+            self.assertEqual(time.tolist(), [row[1] for row in self.expected('t2', min_time, max_time)])
+        store.close()
+
+    def test_open_is_current(self):
+        self.build().close()
+        store = MeasurementStore(self.path)
+        entity = FakeFeatureClass(os.path.join(self.gdb, 'measurements'), FIELDS, self.rows)
+        self.assertTrue(store.is_current(entity))
+        self.assertFalse(store.is_current(FakeFeatureClass(os.path.join(self.gdb, 'other'), FIELDS, self.rows)))
+        # changes of the source FileGDB outdate the store
+        with open(os.path.join(self.gdb, 'a00000001.gdbtable'), 'w') as f:
+            f.write('rows')
+        self.assertFalse(store.is_current(entity))
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
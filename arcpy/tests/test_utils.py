@@ -0,0 +1,44 @@
+import random
+import unittest
+from utils import route_to_intervals, sort_rows
+
+
+class SortRowsTest(unittest.TestCase):
+
+    def test_matches_sorted(self):
+        rng = random.Random(0)
+        for n in (0, 1, 5, 99, 100, 101, 1000):
+            rows = [(rng.randint(0, 5), i) for i in xrange(n)]
+            for chunk_size in (1, 3, 100):
+                result = list(sort_rows(iter(rows), key=lambda row: row[0], chunk_size=chunk_size))
+                # sorted() is stable, so equal keys have to keep their order
+                self.assertEqual(result, sorted(rows, key=lambda row: row[0]), 'n=%d chunk_size=%d' % (n, chunk_size))
+
+
+class RouteToIntervalsTest(unittest.TestCase):
+
+    def brute_force(self, rows, intervals):
+        return [(row, value) for row in rows
+                for min_time, max_time, value in intervals.get(row[0], ())
+                if min_time <= row[1] <= max_time]
+
+    def test_example(self):
+        rows = [('a', 1), ('a', 2), ('a', 3), ('a', 5), ('b', 1), ('b', 4), ('c', 1)]
+        intervals = {'a': [(1, 2, 'a0'), (2, 5, 'a1')], 'b': [(2, 4, 'b0')]}
+        self.assertEqual(list(route_to_intervals(rows, lambda row: row[0], lambda row: row[1], intervals)),
+                         [(('a', 1), 'a0'), (('a', 2), 'a0'), (('a', 2), 'a1'), (('a', 3), 'a1'),
+                          (('a', 5), 'a1'), (('b', 4), 'b0')])
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        rows = sorted((rng.choice('abc'), rng.randint(0, 100)) for _ in xrange(500))
+        intervals = {}
+        for key in 'ab':
+            starts = sorted(rng.randint(0, 100) for _ in xrange(10))
+            intervals[key] = [(s, s + rng.randint(0, 20), '%s%d' % (key, i)) for i, s in enumerate(starts)]
+        result = list(route_to_intervals(rows, lambda row: row[0], lambda row: row[1], intervals))
+        self.assertEqual(sorted(result), sorted(self.brute_force(rows, intervals)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 import gzip
+import hashlib
+import heapq
+import json
 import os
+import tempfile
+import cPickle as pickle
 from glob import glob
-from itertools import izip, islice, tee
+from itertools import izip, islice, tee, groupby
 
 
 def nwise(iterable, n = 2):
@@ -30,6 +35,71 @@ def gzip_file(file, remove = True):
         os.remove(file)
     return target
 
+def path_signature(path):
+    """returns the size and modification time of a file or of the files in a
+    directory. the lock files of open FileGDBs are ignored, they come and go
+    with the cursors and layers of any process"""
+    if os.path.isdir(path):
+        size, mtime = 0, 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                if name.endswith('.lock'):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime)
+        return (size, mtime)
+    elif os.path.exists(path):
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime)
+    return None
+
+def fingerprint(*values):
+    """creates a SHA-1 hash of the representation of the values"""
+    return hashlib.sha1(repr(values)).hexdigest()
+
+class Manifest(object):
+    """a JSON file that records the completed steps of a run"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default = None):
+        return self.entries.get(key, default)
+
+    def set(self, key, value):
+        """sets the entry and writes the manifest"""
+        self.entries[key] = value
+        self.save()
+
+    def remove(self, key):
+        """removes the entry and writes the manifest"""
+        if key in self.entries:
+            del self.entries[key]
+            self.save()
+
+    def save(self):
+        """writes the manifest, replacing the old file only if writing succeeded"""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent = 2, sort_keys = True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def delete(self):
+        """deletes the manifest file"""
+        self.entries = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
 class MinMax(object):
     def __init__(self, min, max):
         self.min = min
@@ -57,6 +127,66 @@ def min_max(iterable, key=None, min_key=None, max_key=None):
         	max_value = value
     return MinMax(min_value, max_value)
 
+def route_to_intervals(rows, key, time, intervals):
+    """merge-joins rows ordered by (key, time) with the time intervals of each
+    key. intervals maps keys to lists of (min_time, max_time, value) tuples
+    sorted by min_time. yields a (row, value) tuple for every interval that
+    contains a row (inclusive), overlapping intervals yield a row repeatedly"""
+    for k, group in groupby(rows, key):
+        pending = intervals.get(k, ())
+        active = []
+        i = 0
+        for row in group:
+            t = time(row)
+            while i < len(pending) and pending[i][0] <= t:
+                active.append(pending[i])
+                i += 1
+            if active:
+                active = [interval for interval in active if interval[1] >= t]
+                for interval in active:
+                    yield row, interval[2]
+
+def _spill(chunk, directory):
+    """writes the rows of a sorted chunk to a temporary file and returns it"""
+    f = tempfile.TemporaryFile(dir = directory)
+    for row in chunk:
+        pickle.dump(row, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def _unspill(f, index):
+    """reads the rows of a spilled chunk as (key, index, row) tuples"""
+    try:
+        while True:
+            entry = pickle.load(f)
+            yield entry[0], index, entry[1]
+    except EOFError:
+        f.close()
+
+def sort_rows(rows, key, chunk_size = 100000, directory = None):
+    """sorts the rows by key using at most chunk_size rows of memory. chunks
+    of sorted rows are spilled to temporary files in directory and merged.
+    the sort is stable"""
+    chunks = []
+    try:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            chunk.sort(key = key)
+            if not chunks and len(chunk) < chunk_size:
+                # everything fits into memory
+                for row in chunk:
+                    yield row
+                return
+            chunks.append(_spill(((key(row), row) for row in chunk), directory))
+        # the chunk index keeps equal keys in input order
+        for k, index, row in heapq.merge(*[_unspill(f, i) for i, f in enumerate(chunks)]):
+            yield row
+    finally:
+        for f in chunks:
+            f.close()
+
 class SQL(object):
     @staticmethod
     def is_between_(name, value):
@@ -83,6 +213,11 @@ class SQL(object):
         """creates a "not equal" statement"""
         return '%s <> %s' % (name, str(value))
 
+    @staticmethod
+    def in_(name, values):
+        """creates a "in" statement"""
+        return '%s IN (%s)' % (name, ', '.join(str(x) for x in values))
+
     @staticmethod
     def quote_(value):
         """encloses value in quotes"""